@@ -0,0 +1,130 @@
+"""
+Бенчмарк запросов к БД до и после миграций схемы.
+
+Создаёт во временной папке БД в старом формате (без индексов, время
+строкой), замеряет горячие запросы, затем выполняет на этой БД
+подготовку из main.py (те же миграции, что при старте бота) и замеряет
+снова.
+
+    python bench/db_queries.py --rows 100000
+"""
+import os
+import sys
+import io
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+import contextlib
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LEGACY_SCHEMA = """
+CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, category TEXT,
+    price INTEGER, description TEXT, image TEXT);
+CREATE TABLE support_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER,
+    username TEXT, message TEXT, timestamp TEXT, is_read INTEGER DEFAULT 0, from_admin INTEGER DEFAULT 0);
+CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, username TEXT,
+    products_json TEXT, total_price INTEGER, timestamp TEXT, status TEXT DEFAULT 'pending');
+CREATE TABLE purchases (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, order_id INTEGER, timestamp TEXT);
+"""
+
+LEGACY_QUERIES = {
+    "support_users": ("""SELECT DISTINCT user_id, username, MAX(timestamp) as last_time FROM support_messages
+        WHERE from_admin = 0 GROUP BY user_id ORDER BY last_time DESC""", ()),
+    "user_messages": ("SELECT message, timestamp, from_admin FROM support_messages WHERE user_id=? ORDER BY timestamp", "uid"),
+    "pending_orders": ("""SELECT id, user_id, username, products_json, total_price, timestamp, status
+        FROM orders WHERE status != 'completed' ORDER BY timestamp DESC""", ()),
+    "user_purchases": ("""SELECT o.products_json, o.total_price, p.timestamp FROM purchases p
+        JOIN orders o ON p.order_id = o.id WHERE p.user_id = ? ORDER BY p.timestamp DESC""", "uid"),
+}
+
+
+def build_legacy_db(path, rows, users):
+    rnd = random.Random(42)
+    start = datetime(2024, 1, 1)
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany(
+        "INSERT INTO products (name, category, price, description, image) VALUES (?,?,?,?,?)",
+        [(f"Ягода {i}", "Варенье", 1000 + i, "", "") for i in range(20)]
+    )
+
+    def ts(i):
+        return (start + timedelta(minutes=i)).strftime("%d.%m.%y %H:%M")
+
+    conn.executemany(
+        "INSERT INTO support_messages (user_id, username, message, timestamp, from_admin) VALUES (?,?,?,?,?)",
+        ((rnd.randrange(users), "user", "сообщение", ts(i), int(rnd.random() < 0.3)) for i in range(rows))
+    )
+    conn.executemany(
+        "INSERT INTO orders (user_id, username, products_json, total_price, timestamp, status) VALUES (?,?,?,?,?,?)",
+        ((rnd.randrange(users), "user", '[{"name": "x", "weight": 1, "price": 100}]', 100, ts(i),
+          "completed" if rnd.random() < 0.98 else "pending") for i in range(rows))
+    )
+    conn.execute("""INSERT INTO purchases (user_id, order_id, timestamp)
+        SELECT user_id, id, timestamp FROM orders WHERE status = 'completed'""")
+    conn.commit()
+    conn.close()
+
+
+def timeit(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return samples[len(samples) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="shopbench_")
+    db_path = os.path.join(tmp, "shop.db")
+    print(f"Создание БД: {args.rows} строк в каждой таблице, {args.users} пользователей...")
+    build_legacy_db(db_path, args.rows, args.users)
+    uid = 7
+
+    conn = sqlite3.connect(db_path)
+    before = {}
+    for name, (sql, params) in LEGACY_QUERIES.items():
+        p = (uid,) if params == "uid" else params
+        before[name] = timeit(lambda: conn.execute(sql, p).fetchall(), args.repeat)
+    conn.close()
+
+    # Миграции на этой БД — те же, что выполняются при старте бота
+    os.environ["DB_FILE"] = db_path
+    sys.path.insert(0, ROOT)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+        t0 = time.perf_counter()
+        main.prepare_database()
+    migrate_ms = (time.perf_counter() - t0) * 1000
+
+    after = {
+        # Список диалогов читается из сводки support_threads постранично
+        "support_users": timeit(lambda: main.get_support_threads_page.sync(), args.repeat),
+        # История диалога теперь читается окном (последние N сообщений)
+        "user_messages": timeit(lambda: main.get_support_messages_window.sync(uid), args.repeat),
+        # Список заказов в админке теперь постраничный: первая страница
+        "pending_orders": timeit(lambda: main.get_open_orders_page.sync(), args.repeat),
+        # История покупок — первая страница со строками из order_items
+        "user_purchases": timeit(lambda: main.get_user_purchases_page.sync(uid), args.repeat),
+    }
+
+    print(f"\nМиграция при старте: {migrate_ms:.0f} мс")
+    print(f"\n{'запрос':<16}{'до, мс':>10}{'после, мс':>12}")
+    for name in LEGACY_QUERIES:
+        print(f"{name:<16}{before[name]:>10.2f}{after[name]:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
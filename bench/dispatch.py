@@ -0,0 +1,188 @@
+"""
+Микро-бенчмарк диспетчеризации апдейтов: цепочка фильтров F.data и
+if mode == ... (как было) против таблиц маршрутов из main.py.
+
+Два уровня замера:
+  * match — только выбор обработчика и разбор аргументов callback_data;
+  * aiogram — полный путь апдейта через Dispatcher.feed_update
+    (обработчики пустые, к Bot API запросов нет).
+
+    python bench/dispatch.py --updates 20000
+"""
+import os
+import sys
+import io
+import time
+import random
+import asyncio
+import argparse
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Порядок регистрации и вид фильтров — как в обработчиках до перехода на таблицы
+LEGACY_CALLBACKS = [
+    ("eq", "admin_main"), ("eq", "admin_products"), ("eq", "admin_support"), ("eq", "admin_orders"),
+    ("prefix", "support_page_"), ("prefix", "support_user_"), ("prefix", ("support_older_", "support_newer_")),
+    ("prefix", "support_reply_"), ("prefix", "order_view_"), ("prefix", "order_page_"), ("eq", "order_search"),
+    ("prefix", "order_msg_"), ("prefix", "order_complete_"), ("eq", "noop"), ("prefix", "admin_prod_"),
+    ("prefix", "prod_page_"), ("eq", "prod_search"), ("eq", "admin_add"), ("prefix", "edit_name_"),
+    ("prefix", "edit_cat_"), ("prefix", "edit_price_"), ("prefix", "edit_desc_"), ("prefix", "edit_photo_"),
+    ("prefix", "del_"), ("eq", "import_apply"), ("eq", "import_cancel"), ("eq", "catalog_import"),
+    ("prefix", "catalog_export_"), ("eq", "support_from_notification"),
+]
+
+LEGACY_TEXT_MODES = [
+    "support_message", "support_reply", "order_message", "order_search", "product_search",
+    "add_name", "add_cat", "add_price", "add_desc", "edit_name", "edit_cat", "edit_price", "edit_desc",
+]
+
+SAMPLE_CALLBACKS = [
+    "admin_main", "admin_products", "admin_support", "admin_orders", "support_page_n_3_1005",
+    "support_user_1005", "support_older_1005_77", "support_newer_1005_77", "support_reply_1005",
+    "order_view_501", "order_page_n_501", "order_search", "order_msg_501", "order_complete_501", "noop",
+    "admin_prod_12", "prod_page_p_12", "prod_search", "admin_add", "edit_name_12", "edit_cat_12",
+    "edit_price_12", "edit_desc_12", "edit_photo_12", "del_12", "import_apply", "import_cancel",
+    "catalog_import", "catalog_export_csv", "support_from_notification",
+]
+
+
+def load_main():
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("ADMIN_IDS", "1")
+    sys.path.insert(0, ROOT)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+    return main
+
+
+def legacy_filters():
+    from aiogram import F
+    filters = []
+    for kind, value in LEGACY_CALLBACKS:
+        if kind == "eq":
+            filters.append(F.data == value)
+        elif isinstance(value, tuple):
+            filters.append(F.data.startswith(value[0]) | F.data.startswith(value[1]))
+        else:
+            filters.append(F.data.startswith(value))
+    return filters
+
+
+def make_callback(data):
+    from aiogram import types
+    return types.CallbackQuery(
+        id="1", chat_instance="bench", data=data,
+        from_user=types.User(id=1, is_bot=False, first_name="bench"),
+    )
+
+
+def make_update(update_id, data=None, text=None):
+    from aiogram import types
+    user = {"id": 1, "is_bot": False, "first_name": "bench"}
+    if data is not None:
+        return types.Update.model_validate({"update_id": update_id, "callback_query": {
+            "id": str(update_id), "chat_instance": "bench", "data": data, "from": user,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": 1, "type": "private"}, "text": "x"},
+        }})
+    return types.Update.model_validate({"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "chat": {"id": 1, "type": "private"},
+        "from": user, "text": text,
+    }})
+
+
+def per_update_us(func, items, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = (time.perf_counter() - t0) / len(items) * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_match(main, count, repeat):
+    rnd = random.Random(1)
+    calls = [make_callback(rnd.choice(SAMPLE_CALLBACKS)) for _ in range(count)]
+    modes = [rnd.choice(LEGACY_TEXT_MODES) for _ in range(count)]
+    filters = legacy_filters()
+
+    def legacy_callback(call):
+        for flt in filters:
+            if flt.resolve(call):
+                # Обработчики затем разбирали call.data сами
+                return call.data.split("_")
+        return None
+
+    def table_callback(call):
+        return main.callback_route.filter(call)
+
+    def legacy_mode(mode):
+        for candidate in LEGACY_TEXT_MODES:
+            if mode == candidate:
+                return candidate
+        return None
+
+    return {
+        "callback": (per_update_us(legacy_callback, calls, repeat), per_update_us(table_callback, calls, repeat)),
+        "text mode": (per_update_us(legacy_mode, modes, repeat), per_update_us(main.text_mode.routes.get, modes, repeat)),
+    }
+
+
+async def bench_aiogram(main, count, repeat):
+    from aiogram import Bot, Dispatcher, F
+    from aiogram.fsm.storage.memory import MemoryStorage
+
+    async def noop_handler(event, **kwargs):
+        pass
+
+    legacy = Dispatcher(storage=MemoryStorage())
+    for flt in legacy_filters():
+        legacy.callback_query.register(noop_handler, flt)
+    legacy.message.register(noop_handler, F.text)
+
+    table = Dispatcher(storage=MemoryStorage())
+    table.callback_query.register(noop_handler, main.callback_route.filter)
+    table.message.register(noop_handler, F.text, main.text_mode.filter)
+
+    rnd = random.Random(2)
+    updates = [make_update(i, data=rnd.choice(SAMPLE_CALLBACKS)) for i in range(count)]
+    bot = Bot("123456:bench")
+
+    async def run(dp):
+        best = None
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            for update in updates:
+                await dp.feed_update(bot, update)
+            elapsed = (time.perf_counter() - t0) / len(updates) * 1e6
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    try:
+        return {"callback": (await run(legacy), await run(table))}
+    finally:
+        await bot.session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    shop = load_main()
+    print(f"Маршрутов callback: {len(shop.callback_route.routes)}, режимов текста: {len(shop.text_mode.routes)}")
+
+    results = {f"match/{k}": v for k, v in bench_match(shop, args.updates, args.repeat).items()}
+    aiogram_updates = max(args.updates // 10, 100)
+    results.update({f"aiogram/{k}": v for k, v in asyncio.run(bench_aiogram(shop, aiogram_updates, args.repeat)).items()})
+
+    print(f"\n{'замер':<20}{'цепочка, мкс':>14}{'таблица, мкс':>14}{'ускорение':>11}")
+    for name, (legacy, table) in results.items():
+        print(f"{name:<20}{legacy:>14.2f}{table:>14.2f}{legacy / table:>10.1f}x")
+
+
+if __name__ == "__main__":
+    main()
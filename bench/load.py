@@ -0,0 +1,346 @@
+"""
+Нагрузочный бенчмарк main.py с локальной заглушкой Telegram Bot API.
+
+Для каждого размера БД создаёт во временной папке базу в старом формате
+(как bench/db_queries.py), запускает main.py отдельным процессом —
+миграции выполняются при старте, как в бою, готовность ждём по
+/readyz — и направляет его в
+заглушку Bot API. Заглушка отвечает на sendMessage, getFile и остальные
+методы с заданной задержкой и считает вызовы.
+
+Сценарии (webhook-апдейты пользователей и админа, /api/products,
+/api/order/create, /api/support/send, /api/profile) гоняются по очереди
+с заданной параллельностью; для каждого печатаются пропускная
+способность и задержки p50/p95/p99.
+
+    python bench/load.py --sizes 1000,100000 --requests 2000 --concurrency 50 --api-latency 0.05
+"""
+import os
+import sys
+import io
+import time
+import random
+import socket
+import json
+import asyncio
+import argparse
+import itertools
+import tempfile
+import subprocess
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+from db_queries import build_legacy_db
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BOT_TOKEN = "123456:BENCH"
+ADMIN_ID = 1
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+# --------------------------------
+# Заглушка Bot API
+# --------------------------------
+class FakeBotAPI:
+    """Отвечает как api.telegram.org, но с фиксированной задержкой"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = itertools.count(1)
+        self.file_body = None
+        self.webhook_url = ""
+
+    def message(self, chat_id, text=""):
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "from": {"id": 123456, "is_bot": True, "first_name": "bench"},
+            "text": text,
+        }
+
+    async def handle_method(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getWebhookInfo":
+            result = {"url": self.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "setWebhook":
+            self.webhook_url = data.get("url", "")
+            result = True
+        elif method == "getFile":
+            file_id = data.get("file_id", "file")
+            result = {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_path": f"photos/{file_id}.jpg"}
+        elif method.startswith("send") or method.startswith("edit"):
+            result = self.message(data.get("chat_id"), data.get("text", ""))
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request):
+        self.calls["file"] += 1
+        if self.file_body is None:
+            from PIL import Image
+            buf = io.BytesIO()
+            Image.new("RGB", (1200, 900), (200, 40, 60)).save(buf, "JPEG")
+            self.file_body = buf.getvalue()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=self.file_body, content_type="image/jpeg")
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# --------------------------------
+# Сценарии нагрузки
+# --------------------------------
+class Traffic:
+    """Генерирует запросы сценариев: (метод, путь, параметры aiohttp)"""
+
+    def __init__(self, users, products):
+        self.users = users
+        self.products = products
+        self.rnd = random.Random(7)
+        self.update_ids = itertools.count(1)
+
+    def user(self):
+        uid = self.rnd.randrange(2, self.users)
+        return uid, {"id": uid, "is_bot": False, "first_name": "user", "username": f"user{uid}"}
+
+    def webhook(self, update):
+        update["update_id"] = next(self.update_ids)
+        return "POST", f"/webhook/{BOT_TOKEN}", {"json": update}
+
+    def webhook_user(self, i):
+        uid, user = self.user()
+        text = self.rnd.choice(["/start", "💬 Поддержка", "Здравствуйте, когда доставка?"])
+        return self.webhook({"message": {
+            "message_id": i + 1, "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"}, "from": user, "text": text,
+        }})
+
+    def webhook_admin(self, i):
+        admin = {"id": ADMIN_ID, "is_bot": False, "first_name": "admin"}
+        return self.webhook({"callback_query": {
+            "id": str(i), "from": admin, "chat_instance": "bench",
+            "data": self.rnd.choice(["admin_orders", "admin_support", "admin_products"]),
+            "message": {
+                "message_id": i + 1, "date": int(time.time()),
+                "chat": {"id": ADMIN_ID, "type": "private"},
+                "from": {"id": 123456, "is_bot": True, "first_name": "bench"}, "text": "меню",
+            },
+        }})
+
+    def products_list(self, i):
+        return "GET", "/api/products", {"headers": {"Accept-Encoding": "gzip"}}
+
+    def order_create(self, i):
+        uid, user = self.user()
+        cart = [{
+            "product_id": p["id"],
+            "portions": [self.rnd.choice([{"weight": 1.4, "discount": 0}, {"weight": 2.1, "discount": 5}])],
+        } for p in self.rnd.sample(self.products, min(3, len(self.products)))]
+        return "POST", "/api/order/create", {"json": {"user_id": uid, "username": user["username"], "cart": cart}}
+
+    def support_send(self, i):
+        uid, user = self.user()
+        return "POST", "/api/support/send", {"json": {
+            "user_id": uid, "username": user["username"], "message": f"Вопрос №{i}",
+        }}
+
+    def profile(self, i):
+        uid, user = self.user()
+        return "GET", f"/api/profile?user_id={uid}&username={user['username']}", {}
+
+
+SCENARIOS = {
+    "webhook_user": Traffic.webhook_user,
+    "webhook_admin": Traffic.webhook_admin,
+    "products": Traffic.products_list,
+    "order_create": Traffic.order_create,
+    "support_send": Traffic.support_send,
+    "profile": Traffic.profile,
+}
+
+
+async def run_scenario(session, base, make_request, total, concurrency):
+    latencies = []
+    errors = Counter()
+    counter = itertools.count()
+
+    async def worker():
+        while (i := next(counter)) < total:
+            method, path, kwargs = make_request(i)
+            t0 = time.perf_counter()
+            try:
+                async with session.request(method, base + path, **kwargs) as resp:
+                    await resp.read()
+                    if resp.status >= 400:
+                        errors[resp.status] += 1
+            except aiohttp.ClientError as e:
+                errors[type(e).__name__] += 1
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": total / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+    }
+
+
+async def wait_webhook_drain(session, base, timeout=120):
+    """Ждёт, пока воркеры обработают все принятые апдейты; время в секундах"""
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        async with session.get(base + "/api/webhook/stats") as resp:
+            stats = await resp.json()
+        if stats["queue_depth"] == 0 and stats["processed"] + stats["failed"] >= stats["received"] - stats["duplicates"] - stats["rejected"]:
+            return time.perf_counter() - t0
+        await asyncio.sleep(0.05)
+    return None
+
+
+# --------------------------------
+# Запуск main.py
+# --------------------------------
+def start_server(workdir, db_path, port, api_port):
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        ADMIN_IDS=str(ADMIN_ID),
+        PORT=str(port),
+        RENDER_EXTERNAL_URL=f"http://127.0.0.1:{port}",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{api_port}",
+        DB_FILE=db_path,
+        DATA_JSON=os.path.join(workdir, "data.json"),
+        # Фото из сценария админа сохраняются во временную папку, а не в web/images
+        IMAGES_DIR=os.path.join(workdir, "images"),
+        PYTHONUNBUFFERED="1",
+        # Все клиенты бенчмарка идут с одного адреса — ограничитель частоты
+        # WebApp отключаем, меряется пропускная способность сервера
+        RATE_LIMITS=json.dumps({
+            route: {"user": [1e9, 1e9], "ip": [1e9, 1e9], "concurrency": 0}
+            for route in ("/api/support/send", "/api/order/create", "/api/cart/quote")
+        }),
+    )
+    log = open(os.path.join(workdir, "server.log"), "w")
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "main.py")], env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc, log
+
+
+async def wait_ready(session, base, proc, timeout):
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError("main.py завершился при старте")
+        try:
+            async with session.get(base + "/readyz") as resp:
+                if resp.status == 200:
+                    return time.perf_counter() - t0, (await resp.json())["timings"]
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("main.py не поднялся за отведённое время")
+
+
+async def bench_size(args, rows, scenarios):
+    workdir = tempfile.mkdtemp(prefix="shopload_")
+    db_path = os.path.join(workdir, "shop.db")
+    print(f"\n== БД: {rows} строк в каждой таблице, {args.users} пользователей ==")
+    build_legacy_db(db_path, rows, args.users)
+
+    api = FakeBotAPI(args.api_latency)
+    api_port, port = free_port(), free_port()
+    await api.start(api_port)
+    proc, log = start_server(workdir, db_path, port, api_port)
+    base = f"http://127.0.0.1:{port}"
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        try:
+            startup, timings = await wait_ready(session, base, proc, args.startup_timeout)
+            print(f"Старт (с миграциями): {startup:.1f} с, этапы: {timings}")
+            async with session.get(base + "/api/products") as resp:
+                products = await resp.json()
+            traffic = Traffic(args.users, products)
+
+            print(f"\n{'сценарий':<16}{'запросов':>10}{'ошибок':>8}{'rps':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+            for name in scenarios:
+                make_request = SCENARIOS[name].__get__(traffic)
+                result = await run_scenario(session, base, make_request, args.requests, args.concurrency)
+                print(f"{name:<16}{result['requests']:>10}{sum(result['errors'].values()):>8}{result['rps']:>10.0f}"
+                      f"{result['p50']:>10.2f}{result['p95']:>10.2f}{result['p99']:>10.2f}")
+                if result["errors"]:
+                    print(f"{'':<16}ошибки: {dict(result['errors'])}")
+                if name.startswith("webhook"):
+                    drain = await wait_webhook_drain(session, base)
+                    print(f"{'':<16}обработка очереди после приёма: "
+                          + (f"{drain * 1000:.0f} мс" if drain is not None else "не дождались"))
+
+            print(f"\nВызовы Bot API: {dict(api.calls.most_common())}")
+        except RuntimeError as e:
+            print(f"❌ {e}, лог: {log.name}")
+        finally:
+            proc.terminate()
+            proc.wait()
+            log.close()
+            await api.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,100000", help="размеры БД через запятую")
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--requests", type=int, default=2_000, help="запросов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="задержка заглушки Bot API, с")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    unknown = [s for s in scenarios if s not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+
+    for rows in (int(x) for x in args.sizes.split(",") if x):
+        asyncio.run(bench_size(args, rows, scenarios))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,46 @@ import os
 import sys
 import asyncio
 import json
+import io
+import re
+import gzip
+import hashlib
+import hmac
+import mimetypes
+import csv
+import tempfile
 import sqlite3
-from datetime import datetime
+import time
+import threading
+import signal
+import subprocess
+import functools
+import bisect
+import math
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl
 from aiohttp import web
 from dotenv import load_dotenv
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.strategy import FSMStrategy
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from PIL import Image, ImageOps
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BOOT_STARTED = time.perf_counter()
 
 print("=" * 60)
 print("🚀 СТАРТ ПРИЛОЖЕНИЯ")
@@ -21,13 +54,37 @@ print("📋 Загрузка переменных окружения...")
 load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Повторная регистрация webhook: по умолчанию только при смене URL, а
+# накопившиеся за время деплоя апдейты сохраняются
+WEBHOOK_FORCE_SET = os.getenv("WEBHOOK_FORCE_SET", "") == "1"
+WEBHOOK_DROP_PENDING = os.getenv("WEBHOOK_DROP_PENDING", "") == "1"
 ADMIN_IDS_STR = os.getenv("ADMIN_IDS", "")
 PORT = int(os.getenv("PORT", 10000))
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL", f"http://0.0.0.0:{PORT}")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 8))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+# Многопроцессный режим: супервизор запускает WORKER_PROCESSES процессов
+# на общем порту; WORKER_INDEX выставляется супервизором для дочерних
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 1))
+WORKER_INDEX = os.getenv("WORKER_INDEX", "")
+MULTI_PROCESS = WORKER_PROCESSES > 1
+# Апдейты обрабатывает один процесс (воркер 0 или единственный процесс)
+IS_UPDATE_OWNER = WORKER_INDEX in ("", "0")
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", 20))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_TTL = int(os.getenv("STATE_TTL", 3600))
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", 10000))
+SUPPORT_PAGE_SIZE = int(os.getenv("SUPPORT_PAGE_SIZE", 30))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+# Другой сервер Bot API (локальный telegram-bot-api или заглушка из bench/load.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
 
 print(f"✅ BOT_TOKEN: {'✓ установлен' if BOT_TOKEN else '✗ ОТСУТСТВУЕТ'}")
 print(f"✅ ADMIN_IDS: {ADMIN_IDS_STR}")
 print(f"✅ PORT: {PORT}")
+if MULTI_PROCESS:
+    print(f"✅ Процессов: {WORKER_PROCESSES}" + (f", воркер #{WORKER_INDEX}" if WORKER_INDEX else " (супервизор)"))
 print(f"✅ RENDER_EXTERNAL_URL: {RENDER_EXTERNAL_URL}")
 
 if not BOT_TOKEN:
@@ -38,38 +95,264 @@ ADMIN_IDS = [int(x.strip()) for x in ADMIN_IDS_STR.split(",") if x.strip().isdig
 print(f"✅ Админы (ID): {ADMIN_IDS}")
 
 print("\n📦 Инициализация бота...")
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    print(f"✅ Bot API: {TELEGRAM_API_URL}")
+else:
+    bot = Bot(token=BOT_TOKEN)
 print("✅ Бот инициализирован")
 
+# --------------------------------
+# Метрики
+# --------------------------------
+# Счётчики и гистограммы живут в памяти процесса и отдаются на /metrics
+# в текстовом формате Prometheus. Серия создаётся при первом появлении
+# метки, дальше каждое наблюдение — bisect и несколько сложений, поэтому
+# сбор не нужно выключать в проде. Метки берутся только из ограниченных
+# множеств: имена маршрутов, обработчиков, функций БД и методов Bot API.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+LOOP_LAG_INTERVAL = 0.5
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class RouteStats(Histogram):
+    __slots__ = ("statuses",)
+
+    def __init__(self):
+        super().__init__()
+        self.statuses = [0] * 6  # 1xx..5xx по индексу status // 100
+
+http_metrics = {}       # маршрут -> RouteStats
+handler_metrics = {}    # обработчик -> {режим диалога: Histogram}
+db_metrics = {}         # функция БД -> Histogram (пишется из потоков пула)
+bot_api_metrics = {}    # метод Bot API -> Histogram
+bot_api_errors = {}     # класс исключения -> количество
+loop_lag = Histogram()
+loop_lag_state = {"last": 0.0}
+metrics_lock = threading.Lock()
+
+def get_histogram(table, key, factory=Histogram):
+    hist = table.get(key)
+    if hist is None:
+        hist = table[key] = factory()
+    return hist
+
+class BotAPIMetrics(BaseRequestMiddleware):
+    """Время и ошибки исходящих вызовов Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        hist = get_histogram(bot_api_metrics, method.__api_method__)
+        t0 = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            hist.errors += 1
+            name = type(e).__name__
+            bot_api_errors[name] = bot_api_errors.get(name, 0) + 1
+            raise
+        finally:
+            hist.observe(time.perf_counter() - t0)
+
+bot.session.middleware(BotAPIMetrics())
+
+async def handler_metrics_middleware(handler, event, data):
+    """Время обработчиков aiogram по имени функции и режиму диалога"""
+    handler_object = data.get("handler")
+    route = data.get("route")
+    if route:
+        # Через таблицы маршрутов — по имени конечного обработчика
+        name = route[0].__name__
+    else:
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+    by_mode = handler_metrics.get(name)
+    if by_mode is None:
+        by_mode = handler_metrics[name] = {}
+    hist = get_histogram(by_mode, data.get("raw_state") or "")
+    t0 = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        hist.errors += 1
+        raise
+    finally:
+        hist.observe(time.perf_counter() - t0)
+
+@web.middleware
+async def http_metrics_middleware(request, handler):
+    resource = request.match_info.route.resource
+    # У маршрута webhook есть имя, чтобы токен не попадал в метки
+    route = (resource.name or resource.canonical) if resource is not None else "unmatched"
+    status = 500
+    t0 = time.perf_counter()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        stats = get_histogram(http_metrics, route, RouteStats)
+        stats.observe(time.perf_counter() - t0)
+        stats.statuses[min(status // 100, 5)] += 1
+
+async def monitor_loop_lag():
+    """Задержка event loop: насколько позже срока просыпается sleep"""
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, time.perf_counter() - t0 - LOOP_LAG_INTERVAL)
+        loop_lag.observe(lag)
+        loop_lag_state["last"] = lag
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def metric_labels(**labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + "}"
+
+def render_histogram(lines, name, hist, **labels):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, hist.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{metric_labels(**labels, le=bound)} {cumulative}")
+    lines.append(f"{name}_bucket{metric_labels(**labels, le='+Inf')} {hist.count}")
+    lines.append(f"{name}_sum{metric_labels(**labels)} {hist.sum}")
+    lines.append(f"{name}_count{metric_labels(**labels)} {hist.count}")
+
+def metric_header(lines, name, kind, help_text):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
 # --------------------------------
 # Пути и база данных
 # --------------------------------
 print("\n📂 Настройка путей...")
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 WEB_DIR = os.path.join(BASE_DIR, "web")
-IMAGES_DIR = os.path.join(WEB_DIR, "images")
-DB_FILE = os.path.join(BASE_DIR, "shop.db")
-DATA_JSON = os.path.join(WEB_DIR, "data.json")
+IMAGES_DIR = os.getenv("IMAGES_DIR", os.path.join(WEB_DIR, "images"))
+DERIVED_DIR = os.path.join(IMAGES_DIR, "derived")
+DB_FILE = os.getenv("DB_FILE", os.path.join(BASE_DIR, "shop.db"))
+DATA_JSON = os.getenv("DATA_JSON", os.path.join(WEB_DIR, "data.json"))
+ARCHIVE_DB_FILE = os.getenv("ARCHIVE_DB_FILE", os.path.splitext(DB_FILE)[0] + "_archive.db")
 
 print(f"BASE_DIR: {BASE_DIR}")
 print(f"WEB_DIR: {WEB_DIR}")
+print(f"IMAGES_DIR: {IMAGES_DIR}")
 print(f"DB_FILE: {DB_FILE}")
+print(f"ARCHIVE_DB_FILE: {ARCHIVE_DB_FILE}")
 print(f"DATA_JSON: {DATA_JSON}")
 
 os.makedirs(IMAGES_DIR, exist_ok=True)
+os.makedirs(DERIVED_DIR, exist_ok=True)
 print("✅ Директории созданы")
 
+# --------------------------------
+# Слой доступа к БД
+# --------------------------------
+# Запросы выполняются в отдельном пуле потоков, чтобы не блокировать
+# event loop. У каждого потока пула своё долгоживущее соединение
+# (WAL, кэш подготовленных выражений), поэтому соединения не закрываются
+# после каждого запроса.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4))
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+_db_local = threading.local()
+
+def open_conn():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, timeout=30, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA foreign_keys=ON")
+    # Старые заказы и диалоги лежат в отдельном файле (см. "Архив и хранение")
+    conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB_FILE,))
+    # Действует только на новый (пустой) файл, поэтому до смены журнала
+    conn.execute("PRAGMA archive.auto_vacuum=INCREMENTAL")
+    conn.execute("PRAGMA archive.journal_mode=WAL")
+    conn.execute("PRAGMA archive.synchronous=NORMAL")
+    # lower() в SQLite понимает только латиницу
+    conn.create_function("casefold", 1, lambda v: v.casefold() if isinstance(v, str) else v, deterministic=True)
+    return conn
+
 def get_conn():
-    return sqlite3.connect(DB_FILE, check_same_thread=False)
+    """Соединение текущего потока (создаётся один раз)"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = open_conn()
+        _db_local.conn = conn
+    return conn
 
-def init_db():
-    print("\n🗄️  Инициализация базы данных...")
-    conn = get_conn()
-    cur = conn.cursor()
-    
+def timed_db_call(func, *args, **kwargs):
+    """Выполняется в потоке пула: время запроса без ожидания в очереди пула"""
+    t0 = time.perf_counter()
+    failed = False
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        with metrics_lock:
+            hist = get_histogram(db_metrics, func.__name__)
+            hist.observe(elapsed)
+            hist.errors += failed
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(timed_db_call, func, *args, **kwargs))
+
+def db_task(func):
+    """Делает функцию работы с БД awaitable: она выполняется в пуле БД.
+    Синхронный вариант доступен как func.sync (для старта и других db-функций)."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_db(func, *args, **kwargs)
+    wrapper.sync = func
+    return wrapper
+
+# --------------------------------
+# Миграции схемы
+# --------------------------------
+# Версия схемы хранится в PRAGMA user_version. Миграция N переводит БД
+# с версии N-1 на N; каждая выполняется в отдельной транзакции.
+# Новые миграции добавляются только в конец списка.
+TS_FORMAT = "%d.%m.%y %H:%M"
+MIGRATIONS = []
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+def now_ts():
+    """Текущее время: (строка для отображения, epoch для сортировки и индексов)"""
+    now = datetime.now()
+    return now.strftime(TS_FORMAT), int(now.timestamp())
+
+def parse_legacy_ts(value):
+    """Старые строки вида '17.10.26 18:33' -> epoch (None если не разобрать)"""
+    try:
+        return int(datetime.strptime(value, TS_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+@migration
+def m001_base_schema(conn):
     # Таблица товаров
-    cur.execute("""CREATE TABLE IF NOT EXISTS products (
+    conn.execute("""CREATE TABLE IF NOT EXISTS products (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         name TEXT,
         category TEXT,
@@ -79,7 +362,7 @@ def init_db():
     )""")
     
     # Таблица сообщений поддержки
-    cur.execute("""CREATE TABLE IF NOT EXISTS support_messages (
+    conn.execute("""CREATE TABLE IF NOT EXISTS support_messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
         username TEXT,
@@ -90,7 +373,7 @@ def init_db():
     )""")
     
     # Таблица заказов
-    cur.execute("""CREATE TABLE IF NOT EXISTS orders (
+    conn.execute("""CREATE TABLE IF NOT EXISTS orders (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
         username TEXT,
@@ -101,15 +384,373 @@ def init_db():
     )""")
     
     # Таблица покупок (история)
-    cur.execute("""CREATE TABLE IF NOT EXISTS purchases (
+    conn.execute("""CREATE TABLE IF NOT EXISTS purchases (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER,
         order_id INTEGER,
         timestamp TEXT
     )""")
-    
+
+@migration
+def m002_epoch_timestamps(conn):
+    # Строки "%d.%m.%y %H:%M" сортируются по дню месяца, поэтому рядом
+    # храним epoch-секунды; текстовая колонка остаётся для отображения
+    conn.create_function("parse_legacy_ts", 1, parse_legacy_ts, deterministic=True)
+    for table in ("support_messages", "orders", "purchases"):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN created_at INTEGER")
+        conn.execute(f"UPDATE {table} SET created_at = COALESCE(parse_legacy_ts(timestamp), 0)")
+
+@migration
+def m003_indexes(conn):
+    # История диалога пользователя
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_support_user ON support_messages(user_id, created_at)")
+    # Список диалогов: группировка по user_id только по индексу
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_support_inbox
+        ON support_messages(from_admin, user_id, created_at, username, timestamp)""")
+    # Активные заказы (частичный индекс под условие status != 'completed')
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_orders_open
+        ON orders(created_at) WHERE status != 'completed'""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, created_at)")
+    # История покупок
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, created_at, order_id)")
+
+@migration
+def m004_notification_outbox(conn):
+    # Очередь исходящих уведомлений: переживает рестарт процесса
+    conn.execute("""CREATE TABLE IF NOT EXISTS notification_outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        reply_markup TEXT,
+        coalesce_key TEXT,
+        attempts INTEGER DEFAULT 0,
+        next_at REAL NOT NULL,
+        created_at INTEGER
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox(next_at)")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_outbox_coalesce
+        ON notification_outbox(chat_id, coalesce_key) WHERE coalesce_key IS NOT NULL""")
+
+@migration
+def m005_product_images(conn):
+    # Уменьшенные копии фото товаров (см. "Конвейер изображений")
+    conn.execute("""CREATE TABLE IF NOT EXISTS product_images (
+        image TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        variants TEXT NOT NULL,
+        created_at INTEGER
+    )""")
+
+@migration
+def m006_open_orders_by_id(conn):
+    # Постраничный список активных заказов идёт по id (keyset)
+    conn.execute("DROP INDEX IF EXISTS idx_orders_open")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_open ON orders(id) WHERE status != 'completed'")
+
+@migration
+def m007_support_by_id(conn):
+    # Окна истории диалога выбираются по id сообщения (keyset)
+    conn.execute("DROP INDEX IF EXISTS idx_support_user")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_support_user ON support_messages(user_id, id)")
+
+INBOX_RANK_SQL = "last_from_admin * 4294967296 - last_message_at"
+
+@migration
+def m008_support_threads(conn):
+    # Сводка по диалогам, обновляется при каждом сообщении (save_support_message)
+    conn.execute("""CREATE TABLE IF NOT EXISTS support_threads (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        last_message_at INTEGER NOT NULL,
+        last_timestamp TEXT,
+        last_from_admin INTEGER NOT NULL DEFAULT 0,
+        last_admin TEXT,
+        unread_count INTEGER NOT NULL DEFAULT 0,
+        inbox_rank INTEGER NOT NULL DEFAULT 0
+    )""")
+    # inbox_rank: сначала ждущие ответа, внутри — новые сверху (одно поле,
+    # чтобы страница выбиралась из индекса по курсору (inbox_rank, user_id))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_threads_inbox ON support_threads(inbox_rank, user_id)")
+    conn.execute("""
+        INSERT OR REPLACE INTO support_threads
+            (user_id, username, last_message_at, last_timestamp, last_from_admin, last_admin, unread_count)
+        SELECT m.user_id,
+               (SELECT u.username FROM support_messages u
+                 WHERE u.user_id = m.user_id AND u.from_admin = 0 ORDER BY u.id DESC LIMIT 1),
+               m.created_at, m.timestamp, m.from_admin,
+               (SELECT a.username FROM support_messages a
+                 WHERE a.user_id = m.user_id AND a.from_admin = 1 ORDER BY a.id DESC LIMIT 1),
+               (SELECT COUNT(*) FROM support_messages c
+                 WHERE c.user_id = m.user_id AND c.from_admin = 0 AND c.is_read = 0
+                   AND c.id > COALESCE((SELECT MAX(r.id) FROM support_messages r
+                                        WHERE r.user_id = m.user_id AND r.from_admin = 1), 0))
+        FROM support_messages m
+        WHERE m.id = (SELECT MAX(id) FROM support_messages WHERE user_id = m.user_id)
+    """)
+    conn.execute(f"UPDATE support_threads SET inbox_rank = {INBOX_RANK_SQL}")
+    # Группировка по всей таблице больше не нужна
+    conn.execute("DROP INDEX IF EXISTS idx_support_inbox")
+
+@migration
+def m009_conversation_state(conn):
+    # Состояние диалогов при STATE_BACKEND=sqlite
+    conn.execute("""CREATE TABLE IF NOT EXISTS conversation_state (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_state_expires ON conversation_state(expires_at)")
+
+def insert_order_items(conn, order_id, items, product_ids=None):
+    rows = []
+    for position, item in enumerate(items):
+        product_id = item.get("product_id")
+        if product_id is None and product_ids:
+            product_id = product_ids.get(item.get("name"))
+        rows.append((order_id, position, product_id, item.get("name", ""), item.get("weight", 0), item.get("price", 0)))
+    conn.executemany(
+        "INSERT INTO order_items (order_id, position, product_id, name, weight, price) VALUES (?,?,?,?,?,?)",
+        rows
+    )
+
+def backfill_order_items(conn):
+    product_ids = {name: pid for pid, name in conn.execute("SELECT id, name FROM products")}
+    rows = conn.execute("SELECT id, products_json FROM orders").fetchall()
+    for order_id, products_json in rows:
+        try:
+            items = json.loads(products_json or "[]")
+        except ValueError:
+            continue
+        insert_order_items(conn, order_id, items, product_ids)
+
+@migration
+def m010_order_items(conn):
+    # Строки заказа отдельной таблицей вместо разбора products_json
+    conn.execute("""CREATE TABLE IF NOT EXISTS order_items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        product_id INTEGER,
+        name TEXT,
+        weight REAL,
+        price INTEGER
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items(order_id, position)")
+    backfill_order_items(conn)
+    # История покупок листается по id (keyset)
+    conn.execute("DROP INDEX IF EXISTS idx_purchases_user")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id, id, order_id)")
+
+@migration
+def m011_cross_process(conn):
+    # События инвалидации кэшей для других процессов (см. watch_cache_events)
+    conn.execute("""CREATE TABLE IF NOT EXISTS cache_events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        key INTEGER NOT NULL DEFAULT 0,
+        origin INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    )""")
+    # Входящие апдейты в многопроцессном режиме: принимает любой воркер,
+    # обрабатывает воркер 0. update_id — ключ, повторы отсекаются вставкой
+    conn.execute("""CREATE TABLE IF NOT EXISTS webhook_inbox (
+        update_id INTEGER PRIMARY KEY,
+        body TEXT NOT NULL,
+        received_at REAL NOT NULL
+    )""")
+
+# Текст для поиска: FTS5 (unicode61) сам приводит кириллицу к нижнему
+# регистру, но «ё» и «е» для него разные буквы — сводим их заранее.
+# Только встроенные функции SQL, чтобы триггеры работали из любого клиента
+SEARCH_FOLD_SQL = "replace(replace(coalesce({0}, ''), 'ё', 'е'), 'Ё', 'Е')"
+
+@migration
+def m012_products_search(conn):
+    # Полнотекстовый индекс по названию и описанию; rowid = products.id.
+    # prefix='2 3' — быстрый поиск по началу слова при вводе
+    conn.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+        name, description,
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )""")
+    name, desc = SEARCH_FOLD_SQL.format("new.name"), SEARCH_FOLD_SQL.format("new.description")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts (rowid, name, description) VALUES (new.id, {name}, {desc});
+    END""")
+    conn.execute(f"""CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, description ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = old.id;
+        INSERT INTO products_fts (rowid, name, description) VALUES (new.id, {name}, {desc});
+    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        DELETE FROM products_fts WHERE rowid = old.id;
+    END""")
+    conn.execute("DELETE FROM products_fts")
+    conn.execute(f"""INSERT INTO products_fts (rowid, name, description)
+        SELECT id, {SEARCH_FOLD_SQL.format("name")}, {SEARCH_FOLD_SQL.format("description")} FROM products""")
+
+@migration
+def m013_media_files(conn):
+    # Фото из Telegram: file_unique_id -> файл в web/images (см. "Медиа-хранилище")
+    conn.execute("""CREATE TABLE IF NOT EXISTS media_files (
+        file_unique_id TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        image TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        content_hash TEXT,
+        size INTEGER,
+        created_at INTEGER
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_hash ON media_files(content_hash) WHERE status = 'ready'")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_media_pending ON media_files(status) WHERE status = 'pending'")
+
+@migration
+def m014_cache_event_payload(conn):
+    # Данные push-событий для WebApp (см. "Push-события"), JSON
+    conn.execute("ALTER TABLE cache_events ADD COLUMN payload TEXT")
+
+@migration
+def m015_retention(conn):
+    # Выборки для переноса в архив (см. "Архив и хранение")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_orders_completed
+        ON orders(created_at) WHERE status = 'completed'""")
+    conn.execute("ALTER TABLE support_threads ADD COLUMN archived INTEGER NOT NULL DEFAULT 0")
+    conn.execute("""CREATE INDEX IF NOT EXISTS idx_threads_closed
+        ON support_threads(last_message_at) WHERE last_from_admin = 1 AND archived = 0""")
+
+# Таблицы, строки которых со временем переезжают в архивную БД. Схема
+# архива повторяет основную (столбцы добавляются вслед за миграциями),
+# индексы — только под чтение истории
+ARCHIVE_TABLES = ("orders", "order_items", "purchases", "support_messages")
+ARCHIVE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS archive.idx_order_items_order ON order_items(order_id, position)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_purchases_user ON purchases(user_id, id, order_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_purchases_order ON purchases(order_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_support_user ON support_messages(user_id, id)",
+)
+
+def table_columns(conn, schema, table):
+    return [r[1] for r in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+def ensure_archive_schema(conn):
+    for table in ARCHIVE_TABLES:
+        have = table_columns(conn, "archive", table)
+        if not have:
+            sql = conn.execute("SELECT sql FROM main.sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+            conn.execute(re.sub(r"^CREATE TABLE\s+(IF NOT EXISTS\s+)?\"?\w+\"?", f"CREATE TABLE archive.{table}", sql))
+            continue
+        for _, name, col_type, _, default, _ in conn.execute(f"PRAGMA main.table_info({table})").fetchall():
+            if name not in have:
+                extra = f" DEFAULT {default}" if default is not None else ""
+                conn.execute(f"ALTER TABLE archive.{table} ADD COLUMN {name} {col_type}{extra}")
+    # Повторы покупок, перенесённые до уникального индекса (см. m017)
+    if not conn.execute("SELECT 1 FROM archive.sqlite_master WHERE name = 'idx_purchases_order'").fetchone():
+        conn.execute("DELETE FROM archive.purchases WHERE id NOT IN (SELECT MIN(id) FROM archive.purchases GROUP BY order_id)")
+    for sql in ARCHIVE_INDEXES:
+        conn.execute(sql)
+    conn.commit()
+
+def enable_incremental_vacuum(conn):
+    # Переключение режима требует одного полного VACUUM; дальше свободные
+    # страницы возвращаются порциями (см. vacuum_step)
+    if conn.execute("PRAGMA main.auto_vacuum").fetchone()[0] == 2:
+        return
+    print("  🧹 Включаем incremental auto_vacuum (однократный VACUUM)...")
+    conn.commit()
+    conn.execute("PRAGMA main.auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM main")
+
+@migration
+def m016_sales_stats(conn):
+    # Сводки продаж (см. "Статистика продаж"), пополняются при выполнении заказа
+    conn.execute("""CREATE TABLE IF NOT EXISTS sales_daily (
+        day TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        weight REAL NOT NULL DEFAULT 0
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS sales_products (
+        product_id INTEGER PRIMARY KEY,
+        name TEXT,
+        category TEXT,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        weight REAL NOT NULL DEFAULT 0
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS sales_categories (
+        category TEXT PRIMARY KEY,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue INTEGER NOT NULL DEFAULT 0,
+        weight REAL NOT NULL DEFAULT 0
+    )""")
+    rebuild_sales(conn)
+
+@migration
+def m017_unique_purchases(conn):
+    # Одна покупка на заказ: повторное выполнение заказа (completed →
+    # in_progress → completed) добавляло вторую строку в историю
+    conn.execute("DELETE FROM purchases WHERE id NOT IN (SELECT MIN(id) FROM purchases GROUP BY order_id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_order ON purchases(order_id)")
+
+@migration
+def m018_recount_sales(conn):
+    # Повторно выполненные заказы учитывались в сводках дважды
+    rebuild_sales(conn)
+
+@migration
+def m019_app_meta(conn):
+    # Служебные значения процесса (отпечаток регистрации webhook и т.п.)
+    conn.execute("""CREATE TABLE IF NOT EXISTS app_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""")
+
+@db_task
+def get_app_meta(key):
+    row = get_conn().execute("SELECT value FROM app_meta WHERE key=?", (key,)).fetchone()
+    return row[0] if row else None
+
+@db_task
+def set_app_meta(key, value):
+    conn = get_conn()
+    conn.execute("INSERT OR REPLACE INTO app_meta (key, value) VALUES (?,?)", (key, value))
     conn.commit()
-    conn.close()
+
+@migration
+def m020_pending_imports(conn):
+    # Разобранный файл импорта до подтверждения: в состоянии диалога
+    # хранится только id (см. "Импорт и экспорт каталога")
+    conn.execute("""CREATE TABLE IF NOT EXISTS pending_imports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_id INTEGER NOT NULL,
+        rows TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    )""")
+
+def migrate_db(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, func in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        print(f"  ⏫ Миграция {number}: {func.__name__}")
+        conn.execute("BEGIN")
+        try:
+            func(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return version
+
+def init_db():
+    print("\n🗄️  Инициализация базы данных...")
+    conn = get_conn()
+    old_version = migrate_db(conn)
+    ensure_archive_schema(conn)
+    enable_incremental_vacuum(conn)
+    conn.execute("PRAGMA optimize")
+    if old_version != len(MIGRATIONS):
+        print(f"✅ Схема обновлена: v{old_version} → v{len(MIGRATIONS)}")
     print("✅ Все таблицы созданы/проверены")
 
 def seed_database_from_json():
@@ -133,243 +774,2153 @@ def seed_database_from_json():
             
             print(f"📄 Найдено товаров в data.json: {len(products)}")
             
-            for i, p in enumerate(products):
-                cur.execute(
+            # Одна транзакция на весь каталог
+            with conn:
+                conn.executemany(
                     "INSERT INTO products (name, category, price, description, image) VALUES (?,?,?,?,?)",
-                    (p.get("name", ""), p.get("category", ""), p.get("price", 0), 
-                     p.get("description", ""), p.get("image", "").replace("images/", ""))
+                    [(p.get("name", ""), p.get("category", ""), p.get("price", 0),
+                      p.get("description", ""), p.get("image", "").replace("images/", "")) for p in products]
                 )
-                if i < 3:
-                    print(f"  - {p.get('name')} ({p.get('category')}, {p.get('price')} ₽)")
+            for p in products[:3]:
+                print(f"  - {p.get('name')} ({p.get('category')}, {p.get('price')} ₽)")
             
-            conn.commit()
             print(f"✅ Загружено {len(products)} товаров в базу данных!")
         else:
             print(f"⚠️ ФАЙЛ НЕ НАЙДЕН: {DATA_JSON}")
     else:
         print(f"✅ В базе уже есть {count} товаров")
     
-    conn.close()
 
-print("\n" + "=" * 60)
-print("ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ")
-print("=" * 60)
+@db_task
+def reset_db():
+    """Пересоздание всех таблиц (файл БД не удаляем: его держат открытые соединения пула)"""
+    conn = get_conn()
+    # Виртуальные таблицы (FTS) первыми: вместе с ними уходят их служебные таблицы
+    tables = [r[0] for r in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' "
+        "ORDER BY sql NOT LIKE 'CREATE VIRTUAL%'"
+    )]
+    for table in tables:
+        conn.execute(f"DROP TABLE IF EXISTS {table}")
+    for table in ARCHIVE_TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS archive.{table}")
+    conn.execute("PRAGMA user_version = 0")
+    conn.commit()
+    init_db()
+    seed_database_from_json()
+    publish_cache_event(conn, "catalog")
+    conn.commit()
+    bump_catalog_version()
 
-init_db()
-seed_database_from_json()
+def prepare_database():
+    """Миграции и первичное наполнение. Вызывается при старте после того,
+    как порт уже слушается; повторный вызов ничего не меняет"""
+    print("\n" + "=" * 60)
+    print("ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ")
+    print("=" * 60)
+    init_db()
+    seed_database_from_json()
 
 # --------------------------------
 # Вспомогательные функции для товаров
 # --------------------------------
+@db_task
 def get_all_products():
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT id, name, category, price, description, image FROM products ORDER BY id")
     rows = cur.fetchall()
-    conn.close()
     return rows
 
+@db_task
 def get_product(pid):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT id, name, category, price, description, image FROM products WHERE id=?", (pid,))
     row = cur.fetchone()
-    conn.close()
     return row
 
+@db_task
 def update_product_field(pid, field, value):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute(f"UPDATE products SET {field}=? WHERE id=?", (value, pid))
+    publish_cache_event(conn, "catalog")
     conn.commit()
-    conn.close()
+    bump_catalog_version()
 
+@db_task
+def add_product(name, category, price, description, image):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(
+        "INSERT INTO products (name, category, price, description, image) VALUES (?,?,?,?,?)",
+        (name, category, price, description, image)
+    )
+    pid = cur.lastrowid
+    publish_cache_event(conn, "catalog")
+    conn.commit()
+    bump_catalog_version()
+    return pid
+
+@db_task
 def delete_product(pid):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("DELETE FROM products WHERE id=?", (pid,))
+    publish_cache_event(conn, "catalog")
     conn.commit()
-    conn.close()
+    bump_catalog_version()
+
+def select_with_archive(conn, sql, params=()):
+    """Один запрос к основной и архивной БД ({db} в тексте) без повторов.
+    Строка может оказаться в обеих, если перенос прервался между
+    фиксацией архива и основной БД — одинаковые строки схлопываются."""
+    rows = set(conn.execute(sql.format(db="main"), params).fetchall())
+    rows.update(conn.execute(sql.format(db="archive"), params).fetchall())
+    return list(rows)
+
+def keyset_page(rows, limit, backward):
+    """Обрезает выборку limit+1 строк до страницы и сообщает, есть ли ещё"""
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, has_more
 
-def refresh_web_data():
-    rows = get_all_products()
+@db_task
+def get_products_page(after_id=None, before_id=None, limit=ADMIN_PAGE_SIZE):
+    """Страница товаров по id: после after_id или перед before_id"""
+    conn = get_conn()
+    if before_id is not None:
+        rows = conn.execute(
+            "SELECT id, name FROM products WHERE id < ? ORDER BY id DESC LIMIT ?", (before_id, limit + 1)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT id, name FROM products WHERE id > ? ORDER BY id LIMIT ?", (after_id or 0, limit + 1)
+        ).fetchall()
+    return keyset_page(rows, limit, before_id is not None)
+
+@db_task
+def search_products(query, limit=ADMIN_PAGE_SIZE):
+    conn = get_conn()
+    pattern = "%" + query.casefold().replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+    return conn.execute(
+        "SELECT id, name FROM products WHERE casefold(name) LIKE ? ESCAPE '\\' ORDER BY id LIMIT ?",
+        (pattern, limit)
+    ).fetchall()
+
+# --------------------------------
+# Кэш каталога
+# --------------------------------
+# Ответ /api/products хранится в памяти уже сериализованным (и сжатым).
+# Любое изменение товаров увеличивает version; снимок пересобирается
+# лениво при первом обращении после изменения. Снимок не меняется после
+# сборки: новый собирается целиком в пуле БД и подменяется одной ссылкой
+# в event loop, поэтому обработчик, взявший снимок, видит согласованные
+# body, etag, цены и списки даже через await.
+catalog_cache = {
+    "version": 1,
+    "snapshot": {
+        "built_version": 0,
+        "items": [],
+        "body": b"[]",
+        "gzip_body": b"",
+        "etag": "",
+        "prices": {},
+        "price_names": {},
+        "categories": {},
+        "views": {},
+    },
+}
+# version увеличивают и потоки пула БД (изменения товаров)
+catalog_version_lock = threading.Lock()
+
+def bump_catalog_version():
+    with catalog_version_lock:
+        catalog_cache["version"] += 1
+    push_hub.publish("catalog", "catalog", {})
+
+catalog_lock = asyncio.Lock()
+
+def build_catalog_items():
+    rows = get_conn().execute("""
+        SELECT p.id, p.name, p.category, p.price, p.description, p.image, i.variants
+        FROM products p
+        LEFT JOIN product_images i ON i.image = p.image
+        ORDER BY p.id
+    """).fetchall()
     out = []
-    for r in rows:
-        pid, name, cat, price, desc, img = r
+    for pid, name, cat, price, desc, img, variants in rows:
         out.append({
             "id": pid,
             "name": name or "",
             "category": cat or "",
             "price": price or 0,
             "description": desc or "",
-            "image": f"images/{img}" if img else ""
+            "image": f"images/{img}" if img else "",
+            "images": json.loads(variants) if variants else {}
         })
-    with open(DATA_JSON, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    return out
+
+def write_data_json(items):
+    """Атомарная запись data.json: пишем во временный файл и подменяем"""
+    tmp = f"{DATA_JSON}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(items, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, DATA_JSON)
+
+def rebuild_catalog_snapshot(version):
+    """Выполняется в пуле БД: выборка, сериализация, сжатие и запись data.json.
+    Возвращает новый снимок, общий кэш не трогает"""
+    items = build_catalog_items()
+    body = json.dumps(items, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    snapshot = {
+        "built_version": version,
+        "items": items,
+        # Таблица цен для расчёта корзины — из того же снимка, той же версии
+        "prices": {p["id"]: (p["name"], p["category"], p["price"]) for p in items},
+        "price_names": {p["name"]: p["id"] for p in items},
+        # Счётчики категорий и готовые упорядоченные списки для постраничной выдачи
+        "categories": count_categories(items),
+        "views": build_catalog_views(items),
+        "body": body,
+        "gzip_body": gzip.compress(body, compresslevel=6),
+        "etag": f'"{hashlib.sha1(body).hexdigest()[:20]}"',
+    }
+    write_data_json(items)
+    return snapshot
+
+async def get_catalog_snapshot():
+    """Актуальный снимок каталога; пересобирается только при смене версии"""
+    if catalog_cache["snapshot"]["built_version"] != catalog_cache["version"]:
+        async with catalog_lock:
+            version = catalog_cache["version"]
+            if catalog_cache["snapshot"]["built_version"] != version:
+                catalog_cache["snapshot"] = await run_db(rebuild_catalog_snapshot, version)
+    return catalog_cache["snapshot"]
+
+async def refresh_web_data():
+    await get_catalog_snapshot()
 
 # --------------------------------
-# Функции для поддержки
+# Выборка каталога: категории, сортировка, поиск
 # --------------------------------
-def save_support_message(user_id, username, message, from_admin=0):
+# Страницы /api/products собираются из списков, подготовленных вместе со
+# снимком: для каждой сортировки и категории порядок и позиции товаров
+# уже известны, курсор (id последнего товара) находится словарём.
+# В БД ходит только текстовый поиск — через индекс products_fts.
+CATALOG_SORTS = {
+    "default": lambda p: p["id"],
+    "name": lambda p: (p["name"].casefold(), p["id"]),
+    # Цена сравнивается за кг: у чая в каталоге цена за 100 г
+    "price_asc": lambda p: (price_rule(p["category"])["calculate"](p["price"], 1), p["id"]),
+    "price_desc": lambda p: (-price_rule(p["category"])["calculate"](p["price"], 1), p["id"]),
+}
+CATALOG_PAGE_SIZE = 20
+CATALOG_PAGE_MAX = 100
+SEARCH_MAX_TERMS = 8
+SEARCH_MAX_RESULTS = 500
+
+def count_categories(items):
+    counts = {}
+    for p in items:
+        counts[p["category"]] = counts.get(p["category"], 0) + 1
+    return counts
+
+def catalog_view(items):
+    return {"items": items, "positions": {p["id"]: i for i, p in enumerate(items)}}
+
+def build_catalog_views(items):
+    """{(сортировка, категория): список}; категория "" — все товары"""
+    views = {}
+    for sort, key in CATALOG_SORTS.items():
+        ordered = sorted(items, key=key)
+        views[(sort, "")] = catalog_view(ordered)
+        for category in count_categories(items):
+            views[(sort, category)] = catalog_view([p for p in ordered if p["category"] == category])
+    return views
+
+def search_fold(text):
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+def build_search_query(text):
+    """Запрос пользователя -> выражение FTS5: все слова, каждое по префиксу"""
+    terms = re.findall(r"\w+", search_fold(text).lower())[:SEARCH_MAX_TERMS]
+    return " ".join(f'"{term}"*' for term in terms)
+
+@db_task
+def search_product_ids(text):
+    """id товаров по релевантности (совпадение в названии весит больше)"""
+    query = build_search_query(text)
+    if not query:
+        return []
+    rows = get_conn().execute(
+        "SELECT rowid FROM products_fts WHERE products_fts MATCH ? "
+        "ORDER BY bm25(products_fts, 10.0, 1.0), rowid LIMIT ?",
+        (query, SEARCH_MAX_RESULTS)
+    ).fetchall()
+    return [r[0] for r in rows]
+
+# --------------------------------
+# Расчёт цен корзины
+# --------------------------------
+# Повторяет правила getPriceLogic/selectWeight из web/app.js: цена в
+# каталоге хранится за кг (у чая — за 100 г), у каждой категории свои
+# пределы веса, скидка даётся только на готовые варианты веса.
+# Формулы записаны в том же порядке операций, что и в JS, чтобы
+# округление совпадало до рубля. Цены берутся из снимка каталога,
+# поэтому проверка корзины не делает запросов к БД.
+PRICE_RULES = {
+    "Варенье": {
+        "calculate": lambda price, weight: (price / 10) * weight * 10,
+        "min_weight": 0.2,
+        "max_weight": 50,
+        "presets": {1.4: 0, 2.1: 5, 2.8: 10},
+    },
+    "Мёд": {
+        "calculate": lambda price, weight: price * weight,
+        "min_weight": 0.2,
+        "max_weight": 50,
+        "presets": {1.4: 0, 2.1: 5, 2.8: 10},
+    },
+    "Чай": {
+        "calculate": lambda price, weight: price * weight * 10,
+        "min_weight": 0.025,
+        "max_weight": 1,
+        "presets": {},
+    },
+}
+CART_MAX_LINES = 200
+
+def js_round(value):
+    """Math.round из JS (половина округляется вверх)"""
+    return math.floor(value + 0.5)
+
+def price_rule(category):
+    return PRICE_RULES.get(category, PRICE_RULES["Варенье"])
+
+def price_portion(rule, price, weight, discount):
+    """Цена одной порции; None, если вес или скидка недопустимы"""
+    if not rule["min_weight"] <= weight <= rule["max_weight"]:
+        return None
+    if discount and rule["presets"].get(weight) != discount:
+        return None
+    base = rule["calculate"](price, weight)
+    return js_round(base - base * (discount / 100))
+
+def quote_cart(cart, snapshot):
+    """Пересчёт корзины по серверным ценам: (строки, итог, ошибки).
+    Строка корзины — {product_id, weight, portions: [{weight, discount}]};
+    без portions вся строка считается одной порцией без скидки."""
+    prices = snapshot["prices"]
+    lines, errors, total = [], [], 0
+    if len(cart) > CART_MAX_LINES:
+        return [], 0, [{"line": None, "error": "Слишком много позиций"}]
+    for index, item in enumerate(cart):
+        try:
+            product_id = item.get("product_id")
+            if product_id is None:
+                product_id = snapshot["price_names"].get(item.get("name"))
+            product = prices.get(int(product_id)) if product_id is not None else None
+            if product is None:
+                errors.append({"line": index, "error": "Товар не найден"})
+                continue
+            name, category, price = product
+            rule = price_rule(category)
+            portions = item.get("portions") or [{"weight": item.get("weight"), "discount": 0}]
+            line_price, line_weight = 0, 0
+            for portion in portions:
+                weight = float(portion["weight"])
+                discount = int(portion.get("discount") or 0)
+                portion_price = price_portion(rule, price, weight, discount)
+                if portion_price is None:
+                    raise ValueError
+                line_price += portion_price
+                line_weight += weight
+        except (TypeError, ValueError, KeyError, AttributeError):
+            errors.append({"line": index, "error": "Недопустимый вес или скидка"})
+            continue
+        lines.append({
+            "product_id": int(product_id),
+            "name": name,
+            "weight": round(line_weight, 3),
+            "price": line_price
+        })
+        total += line_price
+    return lines, total, errors
+
+# --------------------------------
+# Конвейер изображений
+# --------------------------------
+# Для каждого фото товара строятся копии, ограниченные по ширине
+# (thumb — для сетки каталога, medium — для карточки товара), в WebP и
+# JPEG. Имена файлов содержат хэш содержимого оригинала, поэтому их
+# можно кэшировать навсегда, а повторная обработка того же фото ничего
+# не пересчитывает.
+IMAGE_VARIANTS = {"thumb": 360, "medium": 900}
+IMAGE_FORMATS = {
+    "webp": ("webp", {"quality": 80, "method": 6}),
+    "jpeg": ("jpg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+media_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="media")
+
+def render_image_variants(filename):
+    """CPU-часть конвейера (выполняется в media_executor)"""
+    with open(os.path.join(IMAGES_DIR, filename), "rb") as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    variants = {}
+    with Image.open(io.BytesIO(data)) as src:
+        im = ImageOps.exif_transpose(src).convert("RGB")
+    for name, width in IMAGE_VARIANTS.items():
+        copy = im.copy()
+        copy.thumbnail((width, width * 10), Image.LANCZOS)
+        entry = {"width": copy.width, "height": copy.height}
+        for fmt, (ext, options) in IMAGE_FORMATS.items():
+            out_name = f"{digest}_{width}.{ext}"
+            out_path = os.path.join(DERIVED_DIR, out_name)
+            if not os.path.exists(out_path):
+                tmp = f"{out_path}.tmp"
+                copy.save(tmp, fmt.upper(), **options)
+                os.replace(tmp, out_path)
+            entry[fmt] = f"/images/derived/{out_name}"
+        variants[name] = entry
+    return digest, variants
+
+@db_task
+def save_image_variants(filename, digest, variants):
     conn = get_conn()
-    cur = conn.cursor()
-    timestamp = datetime.now().strftime("%d.%m.%y %H:%M")
-    cur.execute(
-        "INSERT INTO support_messages (user_id, username, message, timestamp, from_admin) VALUES (?,?,?,?,?)",
-        (user_id, username, message, timestamp, from_admin)
+    conn.execute(
+        "INSERT OR REPLACE INTO product_images (image, content_hash, variants, created_at) VALUES (?,?,?,?)",
+        (filename, digest, json.dumps(variants), int(time.time()))
     )
+    publish_cache_event(conn, "catalog")
     conn.commit()
-    conn.close()
+    bump_catalog_version()
 
-def get_support_users():
-    """Получить список пользователей с непрочитанными сообщениями"""
+@db_task
+def get_images_without_variants():
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT DISTINCT user_id, username, MAX(timestamp) as last_time
-        FROM support_messages
-        WHERE from_admin = 0
-        GROUP BY user_id
-        ORDER BY last_time DESC
-    """)
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    rows = conn.execute("""
+        SELECT DISTINCT p.image FROM products p
+        LEFT JOIN product_images i ON i.image = p.image
+        WHERE p.image != '' AND i.image IS NULL
+    """).fetchall()
+    return [r[0] for r in rows]
 
-def get_user_support_messages(user_id):
-    """Получить все сообщения пользователя"""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT message, timestamp, from_admin FROM support_messages WHERE user_id=? ORDER BY timestamp",
-        (user_id,)
-    )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+async def ingest_image(filename):
+    loop = asyncio.get_running_loop()
+    digest, variants = await loop.run_in_executor(media_executor, render_image_variants, filename)
+    await save_image_variants(filename, digest, variants)
+    return variants
+
+ingest_lock = asyncio.Lock()
+
+async def ingest_existing_images():
+    """Фоновая обработка фото, для которых ещё нет копий"""
+    # Старт и импорт каталога могут запустить обработку одновременно
+    async with ingest_lock:
+        await ingest_pending_images()
+
+async def ingest_pending_images():
+    done = 0
+    for filename in await get_images_without_variants():
+        if not os.path.isfile(os.path.join(IMAGES_DIR, filename)):
+            continue
+        try:
+            await ingest_image(filename)
+            done += 1
+        except Exception as e:
+            print(f"⚠️ Не удалось обработать фото {filename}: {e}")
+    if done:
+        print(f"🖼 Обработано фото: {done}")
 
 # --------------------------------
-# Функции для заказов
+# Медиа-хранилище
 # --------------------------------
-def create_order(user_id, username, cart_data, total_price):
+# Фото от админа сохраняется под именем из file_unique_id (он одинаков
+# для одного и того же файла в Telegram), товар получает это имя сразу,
+# а скачивание и обработка идут в фоне. Повторно присланное фото не
+# скачивается: file_unique_id уже есть в media_files. Если скачанное
+# содержимое совпадает по хэшу с уже сохранённым файлом, товары
+# переключаются на него, а копия удаляется. Незавершённые загрузки
+# (status='pending') продолжаются после перезапуска.
+# Раз в MEDIA_GC_INTERVAL секунд сборщик удаляет из web/images файлы,
+# на которые не ссылается ни один товар, и копии в derived/ без
+# исходника. Файлы моложе MEDIA_GC_GRACE секунд не трогаем.
+MEDIA_GC_INTERVAL = float(os.getenv("MEDIA_GC_INTERVAL", 6 * 3600))
+MEDIA_GC_GRACE = float(os.getenv("MEDIA_GC_GRACE", 3600))
+MEDIA_KEEP_FILES = {"placeholder.jpg"}
+
+media_tasks = {}
+media_stats = {"downloaded": 0, "reused": 0, "deduplicated": 0, "failed": 0, "gc_files": 0, "gc_bytes": 0}
+
+@db_task
+def claim_media(file_unique_id, file_id):
+    """Имя файла для фото и нужно ли его скачивать"""
     conn = get_conn()
-    cur = conn.cursor()
-    timestamp = datetime.now().strftime("%d.%m.%y %H:%M")
-    products_json = json.dumps(cart_data, ensure_ascii=False)
-    
-    cur.execute(
-        "INSERT INTO orders (user_id, username, products_json, total_price, timestamp, status) VALUES (?,?,?,?,?,?)",
-        (user_id, username, products_json, total_price, timestamp, "pending")
+    row = conn.execute(
+        "SELECT image, status FROM media_files WHERE file_unique_id=?", (file_unique_id,)
+    ).fetchone()
+    if row and row[1] == "ready" and os.path.isfile(os.path.join(IMAGES_DIR, row[0])):
+        return row[0], False
+    image = row[0] if row else f"{file_unique_id}.jpg"
+    conn.execute(
+        """INSERT INTO media_files (file_unique_id, file_id, image, status, created_at) VALUES (?,?,?,'pending',?)
+           ON CONFLICT(file_unique_id) DO UPDATE SET file_id=excluded.file_id, status='pending'""",
+        (file_unique_id, file_id, image, int(time.time()))
     )
-    order_id = cur.lastrowid
     conn.commit()
-    conn.close()
-    return order_id
+    return image, True
 
-def get_pending_orders():
-    """Получить все заказы со статусом pending или in_progress"""
+@db_task
+def finish_media(file_unique_id, digest, size):
+    """Отмечает загрузку. Возвращает (имя файла для товаров, лишний файл или None)"""
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, user_id, username, products_json, total_price, timestamp, status FROM orders WHERE status != 'completed' ORDER BY timestamp DESC"
+    image = conn.execute("SELECT image FROM media_files WHERE file_unique_id=?", (file_unique_id,)).fetchone()[0]
+    same = conn.execute(
+        "SELECT image FROM media_files WHERE content_hash=? AND status='ready' AND image != ? LIMIT 1",
+        (digest, image)
+    ).fetchone()
+    if same and os.path.isfile(os.path.join(IMAGES_DIR, same[0])):
+        conn.execute("UPDATE products SET image=? WHERE image=?", (same[0], image))
+        conn.execute(
+            "UPDATE media_files SET image=?, content_hash=?, size=?, status='ready' WHERE file_unique_id=?",
+            (same[0], digest, size, file_unique_id)
+        )
+        publish_cache_event(conn, "catalog")
+        conn.commit()
+        bump_catalog_version()
+        return same[0], image
+    conn.execute(
+        "UPDATE media_files SET content_hash=?, size=?, status='ready' WHERE file_unique_id=?",
+        (digest, size, file_unique_id)
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    conn.commit()
+    return image, None
 
-def get_order(order_id):
+@db_task
+def fail_media(file_unique_id):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, user_id, username, products_json, total_price, timestamp, status FROM orders WHERE id=?",
-        (order_id,)
-    )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    conn.execute("UPDATE media_files SET status='failed' WHERE file_unique_id=?", (file_unique_id,))
+    conn.commit()
+
+@db_task
+def get_pending_media():
+    return get_conn().execute(
+        "SELECT file_unique_id, file_id, image FROM media_files WHERE status='pending'"
+    ).fetchall()
+
+def hash_image_file(path):
+    """Хэш содержимого в том же виде, что и у копий (render_image_variants)"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return hashlib.sha256(data).hexdigest()[:16], len(data)
 
-def update_order_status(order_id, status):
+async def ingest_uploaded_photo(filename):
+    # Без копий товар всё равно сохраняем: WebApp покажет оригинал.
+    # Под ingest_lock — как и фоновая обработка: одно фото не
+    # обрабатывается дважды одновременно, сборщик не удаляет копии
+    try:
+        async with ingest_lock:
+            await ingest_image(filename)
+    except Exception as e:
+        print(f"⚠️ Не удалось обработать фото {filename}: {e}")
+
+async def download_media(file_unique_id, file_id, image, chat_id=None):
+    dest = os.path.join(IMAGES_DIR, image)
+    tmp = f"{dest}.{os.getpid()}.part"
+    try:
+        file = await bot.get_file(file_id)
+        await bot.download_file(file.file_path, tmp)
+        os.replace(tmp, dest)
+        loop = asyncio.get_running_loop()
+        digest, size = await loop.run_in_executor(media_executor, hash_image_file, dest)
+        image, duplicate = await finish_media(file_unique_id, digest, size)
+        media_stats["downloaded"] += 1
+        if duplicate:
+            os.remove(dest)
+            media_stats["deduplicated"] += 1
+        else:
+            await ingest_uploaded_photo(image)
+    except Exception as e:
+        media_stats["failed"] += 1
+        print(f"⚠️ Не удалось загрузить фото {image}: {e}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        await fail_media(file_unique_id)
+        if chat_id:
+            try:
+                await bot.send_message(chat_id, f"⚠️ Не удалось загрузить фото {image} — пришлите его ещё раз")
+            except Exception:
+                pass
+
+def start_media_download(file_unique_id, file_id, image, chat_id=None):
+    if file_unique_id in media_tasks:
+        return
+    task = asyncio.create_task(download_media(file_unique_id, file_id, image, chat_id))
+    media_tasks[file_unique_id] = task
+    task.add_done_callback(lambda _: media_tasks.pop(file_unique_id, None))
+
+async def receive_photo(msg: types.Message):
+    """Имя файла для товара; скачивание (если нужно) уже запущено в фоне"""
+    photo = msg.photo[-1]
+    image, need_download = await claim_media(photo.file_unique_id, photo.file_id)
+    if need_download:
+        start_media_download(photo.file_unique_id, photo.file_id, image, msg.chat.id)
+    else:
+        media_stats["reused"] += 1
+    return image
+
+async def resume_media_downloads():
+    for file_unique_id, file_id, image in await get_pending_media():
+        start_media_download(file_unique_id, file_id, image)
+
+@db_task
+def get_referenced_media():
+    """Чистит записи без товаров и возвращает (имена фото в работе, хэши копий)"""
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE orders SET status=? WHERE id=?", (status, order_id))
+    referenced = {r[0] for r in conn.execute("SELECT DISTINCT image FROM products WHERE image != ''")}
+    referenced |= {r[0] for r in conn.execute("SELECT image FROM media_files WHERE status='pending'")}
+    referenced |= MEDIA_KEEP_FILES
+    conn.execute("DELETE FROM media_files WHERE status != 'pending' AND image NOT IN (SELECT image FROM products)")
+    conn.execute("DELETE FROM product_images WHERE image NOT IN (SELECT image FROM products)")
     conn.commit()
-    
-    # Если заказ выполнен - добавляем в историю покупок
-    if status == "completed":
-        cur.execute("SELECT user_id FROM orders WHERE id=?", (order_id,))
-        user_id = cur.fetchone()[0]
-        timestamp = datetime.now().strftime("%d.%m.%y %H:%M")
-        cur.execute("INSERT INTO purchases (user_id, order_id, timestamp) VALUES (?,?,?)",
-                   (user_id, order_id, timestamp))
-        conn.commit()
-    
-    conn.close()
+    hashes = {r[0] for r in conn.execute("SELECT content_hash FROM product_images")}
+    return referenced, hashes
 
-def get_user_purchases(user_id):
-    """Получить историю покупок пользователя"""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT o.products_json, o.total_price, p.timestamp
-        FROM purchases p
-        JOIN orders o ON p.order_id = o.id
-        WHERE p.user_id = ?
-        ORDER BY p.timestamp DESC
-    """, (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+def sweep_unused_images(referenced, hashes, grace):
+    """Выполняется в media_executor: обход каталогов и удаление файлов
+    не занимает поток пула БД. Возвращает (файлов, байт)"""
+    cutoff = time.time() - grace
+    removed = reclaimed = 0
+    for directory, keep in ((IMAGES_DIR, lambda name: name in referenced),
+                            (DERIVED_DIR, lambda name: name.split("_", 1)[0] in hashes)):
+        for entry in os.scandir(directory):
+            if not entry.is_file() or keep(entry.name):
+                continue
+            stat = entry.stat()
+            if stat.st_mtime > cutoff:
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+            reclaimed += stat.st_size
+    return removed, reclaimed
 
-# --------------------------------
-# Состояние админки
-# --------------------------------
-admin_state = {}
+async def collect_unused_images(grace=MEDIA_GC_GRACE):
+    """Удаляет фото без ссылок из товаров и их копии. Возвращает (файлов, байт)"""
+    referenced, hashes = await get_referenced_media()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(media_executor, sweep_unused_images, referenced, hashes, grace)
 
-def set_admin_state(uid, key, val):
-    if uid not in admin_state:
-        admin_state[uid] = {}
-    admin_state[uid][key] = val
+async def run_media_gc():
+    async with ingest_lock:
+        removed, reclaimed = await collect_unused_images()
+    media_stats["gc_files"] += removed
+    media_stats["gc_bytes"] += reclaimed
+    if removed:
+        print(f"🧹 Удалено неиспользуемых фото: {removed}, освобождено {reclaimed / 1024 / 1024:.1f} МБ")
+    return removed, reclaimed
 
-def get_admin(uid):
-    return admin_state.get(uid, {})
+async def media_gc_loop():
+    while True:
+        await asyncio.sleep(MEDIA_GC_INTERVAL)
+        try:
+            await run_media_gc()
+        except Exception as e:
+            print(f"⚠️ Ошибка очистки фото: {e}")
 
-def clear_admin(uid):
-    admin_state.pop(uid, None)
 # --------------------------------
-# Клавиатуры
+# Импорт и экспорт каталога
 # --------------------------------
-def build_main_kb():
-    """Главная клавиатура для пользователя"""
-    kb = types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="🛍 Открыть магазин", web_app=types.WebAppInfo(url=f"{RENDER_EXTERNAL_URL}/shop"))],
-            [types.KeyboardButton(text="💬 Поддержка")]
-        ],
-        resize_keyboard=True
-    )
-    return kb
-
-def build_admin_main_kb():
-    """Главная админ-панель с 3 кнопками"""
-    kb = InlineKeyboardBuilder()
-    kb.button(text="🍓 Ягоды", callback_data="admin_products")
-    kb.button(text="💬 Поддержка", callback_data="admin_support")
-    kb.button(text="📦 Заказы", callback_data="admin_orders")
-    kb.adjust(1)
-    return kb.as_markup()
+# Админ присылает CSV или JSON (формат как у data.json) — бот показывает,
+# что изменится, и по подтверждению применяет всё одной транзакцией:
+# одно executemany на обновления и одно на новые товары. Каталог,
+# data.json и копии фото пересобираются один раз в конце.
+# Строка сопоставляется с товаром по id, а без id — по названию.
+CATALOG_FIELDS = ("id", "name", "category", "price", "description", "image")
+CATALOG_IMPORT_MAX_BYTES = 1024 * 1024
+SQLITE_INT_MAX = 2 ** 63 - 1
+CATALOG_PREVIEW_LINES = 15
 
-def build_admin_list_kb():
-    """Список товаров"""
+def normalize_catalog_row(raw):
+    """Строка документа -> только заданные поля; ValueError при ошибке"""
+    row = {}
+    for field in CATALOG_FIELDS:
+        value = raw.get(field)
+        # Пустая ячейка — поле не меняется
+        if value is None or (isinstance(value, str) and not value.strip()):
+            continue
+        if field == "id":
+            row["id"] = int(value)
+            # Больше SQLite INTEGER не поместится (OverflowError при записи)
+            if not 0 < row["id"] <= SQLITE_INT_MAX:
+                raise ValueError("некорректный id")
+        elif field == "price":
+            try:
+                price = int(float(str(value).replace(" ", "").replace(",", ".")))
+            except OverflowError:
+                # inf в CSV, 1e999 в JSON
+                raise ValueError("некорректная цена")
+            if price < 0:
+                raise ValueError("отрицательная цена")
+            if price > SQLITE_INT_MAX:
+                raise ValueError("некорректная цена")
+            row["price"] = price
+        elif field == "image":
+            row["image"] = str(value).strip().replace("images/", "")
+        else:
+            row[field] = str(value).strip()
+    return row
+
+def parse_catalog_document(filename, data):
+    """(строки, ошибки); ошибки — список 'строка N: причина'"""
+    text = data.decode("utf-8-sig")
+    if filename.lower().endswith(".json"):
+        items = json.loads(text)
+        if not isinstance(items, list):
+            raise ValueError("JSON должен быть списком товаров")
+        first_line = 1
+    else:
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        items = list(csv.DictReader(io.StringIO(text), dialect=dialect))
+        first_line = 2  # строка 1 — заголовок
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("ожидался объект")
+            row = normalize_catalog_row({k.strip().lower(): v for k, v in item.items() if k})
+            if "id" not in row and "name" not in row:
+                raise ValueError("нужен id или название")
+            rows.append(row)
+        except (ValueError, TypeError, AttributeError) as e:
+            errors.append(f"строка {index + first_line}: {e}")
+    return rows, errors
+
+@db_task
+def save_pending_import(admin_id, rows):
+    """Сохраняет разобранный файл до подтверждения; у админа — один
+    ожидающий импорт, брошенные старше STATE_TTL удаляются"""
+    conn = get_conn()
+    conn.execute("DELETE FROM pending_imports WHERE admin_id=? OR created_at < ?",
+                 (admin_id, int(time.time()) - STATE_TTL))
+    cur = conn.execute(
+        "INSERT INTO pending_imports (admin_id, rows, created_at) VALUES (?,?,?)",
+        (admin_id, json.dumps(rows, ensure_ascii=False), int(time.time()))
+    )
+    conn.commit()
+    return cur.lastrowid
+
+@db_task
+def take_pending_import(import_id, admin_id):
+    """Забирает (и удаляет) ожидающий импорт; None, если его уже нет"""
+    conn = get_conn()
+    row = conn.execute(
+        "DELETE FROM pending_imports WHERE id=? AND admin_id=? RETURNING rows", (import_id, admin_id)
+    ).fetchone()
+    conn.commit()
+    return json.loads(row[0]) if row else None
+
+def plan_catalog_import(conn, rows):
+    """Сравнение с текущим каталогом: (обновления, новые, без изменений, ошибки).
+    Обновление — (id, полная новая строка, {поле: (было, стало)})"""
+    current = {r[0]: r for r in conn.execute(
+        "SELECT id, name, category, price, description, image FROM products"
+    )}
+    by_name = {r[1]: r[0] for r in current.values()}
+    updates, inserts, errors = {}, {}, []
+    unchanged = 0
+    for row in rows:
+        pid = row.get("id")
+        if pid is None:
+            pid = by_name.get(row["name"])
+        elif pid not in current:
+            errors.append(f"нет товара с id {pid}")
+            continue
+        if pid is None:
+            # Повтор нового товара в документе дополняет первую строку
+            row = {**inserts.get(row["name"], {}), **row}
+            if "price" not in row:
+                errors.append(f"{row['name']}: для нового товара нужна цена")
+                continue
+            inserts[row["name"]] = row
+            continue
+        base = dict(zip(CATALOG_FIELDS, updates[pid][1] if pid in updates else current[pid]))
+        changes = {f: (base[f], row[f]) for f in CATALOG_FIELDS[1:] if f in row and row[f] != base[f]}
+        if not changes:
+            unchanged += 1
+            continue
+        merged = tuple(row.get(f, base[f]) for f in CATALOG_FIELDS)
+        old_changes = updates[pid][2] if pid in updates else {}
+        updates[pid] = (pid, merged, {**old_changes, **changes})
+    # Несколько строк одного товара могли вернуть его к исходному виду
+    changed = [u for u in updates.values() if u[1] != tuple(current[u[0]])]
+    unchanged += len(updates) - len(changed)
+    return changed, list(inserts.values()), unchanged, errors
+
+@db_task
+def preview_catalog_import(rows):
+    return plan_catalog_import(get_conn(), rows)
+
+@db_task
+def apply_catalog_import(rows):
+    """Применяет импорт одной транзакцией; план пересчитывается внутри неё"""
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        updates, inserts, unchanged, errors = plan_catalog_import(conn, rows)
+        conn.executemany(
+            "UPDATE products SET name=?, category=?, price=?, description=?, image=? WHERE id=?",
+            [(*merged[1:], pid) for pid, merged, _ in updates]
+        )
+        conn.executemany(
+            "INSERT INTO products (name, category, price, description, image) VALUES (?,?,?,?,?)",
+            [(r["name"], r.get("category", ""), r["price"], r.get("description", ""), r.get("image", ""))
+             for r in inserts]
+        )
+        if updates or inserts:
+            publish_cache_event(conn, "catalog")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    if updates or inserts:
+        bump_catalog_version()
+    return len(updates), len(inserts), unchanged, errors
+
+def format_import_preview(updates, inserts, unchanged, errors):
+    lines = [
+        "📥 Предпросмотр импорта",
+        f"✏️ Изменится: {len(updates)}",
+        f"➕ Новых: {len(inserts)}",
+        f"▫️ Без изменений: {unchanged}",
+    ]
+    if errors:
+        lines.append(f"⚠️ Пропущено с ошибками: {len(errors)}")
+    details = []
+    for pid, merged, changes in updates:
+        fields = ", ".join(
+            f"{f}: {old} → {new}" if f == "price" else f for f, (old, new) in changes.items()
+        )
+        details.append(f"✏️ #{pid} {merged[1]}: {fields}")
+    for row in inserts:
+        details.append(f"➕ {row['name']} ({row.get('category', '')}, {row['price']} ₽)")
+    details.extend(f"⚠️ {e}" for e in errors)
+    if details:
+        lines.append("")
+        lines.extend(details[:CATALOG_PREVIEW_LINES])
+        if len(details) > CATALOG_PREVIEW_LINES:
+            lines.append(f"… и ещё {len(details) - CATALOG_PREVIEW_LINES}")
+    return "\n".join(lines)
+
+def export_catalog(fmt):
+    """Пишет каталог во временный файл построчно, прямо из курсора
+    (выполняется в пуле БД); возвращает путь к файлу"""
+    cursor = get_conn().execute(
+        "SELECT id, name, category, price, description, image FROM products ORDER BY id"
+    )
+    fd, path = tempfile.mkstemp(prefix="catalog_", suffix=f".{fmt}")
+    with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+        if fmt == "json":
+            f.write("[")
+            for index, row in enumerate(cursor):
+                item = dict(zip(CATALOG_FIELDS, row))
+                f.write(("," if index else "") + "\n  " + json.dumps(item, ensure_ascii=False))
+            f.write("\n]\n")
+        else:
+            writer = csv.writer(f)
+            writer.writerow(CATALOG_FIELDS)
+            for row in cursor:
+                writer.writerow(row)
+    return path
+
+# --------------------------------
+# Функции для поддержки
+# --------------------------------
+@db_task
+def save_support_message(user_id, username, message, from_admin=0):
+    conn = get_conn()
+    cur = conn.cursor()
+    timestamp, created_at = now_ts()
+    cur.execute(
+        "INSERT INTO support_messages (user_id, username, message, timestamp, created_at, from_admin) VALUES (?,?,?,?,?,?)",
+        (user_id, username, message, timestamp, created_at, from_admin)
+    )
+    message_id = cur.lastrowid
+    if from_admin:
+        # Ответ админа: диалог прочитан, ждём пользователя
+        cur.execute("""
+            INSERT INTO support_threads (user_id, last_message_at, last_timestamp, last_from_admin, last_admin, unread_count)
+            VALUES (?,?,?,1,?,0)
+            ON CONFLICT(user_id) DO UPDATE SET
+                last_message_at=excluded.last_message_at, last_timestamp=excluded.last_timestamp,
+                last_from_admin=1, last_admin=excluded.last_admin, unread_count=0, archived=0
+        """, (user_id, created_at, timestamp, username))
+        cur.execute(f"UPDATE support_threads SET inbox_rank = {INBOX_RANK_SQL} WHERE user_id=?", (user_id,))
+    else:
+        cur.execute("""
+            INSERT INTO support_threads (user_id, username, last_message_at, last_timestamp, last_from_admin, unread_count)
+            VALUES (?,?,?,?,0,1)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=excluded.username, last_message_at=excluded.last_message_at,
+                last_timestamp=excluded.last_timestamp, last_from_admin=0,
+                unread_count=support_threads.unread_count + 1, archived=0
+        """, (user_id, username, created_at, timestamp))
+        cur.execute(f"UPDATE support_threads SET inbox_rank = {INBOX_RANK_SQL} WHERE user_id=?", (user_id,))
+    event = {"message_id": message_id, "from_admin": bool(from_admin)}
+    publish_cache_event(conn, "support", user_id, event)
+    conn.commit()
+    push_hub.publish(f"user:{user_id}", "support", event)
+
+@db_task
+def get_support_threads_page(after=None, before=None, limit=ADMIN_PAGE_SIZE):
+    """Страница диалогов: сначала ждущие ответа, внутри — новые сверху.
+    Курсор — (inbox_rank, user_id) крайней строки страницы."""
+    conn = get_conn()
+    columns = "user_id, username, last_timestamp, unread_count, last_from_admin, inbox_rank"
+    if before is not None:
+        rows = conn.execute(
+            f"""SELECT {columns} FROM support_threads WHERE (inbox_rank, user_id) < (?, ?)
+                ORDER BY inbox_rank DESC, user_id DESC LIMIT ?""",
+            (*before, limit + 1)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            f"""SELECT {columns} FROM support_threads WHERE (inbox_rank, user_id) > (?, ?)
+                ORDER BY inbox_rank, user_id LIMIT ?""",
+            (*(after or (-sys.maxsize, 0)), limit + 1)
+        ).fetchall()
+    return keyset_page(rows, limit, before is not None)
+
+@db_task
+def mark_support_thread_read(user_id):
+    conn = get_conn()
+    conn.execute("UPDATE support_threads SET unread_count=0 WHERE user_id=? AND unread_count != 0", (user_id,))
+    conn.commit()
+
+@db_task
+def get_support_username(user_id):
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("SELECT username FROM support_threads WHERE user_id=?", (user_id,))
+    result = cur.fetchone()
+    return result[0] if result else None
+
+@db_task
+def get_support_messages_window(user_id, before_id=None, since_id=None, limit=SUPPORT_PAGE_SIZE):
+    """Окно диалога в хронологическом порядке: (rows, has_more).
+    По умолчанию — последние limit сообщений; before_id — более ранние,
+    since_id — только пришедшие после since_id."""
+    conn = get_conn()
+    if since_id is not None:
+        rows = select_with_archive(
+            conn,
+            "SELECT id, message, timestamp, from_admin FROM {db}.support_messages WHERE user_id=? AND id > ? ORDER BY id LIMIT ?",
+            (user_id, since_id, limit + 1)
+        )
+        rows.sort()
+        return keyset_page(rows[:limit + 1], limit, False)
+    rows = select_with_archive(
+        conn,
+        "SELECT id, message, timestamp, from_admin FROM {db}.support_messages WHERE user_id=? AND id < ? ORDER BY id DESC LIMIT ?",
+        (user_id, before_id if before_id is not None else sys.maxsize, limit + 1)
+    )
+    rows.sort(reverse=True)
+    return keyset_page(rows[:limit + 1], limit, True)
+
+# --------------------------------
+# Функции для заказов
+# --------------------------------
+@db_task
+def create_order(user_id, username, cart_data, total_price):
+    conn = get_conn()
+    cur = conn.cursor()
+    timestamp, created_at = now_ts()
+    products_json = json.dumps(cart_data, ensure_ascii=False)
+    
+    cur.execute(
+        "INSERT INTO orders (user_id, username, products_json, total_price, timestamp, created_at, status) VALUES (?,?,?,?,?,?,?)",
+        (user_id, username, products_json, total_price, timestamp, created_at, "pending")
+    )
+    order_id = cur.lastrowid
+    insert_order_items(conn, order_id, cart_data)
+    conn.commit()
+    return order_id
+
+@db_task
+def get_open_orders_page(before_id=None, after_id=None, limit=ADMIN_PAGE_SIZE):
+    """Страница заказов со статусом pending или in_progress, новые сверху.
+    before_id — следующая страница (более старые), after_id — предыдущая."""
+    conn = get_conn()
+    if after_id is not None:
+        rows = conn.execute(
+            "SELECT id, user_id, username, total_price, status FROM orders WHERE status != 'completed' AND id > ? ORDER BY id LIMIT ?",
+            (after_id, limit + 1)
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT id, user_id, username, total_price, status FROM orders WHERE status != 'completed' AND id < ? ORDER BY id DESC LIMIT ?",
+            (before_id if before_id is not None else sys.maxsize, limit + 1)
+        ).fetchall()
+    return keyset_page(rows, limit, after_id is not None)
+
+@db_task
+def get_order(order_id):
+    conn = get_conn()
+    rows = select_with_archive(
+        conn,
+        "SELECT id, user_id, username, total_price, timestamp, status FROM {db}.orders WHERE id=?",
+        (order_id,)
+    )
+    return rows[0] if rows else None
+
+@db_task
+def get_order_items(order_id):
+    conn = get_conn()
+    rows = select_with_archive(
+        conn,
+        "SELECT position, product_id, name, weight, price FROM {db}.order_items WHERE order_id=?",
+        (order_id,)
+    )
+    return [row[1:] for row in sorted(rows)]
+
+@db_task
+def save_order_status(order_id, status):
+    """Смена статуса в БД; возвращает user_id, если заказ стал выполненным"""
+    conn = get_conn()
+    cur = conn.cursor()
+    # completed — конечный статус: карточку выполненного заказа можно открыть
+    # из поиска, но сообщение клиенту не возвращает его в работу
+    cur.execute("UPDATE orders SET status=? WHERE id=? AND status NOT IN (?, 'completed')", (status, order_id, status))
+    if cur.rowcount == 0:
+        conn.commit()
+        return
+    
+    cur.execute("SELECT user_id, total_price FROM orders WHERE id=?", (order_id,))
+    user_id, total_price = cur.fetchone()
+    event = {"order_id": order_id, "status": status}
+    publish_cache_event(conn, "order", user_id, event)
+    
+    # Если заказ выполнен - добавляем в историю покупок (один раз:
+    # purchases.order_id уникален, повторное выполнение строку не добавит)
+    if status == "completed":
+        timestamp, created_at = now_ts()
+        cur.execute("INSERT OR IGNORE INTO purchases (user_id, order_id, timestamp, created_at) VALUES (?,?,?,?)",
+                   (user_id, order_id, timestamp, created_at))
+        # Покупка — журнал продаж: в сводки заказ попадает вместе с ней
+        if cur.rowcount:
+            record_sale(conn, order_id, total_price, created_at)
+        publish_cache_event(conn, "profile", user_id)
+    conn.commit()
+    push_hub.publish(f"user:{user_id}", "order", event)
+    return user_id if status == "completed" else None
+
+async def update_order_status(order_id, status):
+    user_id = await save_order_status(order_id, status)
+    # Кэш профилей меняется только в event loop (см. "Кэш профилей")
+    if user_id is not None:
+        invalidate_profile(user_id)
+
+@db_task
+def get_user_purchases_page(user_id, before=None, limit=20):
+    """Страница истории покупок (новые сверху): (покупки, has_more).
+    Строки заказов подтягиваются одним запросом на всю страницу."""
+    conn = get_conn()
+    # Выполненные заказы со временем уходят в архив — читаем обе БД
+    rows = select_with_archive(conn, """
+        SELECT p.id, p.order_id, o.total_price, p.timestamp
+        FROM {db}.purchases p
+        JOIN {db}.orders o ON p.order_id = o.id
+        WHERE p.user_id = ? AND p.id < ?
+        ORDER BY p.id DESC
+        LIMIT ?
+    """, (user_id, before if before is not None else sys.maxsize, limit + 1))
+    rows.sort(reverse=True)
+    rows, has_more = keyset_page(rows[:limit + 1], limit, False)
+    items = {}
+    if rows:
+        order_ids = [r[1] for r in rows]
+        placeholders = ",".join("?" * len(order_ids))
+        for order_id, position, product_id, name, weight, price in sorted(select_with_archive(
+            conn,
+            f"SELECT order_id, position, product_id, name, weight, price FROM {{db}}.order_items WHERE order_id IN ({placeholders})",
+            order_ids
+        )):
+            items.setdefault(order_id, []).append(
+                {"product_id": product_id, "name": name, "weight": weight, "price": price}
+            )
+    purchases = [{
+        "id": purchase_id,
+        "products": items.get(order_id, []),
+        "total_price": total_price,
+        "timestamp": timestamp
+    } for purchase_id, order_id, total_price, timestamp in rows]
+    return purchases, has_more
+
+# --------------------------------
+# Статистика продаж
+# --------------------------------
+# Выручка, число заказов и килограммы по дням, товарам и категориям
+# хранятся готовыми суммами: update_order_status добавляет выполненный
+# заказ в той же транзакции, что и покупку, поэтому отчёт читает
+# несколько строк сводок, а не всю историю заказов. День — дата
+# выполнения заказа по местному времени. rebuild_sales пересчитывает
+# сводки заново (включая заказы в архиве) — /stats rebuild.
+SALES_TOP_PRODUCTS = 10
+STATS_TOKEN = os.getenv("STATS_TOKEN", "")  # пустой — /api/stats закрыт
+SALES_MAX_PERIODS = 366
+SALES_OTHER_PRODUCT = 0  # строки старых заказов без product_id
+
+SALES_UPSERTS = {
+    "sales_daily": """
+        INSERT INTO sales_daily (day, orders, revenue, weight) VALUES (?,?,?,?)
+        ON CONFLICT(day) DO UPDATE SET orders=orders+excluded.orders,
+            revenue=revenue+excluded.revenue, weight=weight+excluded.weight""",
+    "sales_products": """
+        INSERT INTO sales_products (product_id, name, category, orders, revenue, weight) VALUES (?,?,?,?,?,?)
+        ON CONFLICT(product_id) DO UPDATE SET name=excluded.name, category=excluded.category,
+            orders=orders+excluded.orders, revenue=revenue+excluded.revenue, weight=weight+excluded.weight""",
+    "sales_categories": """
+        INSERT INTO sales_categories (category, orders, revenue, weight) VALUES (?,?,?,?)
+        ON CONFLICT(category) DO UPDATE SET orders=orders+excluded.orders,
+            revenue=revenue+excluded.revenue, weight=weight+excluded.weight""",
+}
+
+def sales_day(ts):
+    return datetime.fromtimestamp(ts).date().isoformat()
+
+def record_sale(conn, order_id, total_price, completed_at, schema="main"):
+    """Добавляет выполненный заказ в сводки (внутри транзакции вызывающего)"""
+    products, categories = {}, {}
+    for product_id, name, weight, price, category in conn.execute(f"""
+        SELECT i.product_id, i.name, i.weight, i.price, p.category
+        FROM {schema}.order_items i LEFT JOIN main.products p ON p.id = i.product_id
+        WHERE i.order_id = ?
+    """, (order_id,)):
+        weight, price = weight or 0, price or 0
+        key = product_id if product_id is not None else SALES_OTHER_PRODUCT
+        line = products.setdefault(key, [name or "", category or "", 0, 0])
+        line[2] += price
+        line[3] += weight
+        totals = categories.setdefault(category or "", [0, 0])
+        totals[0] += price
+        totals[1] += weight
+    conn.execute(SALES_UPSERTS["sales_daily"], (
+        sales_day(completed_at), 1, total_price or 0, sum(line[3] for line in products.values())
+    ))
+    conn.executemany(SALES_UPSERTS["sales_products"], [
+        (key, name, category, 1, revenue, weight) for key, (name, category, revenue, weight) in products.items()
+    ])
+    conn.executemany(SALES_UPSERTS["sales_categories"], [
+        (category, 1, revenue, weight) for category, (revenue, weight) in categories.items()
+    ])
+
+def rebuild_sales(conn):
+    """Сводки с нуля по всем выполненным заказам (внутри транзакции вызывающего)"""
+    for table in SALES_UPSERTS:
+        conn.execute(f"DELETE FROM {table}")
+    seen = set()
+    # Архив может ещё не существовать (первый запуск миграций)
+    for schema in ("main", "archive"):
+        if not table_columns(conn, schema, "orders"):
+            continue
+        rows = conn.execute(f"""
+            SELECT o.id, o.total_price, MIN(p.created_at)
+            FROM {schema}.orders o JOIN {schema}.purchases p ON p.order_id = o.id
+            WHERE o.status = 'completed'
+            GROUP BY o.id
+        """).fetchall()
+        for order_id, total_price, completed_at in rows:
+            if order_id in seen:
+                continue
+            seen.add(order_id)
+            record_sale(conn, order_id, total_price, completed_at or 0, schema)
+    return len(seen)
+
+@db_task
+def rebuild_sales_stats():
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        count = rebuild_sales(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return count
+
+def sales_totals(rows):
+    return {"orders": sum(r[1] for r in rows), "revenue": sum(r[2] for r in rows),
+            "weight": round(sum(r[3] for r in rows), 3)}
+
+@db_task
+def get_sales_report(period="day", count=7, top=SALES_TOP_PRODUCTS):
+    """Отчёт: итоги за сегодня/7/30 дней, ряд по дням или неделям
+    (последние count, пустые периоды с нулями), товары и категории"""
+    if period not in ("day", "week"):
+        raise ValueError("period: day или week")
+    count = min(max(int(count), 1), SALES_MAX_PERIODS)
+    today = datetime.now().date()
+    step = 7 if period == "week" else 1
+    last = today - timedelta(days=today.weekday()) if period == "week" else today
+    first = last - timedelta(days=step * (count - 1))
+    since = min(first, today - timedelta(days=29))
+    conn = get_conn()
+    days = conn.execute(
+        "SELECT day, orders, revenue, weight FROM sales_daily WHERE day >= ? ORDER BY day",
+        (since.isoformat(),)
+    ).fetchall()
+
+    periods = {}
+    for offset in range(count):
+        periods[(first + timedelta(days=step * offset)).isoformat()] = []
+    for row in days:
+        day = datetime.strptime(row[0], "%Y-%m-%d").date()
+        start = day - timedelta(days=day.weekday()) if period == "week" else day
+        if start.isoformat() in periods:
+            periods[start.isoformat()].append(row)
+
+    def window(n):
+        border = (today - timedelta(days=n - 1)).isoformat()
+        return sales_totals([row for row in days if row[0] >= border])
+
+    products = conn.execute(
+        "SELECT product_id, name, category, orders, revenue, weight FROM sales_products ORDER BY revenue DESC LIMIT ?",
+        (top,)
+    ).fetchall()
+    categories = conn.execute(
+        "SELECT category, orders, revenue, weight FROM sales_categories ORDER BY revenue DESC"
+    ).fetchall()
+    return {
+        "period": period,
+        "totals": {"today": window(1), "week": window(7), "month": window(30)},
+        "periods": [dict(start=start, **sales_totals(rows)) for start, rows in periods.items()],
+        "products": [{"product_id": pid or None, "name": name, "category": category, "orders": orders,
+                      "revenue": revenue, "weight": round(weight, 3)}
+                     for pid, name, category, orders, revenue, weight in products],
+        "categories": [{"category": category, "orders": orders, "revenue": revenue, "weight": round(weight, 3)}
+                       for category, orders, revenue, weight in categories],
+    }
+
+# --------------------------------
+# Кэш профилей
+# --------------------------------
+# Страницы истории покупок кэшируются по пользователю. История меняется
+# только при выполнении заказа: update_order_status увеличивает версию
+# профиля, и закэшированные страницы с прежней версией не используются.
+# profile_cache и profile_versions трогаются только из event loop:
+# invalidate_profile вызывается после run_db, а не в потоке пула.
+# Версия страницы — пара (поколение, версия пользователя): reset_profiles
+# меняет поколение, и запросы, начатые до сброса, результат не сохраняют.
+PROFILE_CACHE_USERS = 2000
+profile_cache = OrderedDict()  # user_id -> {"version": (int, int), "pages": {(before, limit): payload}}
+profile_versions = {}
+profile_state = {"generation": 0}
+
+def invalidate_profile(user_id):
+    profile_versions[user_id] = profile_versions.get(user_id, 0) + 1
+    profile_cache.pop(user_id, None)
+
+def reset_profiles():
+    """Сбрасывает кэш профилей целиком (база пересоздана)"""
+    profile_state["generation"] += 1
+    profile_versions.clear()
+    profile_cache.clear()
+
+def profile_version(user_id):
+    return profile_state["generation"], profile_versions.get(user_id, 0)
+
+async def get_profile_page(user_id, before=None, limit=20):
+    version = profile_version(user_id)
+    entry = profile_cache.get(user_id)
+    if entry and entry["version"] == version and (before, limit) in entry["pages"]:
+        profile_cache.move_to_end(user_id)
+        return entry["pages"][(before, limit)]
+
+    payload = await get_user_purchases_page(user_id, before, limit)
+    # За время запроса профиль мог измениться — такой результат не кэшируем
+    if profile_version(user_id) == version:
+        entry = profile_cache.get(user_id)
+        if not entry or entry["version"] != version:
+            entry = profile_cache[user_id] = {"version": version, "pages": {}}
+        entry["pages"][(before, limit)] = payload
+        profile_cache.move_to_end(user_id)
+        while len(profile_cache) > PROFILE_CACHE_USERS:
+            profile_cache.popitem(last=False)
+    return payload
+
+# --------------------------------
+# Архив и хранение
+# --------------------------------
+# Выполненные заказы старше ORDER_RETENTION_DAYS и закрытые диалоги
+# поддержки (последним ответил админ, тишина дольше SUPPORT_RETENTION_DAYS)
+# переносятся в архивную БД (ARCHIVE_DB_FILE, подключена к каждому
+# соединению как "archive"). Перенос идёт пачками по RETENTION_BATCH
+# строк, каждая пачка — своя короткая транзакция, между пачками пауза,
+# чтобы не держать блокировку записи. Чтение истории (профиль, карточка
+# заказа, диалог) смотрит в обе БД через select_with_archive.
+# После переноса свободные страницы основной БД возвращаются порциями
+# incremental_vacuum в пуле БД. 0 в *_RETENTION_DAYS отключает перенос.
+ORDER_RETENTION_DAYS = float(os.getenv("ORDER_RETENTION_DAYS", 180))
+SUPPORT_RETENTION_DAYS = float(os.getenv("SUPPORT_RETENTION_DAYS", 90))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", 6 * 3600))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", 500))
+RETENTION_PAUSE = float(os.getenv("RETENTION_PAUSE", 0.05))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", 256))
+
+retention_stats = {"orders": 0, "support_threads": 0, "vacuum_pages": 0, "runs": 0}
+
+def move_to_archive(conn, table, key, ids):
+    """Копирует строки в архив и удаляет из основной БД (внутри транзакции).
+    INSERT OR REPLACE — на случай повтора после сбоя между файлами"""
+    columns = ", ".join(table_columns(conn, "main", table))
+    placeholders = ",".join("?" * len(ids))
+    conn.execute(
+        f"INSERT OR REPLACE INTO archive.{table} ({columns}) "
+        f"SELECT {columns} FROM main.{table} WHERE {key} IN ({placeholders})",
+        ids
+    )
+    conn.execute(f"DELETE FROM main.{table} WHERE {key} IN ({placeholders})", ids)
+
+@db_task
+def archive_orders_batch(cutoff, limit=RETENTION_BATCH):
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM orders WHERE status = 'completed' AND created_at < ? ORDER BY created_at LIMIT ?",
+            (cutoff, limit)
+        )]
+        if ids:
+            move_to_archive(conn, "order_items", "order_id", ids)
+            move_to_archive(conn, "purchases", "order_id", ids)
+            move_to_archive(conn, "orders", "id", ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(ids)
+
+@db_task
+def archive_support_batch(cutoff, limit=RETENTION_BATCH):
+    conn = get_conn()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        user_ids = [r[0] for r in conn.execute(
+            "SELECT user_id FROM support_threads WHERE last_from_admin = 1 AND archived = 0 "
+            "AND last_message_at < ? ORDER BY last_message_at LIMIT ?",
+            (cutoff, limit)
+        )]
+        if user_ids:
+            # Сводка диалога остаётся в основной БД: по ней строится список у админа
+            move_to_archive(conn, "support_messages", "user_id", user_ids)
+            conn.executemany("UPDATE support_threads SET archived = 1 WHERE user_id = ?", [(u,) for u in user_ids])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(user_ids)
+
+@db_task
+def vacuum_step(pages=RETENTION_VACUUM_PAGES):
+    """Возвращает ОС до pages свободных страниц; результат — сколько осталось"""
+    conn = get_conn()
+    # execute() делает один шаг (= одну страницу), executescript — до конца
+    conn.executescript(f"PRAGMA main.incremental_vacuum({int(pages)});")
+    return conn.execute("PRAGMA main.freelist_count").fetchone()[0]
+
+async def archive_in_batches(batch_func, days):
+    if days <= 0:
+        return 0
+    cutoff = int(time.time() - days * 86400)
+    total = 0
+    while True:
+        moved = await batch_func(cutoff)
+        total += moved
+        if moved < RETENTION_BATCH:
+            return total
+        await asyncio.sleep(RETENTION_PAUSE)
+
+async def run_retention():
+    orders = await archive_in_batches(archive_orders_batch, ORDER_RETENTION_DAYS)
+    threads = await archive_in_batches(archive_support_batch, SUPPORT_RETENTION_DAYS)
+    freed = 0
+    if orders or threads:
+        remaining = await run_db(lambda: get_conn().execute("PRAGMA main.freelist_count").fetchone()[0])
+        while remaining:
+            left = await vacuum_step()
+            freed += remaining - left
+            if left >= remaining:
+                break
+            remaining = left
+            await asyncio.sleep(RETENTION_PAUSE)
+    retention_stats["orders"] += orders
+    retention_stats["support_threads"] += threads
+    retention_stats["vacuum_pages"] += freed
+    retention_stats["runs"] += 1
+    if orders or threads:
+        print(f"🗃️ В архив: заказов {orders}, диалогов {threads}; освобождено страниц БД: {freed}")
+    return orders, threads, freed
+
+async def retention_loop():
+    while True:
+        try:
+            await run_retention()
+        except Exception as e:
+            print(f"⚠️ Ошибка архивации: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+# --------------------------------
+# Синхронизация кэшей между процессами
+# --------------------------------
+# Кэши (каталог, профили) у каждого процесса свои. Изменение записывает
+# событие в cache_events в той же транзакции, что и сами данные, а
+# каждый процесс следит за PRAGMA data_version своего соединения и при
+# изменении БД дочитывает новые события других процессов. В обычном
+# однопроцессном режиме свои события пропускаются, и всё сводится к
+# дешёвому опросу data_version.
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", 0.2))
+CACHE_EVENTS_KEEP = 3600
+cache_sync = {"conn": None, "data_version": None, "last_id": 0, "applied": 0}
+
+def publish_cache_event(conn, kind, key=0, payload=None):
+    """Событие инвалидации; пишется в транзакции вызывающего"""
+    conn.execute(
+        "INSERT INTO cache_events (kind, key, origin, created_at, payload) VALUES (?,?,?,?,?)",
+        (kind, key, os.getpid(), int(time.time()), json.dumps(payload) if payload is not None else None)
+    )
+
+def poll_cache_events():
+    """Выполняется в пуле БД на отдельном соединении: data_version у
+    соединения меняется только от чужих коммитов. Возвращает (reset, rows);
+    сами кэши меняет apply_cache_events в event loop"""
+    conn = cache_sync["conn"]
+    if conn is None:
+        conn = cache_sync["conn"] = open_conn()
+        cache_sync["last_id"] = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()[0]
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if data_version == cache_sync["data_version"]:
+        return False, []
+    cache_sync["data_version"] = data_version
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events").fetchone()[0]
+    reset = last_id < cache_sync["last_id"]
+    if reset:
+        # Таблица пересоздана (/resetdb) — нумерация началась заново
+        cache_sync["last_id"] = 0
+    rows = conn.execute(
+        "SELECT id, kind, key, payload FROM cache_events WHERE id > ? AND id <= ? AND origin != ? ORDER BY id",
+        (cache_sync["last_id"], last_id, os.getpid())
+    ).fetchall()
+    cache_sync["last_id"] = last_id
+    return reset, rows
+
+def apply_cache_events(rows, reset=False):
+    catalog = reset
+    if reset:
+        reset_profiles()
+    for _, kind, key, payload in rows:
+        if kind == "catalog":
+            catalog = True
+        elif kind == "profile":
+            invalidate_profile(key)
+        elif kind == "outbox":
+            outbox_wakeup.set()
+        elif kind in USER_PUSH_EVENTS:
+            push_hub.publish(f"user:{key}", kind, json.loads(payload or "{}"))
+    if catalog:
+        bump_catalog_version()
+    cache_sync["applied"] += len(rows)
+
+@db_task
+def prune_cache_events():
+    conn = get_conn()
+    conn.execute("DELETE FROM cache_events WHERE created_at < ?", (int(time.time()) - CACHE_EVENTS_KEEP,))
+    conn.commit()
+
+async def watch_cache_events():
+    last_prune = time.monotonic()
+    while True:
+        try:
+            reset, rows = await run_db(poll_cache_events)
+            if reset or rows:
+                apply_cache_events(rows, reset)
+            if IS_UPDATE_OWNER and time.monotonic() - last_prune > CACHE_EVENTS_KEEP / 4:
+                last_prune = time.monotonic()
+                await prune_cache_events()
+        except Exception as e:
+            print(f"❌ Ошибка синхронизации кэшей: {e}")
+        await asyncio.sleep(CACHE_SYNC_INTERVAL)
+
+# --------------------------------
+# Push-события для WebApp
+# --------------------------------
+# GET /api/events — поток Server-Sent Events. Клиент подписан на тему
+# "catalog" и на свою "user:<id>": ответы поддержки, смена статуса
+# заказа, изменение каталога. Хаб живёт в процессе; события из других
+# процессов приходят через cache_events (watch_cache_events).
+# У каждого подключения ограниченный буфер: кто не успевает читать,
+# отключается и переподключается с Last-Event-ID. Пропущенные события
+# досылаются из истории хаба, а если их там уже нет (или id выдан
+# другим процессом / до перезапуска) — приходит событие reset, и
+# клиент перечитывает данные сам. Пустой комментарий раз в
+# PUSH_HEARTBEAT секунд держит соединение через прокси.
+PUSH_CLIENT_BUFFER = 64
+PUSH_HISTORY = 1000
+PUSH_HEARTBEAT = float(os.getenv("PUSH_HEARTBEAT", 15))
+PUSH_MAX_CLIENTS = int(os.getenv("PUSH_MAX_CLIENTS", 1000))
+USER_PUSH_EVENTS = ("support", "order")
+# Личные события отдаются только по подписанным initData из WebApp;
+# подпись старше INIT_DATA_MAX_AGE секунд не принимается.
+INIT_DATA_MAX_AGE = int(os.getenv("INIT_DATA_MAX_AGE", 86400))
+
+class PushSubscriber:
+    def __init__(self, topics):
+        self.topics = topics
+        self.queue = asyncio.Queue(maxsize=PUSH_CLIENT_BUFFER)
+        self.overflowed = False
+
+class PushHub:
+    def __init__(self):
+        self.subscribers = {}
+        self.history = deque(maxlen=PUSH_HISTORY)
+        self.seq = 0
+        # Префикс id событий: id из другого процесса или до перезапуска не совпадёт
+        self.epoch = f"{os.getpid():x}{int(time.time()):x}"
+        self.loop = None
+        self.clients = 0
+        self.stats = {"published": 0, "delivered": 0, "overflows": 0}
+
+    def bind(self, loop):
+        self.loop = loop
+
+    def publish(self, topic, event, data):
+        """Можно вызывать из любого потока: писатели БД работают в пуле"""
+        loop = self.loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self.dispatch(topic, event, data)
+        else:
+            loop.call_soon_threadsafe(self.dispatch, topic, event, data)
+
+    def dispatch(self, topic, event, data):
+        self.seq += 1
+        message = (self.seq, topic, event, data)
+        self.history.append(message)
+        self.stats["published"] += 1
+        for sub in list(self.subscribers.get(topic, ())):
+            self.deliver(sub, message)
+
+    def deliver(self, sub, message):
+        if sub.overflowed:
+            return
+        try:
+            sub.queue.put_nowait(message)
+            self.stats["delivered"] += 1
+        except asyncio.QueueFull:
+            # Освобождаем место под сигнал закрытия: клиент переподключится
+            sub.overflowed = True
+            self.stats["overflows"] += 1
+            sub.queue.get_nowait()
+            sub.queue.put_nowait(None)
+
+    def event_id(self, seq):
+        return f"{self.epoch}-{seq}"
+
+    def missed(self, topics, last_event_id):
+        """События после last_event_id; None — восстановить нельзя (нужен reset)"""
+        if not last_event_id:
+            return []
+        epoch, _, seq = last_event_id.rpartition("-")
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        seq = int(seq)
+        oldest = self.history[0][0] if self.history else self.seq + 1
+        if seq + 1 < oldest:
+            return None
+        return [m for m in self.history if m[0] > seq and m[1] in topics]
+
+    def subscribe(self, topics, last_event_id=None):
+        sub = PushSubscriber(topics)
+        missed = self.missed(topics, last_event_id)
+        for topic in topics:
+            self.subscribers.setdefault(topic, set()).add(sub)
+        self.clients += 1
+        return sub, missed
+
+    def unsubscribe(self, sub):
+        for topic in sub.topics:
+            subs = self.subscribers.get(topic)
+            if subs:
+                subs.discard(sub)
+                if not subs:
+                    del self.subscribers[topic]
+        self.clients -= 1
+
+    def close_all(self):
+        for subs in list(self.subscribers.values()):
+            for sub in list(subs):
+                if not sub.overflowed:
+                    sub.overflowed = True
+                    if sub.queue.full():
+                        sub.queue.get_nowait()
+                    sub.queue.put_nowait(None)
+
+push_hub = PushHub()
+
+def format_sse(event_id, event, data):
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    return f"id: {event_id}\nevent: {event}\ndata: {payload}\n\n".encode("utf-8")
+
+def verify_init_data(init_data):
+    """Проверяет подпись initData из Telegram WebApp и возвращает id пользователя"""
+    try:
+        fields = dict(parse_qsl(init_data, strict_parsing=True))
+    except ValueError:
+        return None
+    received = fields.pop("hash", "")
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        return None
+    try:
+        if time.time() - int(fields["auth_date"]) > INIT_DATA_MAX_AGE:
+            return None
+        user_id = json.loads(fields["user"])["id"]
+    except (KeyError, ValueError, TypeError):
+        return None
+    return user_id if isinstance(user_id, int) else None
+
+# --------------------------------
+# Очередь уведомлений админам
+# --------------------------------
+# Уведомления пишутся в таблицу notification_outbox и отправляются фоновой
+# задачей с учётом лимитов Bot API: не больше 30 сообщений в секунду всего
+# и примерно 1 в секунду в один чат. RetryAfter откладывает отправку,
+# сетевые ошибки повторяются с нарастающей паузой. Сообщения с одинаковым
+# coalesce_key, накопившиеся за окно склейки, уходят одной сводкой.
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 1
+OUTBOX_COALESCE_WINDOW = float(os.getenv("OUTBOX_COALESCE_WINDOW", 3))
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BATCH = 100
+TELEGRAM_TEXT_LIMIT = 4096
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Забирает токен (при нехватке — в долг) и возвращает, сколько секунд ждать"""
+        self.refill(time.monotonic())
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def take(self, now):
+        """Забирает токен, только если он есть; иначе — сколько секунд ждать"""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def is_idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+outbox_wakeup = asyncio.Event()
+outbox_global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE, OUTBOX_GLOBAL_RATE)
+outbox_chat_buckets = {}
+outbox_state = {"flood_until": 0.0, "sent": 0, "failed": 0}
+
+def get_chat_bucket(chat_id):
+    bucket = outbox_chat_buckets.get(chat_id)
+    if bucket is None:
+        if len(outbox_chat_buckets) > 1000:
+            now = time.monotonic()
+            for cid in [c for c, b in outbox_chat_buckets.items() if b.is_idle(now)]:
+                del outbox_chat_buckets[cid]
+        bucket = outbox_chat_buckets[chat_id] = TokenBucket(OUTBOX_CHAT_RATE, 1)
+    return bucket
+
+@db_task
+def enqueue_notifications(chat_ids, text, reply_markup=None, coalesce_key=None):
+    conn = get_conn()
+    markup_json = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+    # Склеиваемые уведомления ждут окно, чтобы успела накопиться пачка
+    delay = OUTBOX_COALESCE_WINDOW if coalesce_key else 0
+    next_at = time.time() + delay
+    created_at = int(time.time())
+    conn.executemany(
+        "INSERT INTO notification_outbox (chat_id, text, reply_markup, coalesce_key, next_at, created_at) VALUES (?,?,?,?,?,?)",
+        [(chat_id, text, markup_json, coalesce_key, next_at, created_at) for chat_id in chat_ids]
+    )
+    if not IS_UPDATE_OWNER:
+        # Очередь разбирает только основной воркер — будим его через cache_events
+        publish_cache_event(conn, "outbox")
+    conn.commit()
+
+async def notify_admins(text, reply_markup=None, coalesce_key=None):
+    """Поставить уведомление всем админам в очередь (не ждёт отправки)"""
+    if not ADMIN_IDS:
+        return
+    await enqueue_notifications(ADMIN_IDS, text, reply_markup, coalesce_key)
+    outbox_wakeup.set()
+
+def build_digest(texts):
+    if len(texts) == 1:
+        return texts[0]
+    text = f"📬 Сводка: {len(texts)} уведомлений\n\n" + "\n\n———\n\n".join(texts)
+    if len(text) > TELEGRAM_TEXT_LIMIT:
+        text = text[:TELEGRAM_TEXT_LIMIT - 1] + "…"
+    return text
+
+@db_task
+def fetch_due_notifications(now, limit):
+    """Готовые к отправке пачки: [(ids, chat_id, text, reply_markup, attempts)]"""
+    conn = get_conn()
+    rows = conn.execute(
+        "SELECT id, chat_id, text, reply_markup, coalesce_key, attempts FROM notification_outbox WHERE next_at <= ? ORDER BY id LIMIT ?",
+        (now, limit)
+    ).fetchall()
+    batches = []
+    seen = set()
+    for row_id, chat_id, text, markup, key, attempts in rows:
+        if row_id in seen:
+            continue
+        if key is None:
+            seen.add(row_id)
+            batches.append(([row_id], chat_id, text, markup, attempts))
+            continue
+        # Забираем всю пачку по ключу, включая ещё не "созревшие" записи
+        group = conn.execute(
+            "SELECT id, text, reply_markup, attempts FROM notification_outbox WHERE chat_id=? AND coalesce_key=? ORDER BY id",
+            (chat_id, key)
+        ).fetchall()
+        ids = [g[0] for g in group]
+        seen.update(ids)
+        batches.append((ids, chat_id, build_digest([g[1] for g in group]), group[-1][2], max(g[3] for g in group)))
+    return batches
+
+@db_task
+def next_notification_due():
+    row = get_conn().execute("SELECT MIN(next_at) FROM notification_outbox").fetchone()
+    return row[0]
+
+@db_task
+def finish_notifications(ids):
+    conn = get_conn()
+    conn.executemany("DELETE FROM notification_outbox WHERE id=?", [(i,) for i in ids])
+    conn.commit()
+
+@db_task
+def reschedule_notifications(ids, next_at, attempts):
+    conn = get_conn()
+    conn.executemany(
+        "UPDATE notification_outbox SET next_at=?, attempts=? WHERE id=?",
+        [(next_at, attempts, i) for i in ids]
+    )
+    conn.commit()
+
+async def deliver_batch(ids, chat_id, text, markup_json, attempts):
+    wait = max(get_chat_bucket(chat_id).reserve(), outbox_global_bucket.reserve(),
+               outbox_state["flood_until"] - time.monotonic())
+    if wait > 0:
+        await asyncio.sleep(wait)
+    markup = types.InlineKeyboardMarkup.model_validate_json(markup_json) if markup_json else None
+    try:
+        await bot.send_message(chat_id, text, reply_markup=markup)
+    except TelegramRetryAfter as e:
+        outbox_state["flood_until"] = time.monotonic() + e.retry_after
+        await reschedule_notifications(ids, time.time() + e.retry_after, attempts)
+        return
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Чат недоступен или сообщение некорректно — повтор не поможет
+        print(f"⚠️ Уведомление для {chat_id} отброшено: {e}")
+        outbox_state["failed"] += 1
+        await finish_notifications(ids)
+        return
+    except Exception as e:
+        attempts += 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            print(f"❌ Уведомление для {chat_id} не доставлено после {attempts} попыток: {e}")
+            outbox_state["failed"] += 1
+            await finish_notifications(ids)
+        else:
+            await reschedule_notifications(ids, time.time() + min(2 ** attempts, 300), attempts)
+        return
+    outbox_state["sent"] += 1
+    await finish_notifications(ids)
+
+async def deliver_chat(batches):
+    # В один чат — строго по порядку
+    for batch in batches:
+        await deliver_batch(*batch)
+
+async def process_outbox():
+    """Отправляет созревшие уведомления; возвращает паузу до следующих"""
+    batches = await fetch_due_notifications(time.time(), OUTBOX_BATCH)
+    by_chat = {}
+    for batch in batches:
+        by_chat.setdefault(batch[1], []).append(batch)
+    if by_chat:
+        await asyncio.gather(*(deliver_chat(b) for b in by_chat.values()))
+    if len(batches) >= OUTBOX_BATCH:
+        return 0
+    next_at = await next_notification_due()
+    if next_at is None:
+        return 60
+    return max(0, next_at - time.time())
+
+async def notification_worker():
+    while True:
+        outbox_wakeup.clear()
+        try:
+            delay = await process_outbox()
+        except Exception as e:
+            print(f"❌ Ошибка очереди уведомлений: {e}")
+            delay = 5
+        if delay > 0:
+            try:
+                await asyncio.wait_for(outbox_wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+# --------------------------------
+# Состояние админки
+# --------------------------------
+# Незавершённые диалоги (пользователь нажал «Поддержка» и ушёл) живут
+# не дольше STATE_TTL секунд, а всего записей не больше STATE_MAX_ENTRIES.
+# STATE_BACKEND=memory — словарь в процессе (LRU), sqlite — таблица
+# conversation_state: переживает рестарт и общая для нескольких процессов.
+class ConversationState:
+    """Компактная запись состояния одного пользователя"""
+    __slots__ = ("mode", "target_user", "order_id", "pid",
+                 "new_name", "new_cat", "new_price", "new_desc", "extra")
+    FIELDS = __slots__[:-1]
+
+    def __init__(self, data=None):
+        for name in self.__slots__:
+            setattr(self, name, None)
+        for key, val in (data or {}).items():
+            self.set(key, val)
+
+    def set(self, key, val):
+        if key in self.FIELDS:
+            setattr(self, key, val)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = val
+
+    def as_dict(self):
+        data = {name: getattr(self, name) for name in self.FIELDS if getattr(self, name) is not None}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+class MemoryStateStore:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # uid -> (expires_at, ConversationState)
+
+    def evict(self, now):
+        # Порядок — по последнему изменению, значит истёкшие всегда в начале
+        while self.entries:
+            uid, (expires_at, _) = next(iter(self.entries.items()))
+            if expires_at > now and len(self.entries) <= self.max_entries:
+                break
+            del self.entries[uid]
+
+    async def load(self, uid):
+        entry = self.entries.get(uid)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.entries[uid]
+            return None
+        return entry[1]
+
+    async def update(self, uid, fields):
+        now = time.monotonic()
+        entry = self.entries.pop(uid, None)
+        record = entry[1] if entry and entry[0] > now else ConversationState()
+        for key, val in fields.items():
+            record.set(key, val)
+        self.entries[uid] = (now + self.ttl, record)
+        self.evict(now)
+
+    async def replace(self, uid, data):
+        self.entries.pop(uid, None)
+        if data:
+            await self.update(uid, data)
+
+    async def delete(self, uid):
+        self.entries.pop(uid, None)
+
+class SQLiteStateStore:
+    PURGE_EVERY = 100
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.writes = 0
+
+    def _load(self, uid):
+        row = get_conn().execute(
+            "SELECT data FROM conversation_state WHERE user_id=? AND expires_at > ?", (uid, time.time())
+        ).fetchone()
+        return ConversationState(json.loads(row[0])) if row else None
+
+    def _save(self, conn, uid, record):
+        conn.execute(
+            "INSERT OR REPLACE INTO conversation_state (user_id, data, expires_at) VALUES (?,?,?)",
+            (uid, json.dumps(record.as_dict(), ensure_ascii=False, separators=(",", ":")), time.time() + self.ttl)
+        )
+        self.writes += 1
+        if self.writes % self.PURGE_EVERY == 0:
+            conn.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (time.time(),))
+            conn.execute("""DELETE FROM conversation_state WHERE user_id IN (
+                SELECT user_id FROM conversation_state ORDER BY expires_at DESC LIMIT -1 OFFSET ?)""",
+                (self.max_entries,))
+
+    def _update(self, uid, fields):
+        conn = get_conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            record = self._load(uid) or ConversationState()
+            for key, val in fields.items():
+                record.set(key, val)
+            self._save(conn, uid, record)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _replace(self, uid, data):
+        conn = get_conn()
+        if data:
+            self._save(conn, uid, ConversationState(data))
+        else:
+            conn.execute("DELETE FROM conversation_state WHERE user_id=?", (uid,))
+        conn.commit()
+
+    async def load(self, uid):
+        return await run_db(self._load, uid)
+
+    async def update(self, uid, fields):
+        await run_db(self._update, uid, fields)
+
+    async def replace(self, uid, data):
+        await run_db(self._replace, uid, data)
+
+    async def delete(self, uid):
+        await run_db(self._replace, uid, None)
+
+if STATE_BACKEND == "sqlite":
+    state_store = SQLiteStateStore(STATE_TTL, STATE_MAX_ENTRIES)
+else:
+    state_store = MemoryStateStore(STATE_TTL, STATE_MAX_ENTRIES)
+print(f"✅ Хранилище состояний: {STATE_BACKEND}")
+
+async def set_admin_state(uid, key, val):
+    await state_store.update(uid, {key: val})
+
+async def get_admin(uid):
+    record = await state_store.load(uid)
+    return record.as_dict() if record else {}
+
+async def clear_admin(uid):
+    await state_store.delete(uid)
+
+class ConversationStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх state_store: state — поле mode, data — остальные поля"""
+
+    async def set_state(self, key, state=None):
+        await set_admin_state(key.user_id, "mode", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        return (await get_admin(key.user_id)).get("mode")
+
+    async def set_data(self, key, data):
+        mode = (await get_admin(key.user_id)).get("mode")
+        new_data = {k: v for k, v in data.items() if k != "mode"}
+        if mode is not None:
+            new_data["mode"] = mode
+        await state_store.replace(key.user_id, new_data)
+
+    async def get_data(self, key):
+        data = await get_admin(key.user_id)
+        data.pop("mode", None)
+        return data
+
+    async def close(self):
+        pass
+
+dp = Dispatcher(storage=ConversationStorage(), fsm_strategy=FSMStrategy.GLOBAL_USER)
+dp.message.middleware(handler_metrics_middleware)
+dp.callback_query.middleware(handler_metrics_middleware)
+
+# --------------------------------
+# Маршрутизация: callback-кнопки и режимы диалога
+# --------------------------------
+# Вместо длинной цепочки фильтров F.data (aiogram проверяет их по порядку
+# регистрации) — один обработчик и словарь действий. callback_data имеет
+# вид "<действие>_<арг>_<арг>" — формат прежний, старые кнопки в чатах
+# продолжают работать. Действие ищется по самому длинному префиксу,
+# аргументы приводятся к объявленным типам и передаются обработчику
+# готовыми. Текстовые сообщения и фото так же выбирают обработчик по
+# режиму (raw_state, его уже прочитало FSM-хранилище) одним обращением
+# к словарю.
+class CallbackRoutes:
+    def __init__(self):
+        self.routes = {}
+        self.max_parts = 1
+
+    def __call__(self, action, *arg_types):
+        """Декоратор: @callback_route("order_view", int)"""
+        def decorator(func):
+            if action in self.routes:
+                raise ValueError(f"Повторное действие callback: {action}")
+            self.routes[action] = (func, arg_types)
+            self.max_parts = max(self.max_parts, action.count("_") + 1)
+            return func
+        return decorator
+
+    def resolve(self, data):
+        """(обработчик, аргументы) или None, если действие неизвестно или аргументы не те"""
+        parts = data.split("_")
+        for size in range(min(len(parts), self.max_parts), 0, -1):
+            route = self.routes.get("_".join(parts[:size]))
+            if route is None:
+                continue
+            func, arg_types = route
+            values = parts[size:]
+            if len(values) != len(arg_types):
+                return None
+            try:
+                return func, tuple(cast(value) for cast, value in zip(arg_types, values))
+            except ValueError:
+                return None
+        return None
+
+    def filter(self, call: types.CallbackQuery):
+        route = self.resolve(call.data or "")
+        return {"route": route} if route else False
+
+class ModeRoutes:
+    def __init__(self):
+        self.routes = {}
+
+    def __call__(self, *modes):
+        """Декоратор: @text_mode("edit_name", ...)"""
+        def decorator(func):
+            for mode in modes:
+                self.routes[mode] = func
+            return func
+        return decorator
+
+    def filter(self, message: types.Message, raw_state=None):
+        func = self.routes.get(raw_state)
+        return {"route": (func, ())} if func else False
+
+callback_route = CallbackRoutes()
+text_mode = ModeRoutes()
+photo_mode = ModeRoutes()
+
+@dp.callback_query(callback_route.filter)
+async def handle_callback(call: types.CallbackQuery, route):
+    func, args = route
+    await func(call, *args)
+
+# --------------------------------
+# Клавиатуры
+# --------------------------------
+def build_main_kb():
+    """Главная клавиатура для пользователя"""
+    kb = types.ReplyKeyboardMarkup(
+        keyboard=[
+            [types.KeyboardButton(text="🛍 Открыть магазин", web_app=types.WebAppInfo(url=f"{RENDER_EXTERNAL_URL}/shop"))],
+            [types.KeyboardButton(text="💬 Поддержка")]
+        ],
+        resize_keyboard=True
+    )
+    return kb
+
+def build_admin_main_kb():
+    """Главная админ-панель с 3 кнопками"""
     kb = InlineKeyboardBuilder()
-    rows = get_all_products()
-    if not rows:
+    kb.button(text="🍓 Ягоды", callback_data="admin_products")
+    kb.button(text="💬 Поддержка", callback_data="admin_support")
+    kb.button(text="📦 Заказы", callback_data="admin_orders")
+    kb.adjust(1)
+    return kb.as_markup()
+
+async def build_admin_list_kb(after_id=None, before_id=None):
+    """Список товаров (страница)"""
+    kb = InlineKeyboardBuilder()
+    rows, has_more = await get_products_page(after_id, before_id)
+    if not rows and after_id is None and before_id is None:
         kb.button(text="➕ Добавить первый товар", callback_data="admin_add")
-    else:
-        for r in rows:
-            kb.button(text=f"{r[0]} — {r[1]}", callback_data=f"admin_prod_{r[0]}")
-        kb.button(text="➕ Добавить товар", callback_data="admin_add")
-    kb.button(text="↩ Назад", callback_data="admin_main")
+        kb.button(text="↩ Назад", callback_data="admin_main")
+        kb.adjust(1)
+        return kb.as_markup()
+
+    for r in rows:
+        kb.button(text=f"{r[0]} — {r[1]}", callback_data=f"admin_prod_{r[0]}")
     kb.adjust(2)
+
+    # Навигация: при шаге назад «ещё» означает более ранние товары
+    has_prev = has_more if before_id is not None else bool(after_id)
+    has_next = has_more if before_id is None else True
+    nav = []
+    if rows and has_prev:
+        nav.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"prod_page_p_{rows[0][0]}"))
+    if rows and has_next:
+        nav.append(types.InlineKeyboardButton(text="➡️", callback_data=f"prod_page_n_{rows[-1][0]}"))
+    if nav:
+        kb.row(*nav)
+    kb.row(
+        types.InlineKeyboardButton(text="➕ Добавить товар", callback_data="admin_add"),
+        types.InlineKeyboardButton(text="🔎 Найти", callback_data="prod_search"),
+    )
+    kb.row(
+        types.InlineKeyboardButton(text="📥 Импорт", callback_data="catalog_import"),
+        types.InlineKeyboardButton(text="📤 Экспорт CSV", callback_data="catalog_export_csv"),
+        types.InlineKeyboardButton(text="📤 JSON", callback_data="catalog_export_json"),
+    )
+    kb.row(types.InlineKeyboardButton(text="↩ Назад", callback_data="admin_main"))
+    return kb.as_markup()
+
+def build_product_results_kb(rows):
+    """Результаты поиска товаров"""
+    kb = InlineKeyboardBuilder()
+    for r in rows:
+        kb.button(text=f"{r[0]} — {r[1]}", callback_data=f"admin_prod_{r[0]}")
+    kb.button(text="↩ К списку", callback_data="admin_products")
+    kb.adjust(1)
     return kb.as_markup()
 
 def build_actions_kb(pid):
@@ -385,37 +2936,65 @@ def build_actions_kb(pid):
     kb.adjust(2)
     return kb.as_markup()
 
-def build_support_list_kb():
-    """Список пользователей в поддержке"""
+def thread_cursor(row):
+    return f"{row[5]}_{row[0]}"
+
+async def build_support_list_kb(after=None, before=None):
+    """Список диалогов поддержки (страница, ждущие ответа сверху)"""
     kb = InlineKeyboardBuilder()
-    users = get_support_users()
+    threads, has_more = await get_support_threads_page(after, before)
     
-    if not users:
+    if not threads:
         kb.button(text="Нет сообщений", callback_data="noop")
     else:
-        for user_id, username, last_time in users:
+        for user_id, username, last_time, unread, last_from_admin, _ in threads:
             display_name = f"@{username}" if username else f"ID: {user_id}"
-            kb.button(text=f"{display_name} ({last_time})", callback_data=f"support_user_{user_id}")
-    
-    kb.button(text="↩ Назад", callback_data="admin_main")
+            if unread:
+                mark = f"🔴 {unread} "
+            elif not last_from_admin:
+                mark = "🟡 "
+            else:
+                mark = ""
+            kb.button(text=f"{mark}{display_name} ({last_time})", callback_data=f"support_user_{user_id}")
     kb.adjust(1)
+
+    has_prev = has_more if before is not None else after is not None
+    has_next = has_more if before is None else True
+    nav = []
+    if threads and has_prev:
+        nav.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"support_page_p_{thread_cursor(threads[0])}"))
+    if threads and has_next:
+        nav.append(types.InlineKeyboardButton(text="➡️", callback_data=f"support_page_n_{thread_cursor(threads[-1])}"))
+    if nav:
+        kb.row(*nav)
+    kb.row(types.InlineKeyboardButton(text="↩ Назад", callback_data="admin_main"))
     return kb.as_markup()
 
-def build_orders_list_kb():
-    """Список заказов"""
+async def build_orders_list_kb(before_id=None, after_id=None):
+    """Список заказов (страница, новые сверху)"""
     kb = InlineKeyboardBuilder()
-    orders = get_pending_orders()
+    orders, has_more = await get_open_orders_page(before_id, after_id)
     
     if not orders:
         kb.button(text="Нет активных заказов", callback_data="noop")
     else:
-        for order_id, user_id, username, products_json, total_price, timestamp, status in orders:
+        for order_id, user_id, username, total_price, status in orders:
             display_name = f"@{username}" if username else f"ID: {user_id}"
             status_emoji = "🆕" if status == "pending" else "⏳"
             kb.button(text=f"{status_emoji} {display_name} — {total_price} ₽", callback_data=f"order_view_{order_id}")
-    
-    kb.button(text="↩ Назад", callback_data="admin_main")
     kb.adjust(1)
+
+    has_newer = has_more if after_id is not None else before_id is not None
+    has_older = has_more if after_id is None else True
+    nav = []
+    if orders and has_newer:
+        nav.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"order_page_p_{orders[0][0]}"))
+    if orders and has_older:
+        nav.append(types.InlineKeyboardButton(text="➡️", callback_data=f"order_page_n_{orders[-1][0]}"))
+    if nav:
+        kb.row(*nav)
+    kb.row(types.InlineKeyboardButton(text="🔎 Заказ по номеру", callback_data="order_search"))
+    kb.row(types.InlineKeyboardButton(text="↩ Назад", callback_data="admin_main"))
     return kb.as_markup()
 
 # --------------------------------
@@ -441,110 +3020,158 @@ async def cmd_resetdb(msg: types.Message):
     await msg.answer("🔄 Пересоздаю базу данных...")
     
     try:
-        if os.path.exists(DB_FILE):
-            os.remove(DB_FILE)
-        init_db()
-        seed_database_from_json()
-        refresh_web_data()
+        await reset_db()
+        await refresh_web_data()
         
-        count = len(get_all_products())
+        count = len(await get_all_products())
         await msg.answer(f"✅ База пересоздана!\n📦 Товаров в базе: {count}")
     except Exception as e:
         await msg.answer(f"❌ Ошибка: {e}")
 
 @dp.message(F.text == "💬 Поддержка")
 async def cmd_support(msg: types.Message):
-    set_admin_state(msg.from_user.id, "mode", "support_message")
+    await set_admin_state(msg.from_user.id, "mode", "support_message")
     await msg.answer("💬 Напишите ваше сообщение в поддержку:")
 
 # --------------------------------
 # Callback handlers - админ панель
 # --------------------------------
-@dp.callback_query(F.data == "admin_main")
+@callback_route("admin_main")
 async def admin_main(call: types.CallbackQuery):
     await call.answer()
     await call.message.edit_text("⚙️ Админ-панель:", reply_markup=build_admin_main_kb())
 
-@dp.callback_query(F.data == "admin_products")
+@callback_route("admin_products")
 async def admin_products(call: types.CallbackQuery):
     await call.answer()
-    clear_admin(call.from_user.id)
-    await call.message.edit_text("📦 Список товаров:", reply_markup=build_admin_list_kb())
+    await clear_admin(call.from_user.id)
+    await call.message.edit_text("📦 Список товаров:", reply_markup=await build_admin_list_kb())
 
-@dp.callback_query(F.data == "admin_support")
+@callback_route("admin_support")
 async def admin_support(call: types.CallbackQuery):
     await call.answer()
-    await call.message.edit_text("💬 Поддержка — список пользователей:", reply_markup=build_support_list_kb())
+    await call.message.edit_text("💬 Поддержка — список пользователей:", reply_markup=await build_support_list_kb())
 
-@dp.callback_query(F.data == "admin_orders")
+@callback_route("admin_orders")
 async def admin_orders(call: types.CallbackQuery):
     await call.answer()
-    await call.message.edit_text("📦 Заказы:", reply_markup=build_orders_list_kb())
+    await call.message.edit_text("📦 Заказы:", reply_markup=await build_orders_list_kb())
 
 # --------------------------------
 # Поддержка - просмотр диалога
 # --------------------------------
-@dp.callback_query(F.data.startswith("support_user_"))
-async def view_support_user(call: types.CallbackQuery):
+# Лимит Telegram на текст — 4096 символов; оставляем запас под заголовок
+SUPPORT_TEXT_BUDGET = 3800
+
+def format_support_entry(message, timestamp, from_admin):
+    if len(message) > SUPPORT_TEXT_BUDGET // 2:
+        message = message[:SUPPORT_TEXT_BUDGET // 2] + "…"
+    if from_admin:
+        return f"👨‍💼 Админ ({timestamp}):\n{message}\n\n"
+    return f"👤 Пользователь ({timestamp}):\n{message}\n\n"
+
+def fit_support_page(rows, keep_newest):
+    """Берёт из окна столько сообщений, сколько влезает в одно сообщение Telegram.
+    keep_newest — отбрасывать старые (иначе — новые). Возвращает (текст, показанные строки)."""
+    ordered = list(reversed(rows)) if keep_newest else list(rows)
+    shown, size = [], 0
+    for row in ordered:
+        entry = format_support_entry(*row[1:])
+        if shown and size + len(entry) > SUPPORT_TEXT_BUDGET:
+            break
+        shown.append((row, entry))
+        size += len(entry)
+    if keep_newest:
+        shown.reverse()
+    return "".join(entry for _, entry in shown), [row for row, _ in shown]
+
+async def render_support_dialog(user_id, before_id=None, since_id=None):
+    rows, has_more = await get_support_messages_window(user_id, before_id, since_id)
+    if not rows:
+        return None, None
+    text, shown = fit_support_page(rows, keep_newest=since_id is None)
+
+    if since_id is None:
+        has_older = has_more or len(shown) < len(rows)
+        has_newer = before_id is not None
+    else:
+        has_older = True
+        has_newer = has_more or len(shown) < len(rows)
+
+    username = await get_support_username(user_id) or "неизвестен"
+    text = f"💬 Диалог с @{username}\n\n" + text
+
+    kb = InlineKeyboardBuilder()
+    nav = []
+    if has_older:
+        nav.append(types.InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"support_older_{user_id}_{shown[0][0]}"))
+    if has_newer:
+        nav.append(types.InlineKeyboardButton(text="Позже ➡️", callback_data=f"support_newer_{user_id}_{shown[-1][0]}"))
+    if nav:
+        kb.row(*nav)
+    kb.row(types.InlineKeyboardButton(text="✍️ Ответить", callback_data=f"support_reply_{user_id}"))
+    kb.row(types.InlineKeyboardButton(text="↩ Назад", callback_data="admin_support"))
+    return text, kb.as_markup()
+
+@callback_route("support_page", str, int, int)
+async def support_threads_page(call: types.CallbackQuery, direction, rank, user_id):
+    await call.answer()
+    cursor = (rank, user_id)
+    if direction == "n":
+        markup = await build_support_list_kb(after=cursor)
+    else:
+        markup = await build_support_list_kb(before=cursor)
+    await call.message.edit_reply_markup(reply_markup=markup)
+
+@callback_route("support_user", int)
+async def view_support_user(call: types.CallbackQuery, user_id):
     await call.answer()
-    user_id = int(call.data.split("_")[2])
     
-    messages = get_user_support_messages(user_id)
+    text, markup = await render_support_dialog(user_id)
     
-    if not messages:
+    if not text:
         await call.message.answer("Нет сообщений")
         return
     
-    # Получаем username
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT username FROM support_messages WHERE user_id=? LIMIT 1", (user_id,))
-    result = cur.fetchone()
-    conn.close()
-    username = result[0] if result else "неизвестен"
-    
-    text = f"💬 Диалог с @{username}\n\n"
-    
-    for message, timestamp, from_admin in messages:
-        if from_admin:
-            text += f"👨‍💼 Админ ({timestamp}):\n{message}\n\n"
-        else:
-            text += f"👤 Пользователь ({timestamp}):\n{message}\n\n"
-    
-    kb = InlineKeyboardBuilder()
-    kb.button(text="✍️ Ответить", callback_data=f"support_reply_{user_id}")
-    kb.button(text="↩ Назад", callback_data="admin_support")
-    kb.adjust(1)
-    
-    await call.message.edit_text(text, reply_markup=kb.as_markup())
+    await mark_support_thread_read(user_id)
+    await call.message.edit_text(text, reply_markup=markup)
+
+@callback_route("support_older", int, int)
+async def support_dialog_older(call: types.CallbackQuery, user_id, message_id):
+    await call.answer()
+    text, markup = await render_support_dialog(user_id, before_id=message_id)
+    if text:
+        await call.message.edit_text(text, reply_markup=markup)
 
-@dp.callback_query(F.data.startswith("support_reply_"))
-async def support_reply(call: types.CallbackQuery):
+@callback_route("support_newer", int, int)
+async def support_dialog_newer(call: types.CallbackQuery, user_id, message_id):
+    await call.answer()
+    text, markup = await render_support_dialog(user_id, since_id=message_id)
+    if text:
+        await call.message.edit_text(text, reply_markup=markup)
+
+@callback_route("support_reply", int)
+async def support_reply(call: types.CallbackQuery, user_id):
     await call.answer()
-    user_id = int(call.data.split("_")[2])
     
-    set_admin_state(call.from_user.id, "mode", "support_reply")
-    set_admin_state(call.from_user.id, "target_user", user_id)
+    await set_admin_state(call.from_user.id, "mode", "support_reply")
+    await set_admin_state(call.from_user.id, "target_user", user_id)
     
     await call.message.answer("✍️ Введите ответ пользователю:")
 
 # --------------------------------
 # Заказы - просмотр
 # --------------------------------
-@dp.callback_query(F.data.startswith("order_view_"))
-async def view_order(call: types.CallbackQuery):
-    await call.answer()
-    order_id = int(call.data.split("_")[2])
-    
-    order = get_order(order_id)
+async def render_order(order_id):
+    """Текст и клавиатура карточки заказа (None, None — если заказа нет)"""
+    order = await get_order(order_id)
     
     if not order:
-        await call.message.answer("❌ Заказ не найден")
-        return
+        return None, None
     
-    order_id, user_id, username, products_json, total_price, timestamp, status = order
+    order_id, user_id, username, total_price, timestamp, status = order
     
-    products = json.loads(products_json)
+    products = await get_order_items(order_id)
     
     text = f"📦 Заказ #{order_id}\n\n"
     text += f"👤 От: @{username}\n"
@@ -552,10 +3179,10 @@ async def view_order(call: types.CallbackQuery):
     text += f"📊 Статус: {status}\n\n"
     text += f"🛒 Состав заказа:\n\n"
     
-    for item in products:
-        text += f"• {item['name']}\n"
-        text += f"  Вес: {item['weight']} кг\n"
-        text += f"  Цена: {item['price']} ₽\n\n"
+    for product_id, name, weight, price in products:
+        text += f"• {name}\n"
+        text += f"  Вес: {weight} кг\n"
+        text += f"  Цена: {price} ₽\n\n"
     
     text += f"💰 Итого: {total_price} ₽"
     
@@ -564,49 +3191,64 @@ async def view_order(call: types.CallbackQuery):
     kb.button(text="✅ Заказ выполнен", callback_data=f"order_complete_{order_id}")
     kb.button(text="↩ Назад", callback_data="admin_orders")
     kb.adjust(1)
+    return text, kb.as_markup()
+
+@callback_route("order_view", int)
+async def view_order(call: types.CallbackQuery, order_id):
+    await call.answer()
     
-    await call.message.edit_text(text, reply_markup=kb.as_markup())
+    text, markup = await render_order(order_id)
+    if not text:
+        await call.message.answer("❌ Заказ не найден")
+        return
+    
+    await call.message.edit_text(text, reply_markup=markup)
+
+@callback_route("order_page", str, int)
+async def orders_page(call: types.CallbackQuery, direction, order_id):
+    await call.answer()
+    if direction == "n":
+        markup = await build_orders_list_kb(before_id=order_id)
+    else:
+        markup = await build_orders_list_kb(after_id=order_id)
+    await call.message.edit_reply_markup(reply_markup=markup)
+
+@callback_route("order_search")
+async def order_search(call: types.CallbackQuery):
+    await call.answer()
+    await set_admin_state(call.from_user.id, "mode", "order_search")
+    await call.message.answer("🔎 Введите номер заказа:")
 
-@dp.callback_query(F.data.startswith("order_msg_"))
-async def order_message(call: types.CallbackQuery):
+@callback_route("order_msg", int)
+async def order_message(call: types.CallbackQuery, order_id):
     await call.answer()
-    order_id = int(call.data.split("_")[2])
     
-    order = get_order(order_id)
+    order = await get_order(order_id)
     user_id = order[1]
     
-    set_admin_state(call.from_user.id, "mode", "order_message")
-    set_admin_state(call.from_user.id, "target_user", user_id)
-    set_admin_state(call.from_user.id, "order_id", order_id)
+    await set_admin_state(call.from_user.id, "mode", "order_message")
+    await set_admin_state(call.from_user.id, "target_user", user_id)
+    await set_admin_state(call.from_user.id, "order_id", order_id)
     
     await call.message.answer("✍️ Введите сообщение клиенту (по заказу):")
 
-@dp.callback_query(F.data.startswith("order_complete_"))
-async def order_complete(call: types.CallbackQuery):
+@callback_route("order_complete", int)
+async def order_complete(call: types.CallbackQuery, order_id):
     await call.answer()
-    order_id = int(call.data.split("_")[2])
     
-    update_order_status(order_id, "completed")
+    await update_order_status(order_id, "completed")
     
     await call.message.answer("✅ Заказ отмечен как выполненный!")
-    await call.message.edit_reply_markup(reply_markup=build_orders_list_kb())
+    await call.message.edit_reply_markup(reply_markup=await build_orders_list_kb())
 
-@dp.callback_query(F.data == "noop")
+@callback_route("noop")
 async def noop(call: types.CallbackQuery):
     await call.answer()
 # --------------------------------
 # Callback handlers - товары
 # --------------------------------
-@dp.callback_query(F.data.startswith("admin_prod_"))
-async def view_product(call: types.CallbackQuery):
-    await call.answer()
-    pid = int(call.data.split("_")[2])
-    p = get_product(pid)
-    if not p:
-        await call.message.answer("❌ Товар не найден")
-        return
-    
-    text = (
+def render_product(p):
+    return (
         f"🔹 ID: {p[0]}\n"
         f"📦 Название: {p[1]}\n"
         f"📂 Категория: {p[2]}\n"
@@ -614,277 +3256,629 @@ async def view_product(call: types.CallbackQuery):
         f"📝 Описание: {p[4]}\n"
         f"📷 Фото: {p[5]}\n"
     )
-    await call.message.edit_text(text, reply_markup=build_actions_kb(pid))
 
-@dp.callback_query(F.data == "admin_add")
+@callback_route("admin_prod", int)
+async def view_product(call: types.CallbackQuery, pid):
+    await call.answer()
+    p = await get_product(pid)
+    if not p:
+        await call.message.answer("❌ Товар не найден")
+        return
+    
+    await call.message.edit_text(render_product(p), reply_markup=build_actions_kb(pid))
+
+@callback_route("prod_page", str, int)
+async def products_page(call: types.CallbackQuery, direction, pid):
+    await call.answer()
+    if direction == "n":
+        markup = await build_admin_list_kb(after_id=pid)
+    else:
+        markup = await build_admin_list_kb(before_id=pid)
+    await call.message.edit_reply_markup(reply_markup=markup)
+
+@callback_route("prod_search")
+async def product_search(call: types.CallbackQuery):
+    await call.answer()
+    await set_admin_state(call.from_user.id, "mode", "product_search")
+    await call.message.answer("🔎 Введите ID товара или часть названия:")
+
+@callback_route("admin_add")
 async def admin_add(call: types.CallbackQuery):
     await call.answer()
-    set_admin_state(call.from_user.id, "mode", "add_name")
+    await set_admin_state(call.from_user.id, "mode", "add_name")
     await call.message.answer("➕ Введите название нового товара:")
 
-@dp.callback_query(F.data.startswith("edit_name_"))
-async def edit_name(call: types.CallbackQuery):
-    await call.answer()
-    pid = int(call.data.split("_")[2])
-    set_admin_state(call.from_user.id, "mode", "edit_name")
-    set_admin_state(call.from_user.id, "pid", pid)
-    await call.message.answer(f"✏️ Введите новое название для товара #{pid}:")
+@callback_route("edit_name", int)
+async def edit_name(call: types.CallbackQuery, pid):
+    await call.answer()
+    await set_admin_state(call.from_user.id, "mode", "edit_name")
+    await set_admin_state(call.from_user.id, "pid", pid)
+    await call.message.answer(f"✏️ Введите новое название для товара #{pid}:")
+
+@callback_route("edit_cat", int)
+async def edit_cat(call: types.CallbackQuery, pid):
+    await call.answer()
+    await set_admin_state(call.from_user.id, "mode", "edit_cat")
+    await set_admin_state(call.from_user.id, "pid", pid)
+    await call.message.answer(f"📂 Введите новую категорию для товара #{pid}:")
+
+@callback_route("edit_price", int)
+async def edit_price(call: types.CallbackQuery, pid):
+    await call.answer()
+    await set_admin_state(call.from_user.id, "mode", "edit_price")
+    await set_admin_state(call.from_user.id, "pid", pid)
+    await call.message.answer(f"💰 Введите новую цену для товара #{pid}:")
+
+@callback_route("edit_desc", int)
+async def edit_desc(call: types.CallbackQuery, pid):
+    await call.answer()
+    await set_admin_state(call.from_user.id, "mode", "edit_desc")
+    await set_admin_state(call.from_user.id, "pid", pid)
+    await call.message.answer(f"📝 Введите новое описание для товара #{pid}:")
+
+@callback_route("edit_photo", int)
+async def edit_photo(call: types.CallbackQuery, pid):
+    await call.answer()
+    await set_admin_state(call.from_user.id, "mode", "edit_photo")
+    await set_admin_state(call.from_user.id, "pid", pid)
+    await call.message.answer(f"📷 Отправьте новое фото для товара #{pid}:")
+
+@callback_route("del", int)
+async def delete_product_confirm(call: types.CallbackQuery, pid):
+    await call.answer()
+    await delete_product(pid)
+    await refresh_web_data()
+    await call.message.answer(f"✅ Товар #{pid} удалён!")
+    await call.message.edit_text("📦 Список товаров:", reply_markup=await build_admin_list_kb())
+
+# --------------------------------
+# Обработчики текстовых сообщений (по режиму диалога)
+# --------------------------------
+@dp.message(F.text, text_mode.filter)
+async def handle_text(msg: types.Message, route):
+    func, _ = route
+    await func(msg, await get_admin(msg.from_user.id))
+
+# ========== ПОДДЕРЖКА ==========
+@text_mode("support_message")
+async def text_support_message(msg: types.Message, state):
+    # Пользователь отправляет сообщение в поддержку
+    uid = msg.from_user.id
+    username = msg.from_user.username or "неизвестен"
+    await save_support_message(uid, username, msg.text, from_admin=0)
+    
+    # Уведомляем всех админов
+    kb = InlineKeyboardBuilder()
+    kb.button(text="✍️ Ответить", callback_data=f"support_reply_{uid}")
+    await notify_admins(
+        f"💬 Новое сообщение в поддержку!\n\n"
+        f"От: @{username}\n"
+        f"Сообщение: {msg.text}",
+        reply_markup=kb.as_markup(),
+        coalesce_key=f"support_{uid}"
+    )
+    
+    await clear_admin(uid)
+    await msg.answer("✅ Ваше сообщение отправлено в поддержку!")
+
+@text_mode("support_reply")
+async def text_support_reply(msg: types.Message, state):
+    # Админ отвечает пользователю
+    target_user = state.get("target_user")
+    
+    # Сохраняем ответ админа
+    admin_username = msg.from_user.username or "admin"
+    await save_support_message(target_user, admin_username, msg.text, from_admin=1)
+    
+    # Отправляем пользователю уведомление
+    kb = InlineKeyboardBuilder()
+    kb.button(text="✍️ Ответить", callback_data="support_from_notification")
+    
+    try:
+        await bot.send_message(
+            target_user,
+            f"💬 Новое сообщение от поддержки!\n\n{msg.text}",
+            reply_markup=kb.as_markup()
+        )
+    except:
+        pass
+    
+    await clear_admin(msg.from_user.id)
+    await msg.answer("✅ Ответ отправлен пользователю!")
+
+@text_mode("order_message")
+async def text_order_message(msg: types.Message, state):
+    # Админ пишет клиенту по заказу
+    target_user = state.get("target_user")
+    order_id = state.get("order_id")
+    
+    # Обновляем статус заказа на in_progress (выполненный остаётся выполненным)
+    await update_order_status(order_id, "in_progress")
+    
+    # Отправляем сообщение клиенту
+    try:
+        await bot.send_message(
+            target_user,
+            f"📦 Сообщение по вашему заказу #{order_id}:\n\n{msg.text}"
+        )
+    except:
+        pass
+    
+    await clear_admin(msg.from_user.id)
+    await msg.answer("✅ Сообщение отправлено клиенту!")
+
+@text_mode("order_search")
+async def text_order_search(msg: types.Message, state):
+    await clear_admin(msg.from_user.id)
+    if not msg.text.strip().lstrip("#").isdigit():
+        await msg.reply("❌ Номер заказа должен быть числом!")
+        return
+    text, markup = await render_order(int(msg.text.strip().lstrip("#")))
+    if not text:
+        await msg.reply("❌ Заказ не найден")
+        return
+    await msg.answer(text, reply_markup=markup)
 
-@dp.callback_query(F.data.startswith("edit_cat_"))
-async def edit_cat(call: types.CallbackQuery):
-    await call.answer()
-    pid = int(call.data.split("_")[2])
-    set_admin_state(call.from_user.id, "mode", "edit_cat")
-    set_admin_state(call.from_user.id, "pid", pid)
-    await call.message.answer(f"📂 Введите новую категорию для товара #{pid}:")
+# ========== ТОВАРЫ ==========
+@text_mode("product_search")
+async def text_product_search(msg: types.Message, state):
+    await clear_admin(msg.from_user.id)
+    query = msg.text.strip()
+    if query.isdigit():
+        p = await get_product(int(query))
+        if not p:
+            await msg.reply("❌ Товар не найден")
+            return
+        await msg.answer(render_product(p), reply_markup=build_actions_kb(p[0]))
+        return
+    rows = await search_products(query)
+    if not rows:
+        await msg.reply("❌ Ничего не найдено")
+        return
+    await msg.answer(f"🔎 Найдено: {len(rows)}", reply_markup=build_product_results_kb(rows))
 
-@dp.callback_query(F.data.startswith("edit_price_"))
-async def edit_price(call: types.CallbackQuery):
-    await call.answer()
-    pid = int(call.data.split("_")[2])
-    set_admin_state(call.from_user.id, "mode", "edit_price")
-    set_admin_state(call.from_user.id, "pid", pid)
-    await call.message.answer(f"💰 Введите новую цену для товара #{pid}:")
+# Шаги добавления товара: режим -> (поле, следующий режим, подсказка)
+ADD_PRODUCT_STEPS = {
+    "add_name": ("new_name", "add_cat", "📂 Введите категорию:"),
+    "add_cat": ("new_cat", "add_price", "💰 Введите цену:"),
+    "add_price": ("new_price", "add_desc", "📝 Введите описание:"),
+    "add_desc": ("new_desc", "add_photo", "📷 Отправьте фото товара:"),
+}
 
-@dp.callback_query(F.data.startswith("edit_desc_"))
-async def edit_desc(call: types.CallbackQuery):
-    await call.answer()
-    pid = int(call.data.split("_")[2])
-    set_admin_state(call.from_user.id, "mode", "edit_desc")
-    set_admin_state(call.from_user.id, "pid", pid)
-    await call.message.answer(f"📝 Введите новое описание для товара #{pid}:")
+@text_mode(*ADD_PRODUCT_STEPS)
+async def text_add_product(msg: types.Message, state):
+    uid = msg.from_user.id
+    field, next_mode, prompt = ADD_PRODUCT_STEPS[state.get("mode")]
+    value = msg.text
+    if field == "new_price":
+        try:
+            value = int(msg.text)
+        except ValueError:
+            await msg.reply("❌ Цена должна быть числом!")
+            return
+    await set_admin_state(uid, field, value)
+    await set_admin_state(uid, "mode", next_mode)
+    await msg.reply(prompt)
 
-@dp.callback_query(F.data.startswith("edit_photo_"))
-async def edit_photo(call: types.CallbackQuery):
-    await call.answer()
-    pid = int(call.data.split("_")[2])
-    set_admin_state(call.from_user.id, "mode", "edit_photo")
-    set_admin_state(call.from_user.id, "pid", pid)
-    await call.message.answer(f"📷 Отправьте новое фото для товара #{pid}:")
+# Редактирование поля товара: режим -> (поле, сообщение об успехе)
+EDIT_PRODUCT_FIELDS = {
+    "edit_name": ("name", "✅ Название товара #{pid} обновлено!"),
+    "edit_cat": ("category", "✅ Категория товара #{pid} обновлена!"),
+    "edit_price": ("price", "✅ Цена товара #{pid} обновлена!"),
+    "edit_desc": ("description", "✅ Описание товара #{pid} обновлено!"),
+}
 
-@dp.callback_query(F.data.startswith("del_"))
-async def delete_product_confirm(call: types.CallbackQuery):
-    await call.answer()
-    pid = int(call.data.split("_")[1])
-    delete_product(pid)
-    refresh_web_data()
-    await call.message.answer(f"✅ Товар #{pid} удалён!")
-    await call.message.edit_text("📦 Список товаров:", reply_markup=build_admin_list_kb())
+@text_mode(*EDIT_PRODUCT_FIELDS)
+async def text_edit_product(msg: types.Message, state):
+    pid = state.get("pid")
+    field, done = EDIT_PRODUCT_FIELDS[state.get("mode")]
+    value = msg.text
+    if field == "price":
+        try:
+            value = int(msg.text)
+        except ValueError:
+            await msg.reply("❌ Цена должна быть числом!")
+            return
+    await update_product_field(pid, field, value)
+    await refresh_web_data()
+    await clear_admin(msg.from_user.id)
+    await msg.reply(done.format(pid=pid))
 
 # --------------------------------
-# Обработчик текстовых сообщений
+# Обработчик фото
 # --------------------------------
-@dp.message(F.text)
-async def handle_text(msg: types.Message):
-    uid = msg.from_user.id
-    state = get_admin(uid)
-    mode = state.get("mode")
-    
-    # ========== ПОДДЕРЖКА ==========
-    if mode == "support_message":
-        # Пользователь отправляет сообщение в поддержку
-        username = msg.from_user.username or "неизвестен"
-        save_support_message(uid, username, msg.text, from_admin=0)
-        
-        # Уведомляем всех админов
-        for admin_id in ADMIN_IDS:
-            try:
-                kb = InlineKeyboardBuilder()
-                kb.button(text="✍️ Ответить", callback_data=f"support_reply_{uid}")
-                
-                await bot.send_message(
-                    admin_id,
-                    f"💬 Новое сообщение в поддержку!\n\n"
-                    f"От: @{username}\n"
-                    f"Сообщение: {msg.text}",
-                    reply_markup=kb.as_markup()
-                )
-            except:
-                pass
-        
-        clear_admin(uid)
-        await msg.answer("✅ Ваше сообщение отправлено в поддержку!")
-        return
+@dp.message(F.photo, photo_mode.filter)
+async def handle_photo(msg: types.Message, route):
+    func, _ = route
+    await func(msg, await get_admin(msg.from_user.id))
+
+@photo_mode("add_photo")
+async def photo_add_product(msg: types.Message, state):
+    # Фото скачивается в фоне, товар появляется сразу
+    filename = await receive_photo(msg)
     
-    if mode == "support_reply":
-        # Админ отвечает пользователю
-        target_user = state.get("target_user")
-        
-        # Сохраняем ответ админа
-        admin_username = msg.from_user.username or "admin"
-        save_support_message(target_user, admin_username, msg.text, from_admin=1)
-        
-        # Отправляем пользователю уведомление
-        kb = InlineKeyboardBuilder()
-        kb.button(text="✍️ Ответить", callback_data="support_from_notification")
-        
-        try:
-            await bot.send_message(
-                target_user,
-                f"💬 Новое сообщение от поддержки!\n\n{msg.text}",
-                reply_markup=kb.as_markup()
-            )
-        except:
-            pass
-        
-        clear_admin(uid)
-        await msg.answer("✅ Ответ отправлен пользователю!")
-        return
+    await add_product(state["new_name"], state["new_cat"], state["new_price"], state["new_desc"], filename)
+    await refresh_web_data()
+    await clear_admin(msg.from_user.id)
+    await msg.reply("✅ Товар добавлен!")
+
+@photo_mode("edit_photo")
+async def photo_edit_product(msg: types.Message, state):
+    pid = state.get("pid")
+    filename = await receive_photo(msg)
     
-    if mode == "order_message":
-        # Админ пишет клиенту по заказу
-        target_user = state.get("target_user")
-        order_id = state.get("order_id")
-        
-        # Обновляем статус заказа на in_progress
-        update_order_status(order_id, "in_progress")
-        
-        # Отправляем сообщение клиенту
-        try:
-            await bot.send_message(
-                target_user,
-                f"📦 Сообщение по вашему заказу #{order_id}:\n\n{msg.text}"
-            )
-        except:
-            pass
-        
-        clear_admin(uid)
-        await msg.answer("✅ Сообщение отправлено клиенту!")
+    await update_product_field(pid, "image", filename)
+    await refresh_web_data()
+    await clear_admin(msg.from_user.id)
+    await msg.reply(f"✅ Фото товара #{pid} обновлено!")
+
+@dp.message(F.document)
+async def handle_catalog_document(msg: types.Message):
+    if msg.from_user.id not in ADMIN_IDS:
         return
-    
-    # ========== ТОВАРЫ ==========
-    if mode == "add_name":
-        set_admin_state(uid, "new_name", msg.text)
-        set_admin_state(uid, "mode", "add_cat")
-        await msg.reply("📂 Введите категорию:")
+    document = msg.document
+    filename = document.file_name or ""
+    if not filename.lower().endswith((".csv", ".json")):
+        await msg.reply("⚠️ Для импорта каталога пришлите файл .csv или .json")
         return
-    
-    if mode == "add_cat":
-        set_admin_state(uid, "new_cat", msg.text)
-        set_admin_state(uid, "mode", "add_price")
-        await msg.reply("💰 Введите цену:")
+    if (document.file_size or 0) > CATALOG_IMPORT_MAX_BYTES:
+        await msg.reply("⚠️ Файл слишком большой (максимум 1 МБ)")
         return
     
-    if mode == "add_price":
-        try:
-            price = int(msg.text)
-            set_admin_state(uid, "new_price", price)
-            set_admin_state(uid, "mode", "add_desc")
-            await msg.reply("📝 Введите описание:")
-        except ValueError:
-            await msg.reply("❌ Цена должна быть числом!")
+    buffer = await bot.download(document, destination=io.BytesIO())
+    try:
+        rows, errors = parse_catalog_document(filename, buffer.getvalue())
+    except (ValueError, UnicodeDecodeError) as e:
+        await msg.reply(f"❌ Не удалось прочитать файл: {e}")
         return
     
-    if mode == "add_desc":
-        set_admin_state(uid, "new_desc", msg.text)
-        set_admin_state(uid, "mode", "add_photo")
-        await msg.reply("📷 Отправьте фото товара:")
+    updates, inserts, unchanged, plan_errors = await preview_catalog_import(rows)
+    text = format_import_preview(updates, inserts, unchanged, errors + plan_errors)
+    kb = InlineKeyboardBuilder()
+    if updates or inserts:
+        import_id = await save_pending_import(msg.from_user.id, rows)
+        await set_admin_state(msg.from_user.id, "import_id", import_id)
+        kb.button(text="✅ Применить", callback_data="import_apply")
+    kb.button(text="✖ Отмена", callback_data="import_cancel")
+    kb.adjust(2)
+    await msg.answer(text, reply_markup=kb.as_markup())
+
+@callback_route("import_apply")
+async def import_apply(call: types.CallbackQuery):
+    await call.answer()
+    import_id = (await get_admin(call.from_user.id)).get("import_id")
+    await set_admin_state(call.from_user.id, "import_id", None)
+    rows = await take_pending_import(import_id, call.from_user.id) if import_id else None
+    if not rows:
+        await call.message.edit_text("⚠️ Импорт устарел — пришлите файл ещё раз")
         return
-    
-    if mode == "edit_name":
-        pid = state.get("pid")
-        update_product_field(pid, "name", msg.text)
-        refresh_web_data()
-        clear_admin(uid)
-        await msg.reply(f"✅ Название товара #{pid} обновлено!")
+    updated, inserted, unchanged, errors = await apply_catalog_import(rows)
+    # Производные данные — один раз на весь импорт
+    await refresh_web_data()
+    asyncio.create_task(ingest_existing_images())
+    text = f"✅ Импорт применён: изменено {updated}, добавлено {inserted}, без изменений {unchanged}"
+    if errors:
+        text += f"\n⚠️ Пропущено: {len(errors)}"
+    await call.message.edit_text(text)
+
+@callback_route("import_cancel")
+async def import_cancel(call: types.CallbackQuery):
+    await call.answer()
+    import_id = (await get_admin(call.from_user.id)).get("import_id")
+    await set_admin_state(call.from_user.id, "import_id", None)
+    if import_id:
+        await take_pending_import(import_id, call.from_user.id)
+    await call.message.edit_text("✖ Импорт отменён")
+
+@callback_route("catalog_import")
+async def catalog_import(call: types.CallbackQuery):
+    await call.answer()
+    await call.message.answer(
+        "📥 Пришлите файл .csv или .json с колонками: id, name, category, price, description, image.\n"
+        "Строки без id сопоставляются по названию, пустые ячейки не меняют поле. "
+        "Перед применением покажу, что изменится."
+    )
+
+@dp.message(Command("export"))
+async def cmd_export(msg: types.Message):
+    if msg.from_user.id not in ADMIN_IDS:
+        await msg.reply("⛔ Доступ запрещён")
         return
-    
-    if mode == "edit_cat":
-        pid = state.get("pid")
-        update_product_field(pid, "category", msg.text)
-        refresh_web_data()
-        clear_admin(uid)
-        await msg.reply(f"✅ Категория товара #{pid} обновлена!")
+    fmt = "json" if "json" in (msg.text or "").lower() else "csv"
+    await send_catalog_export(msg.chat.id, fmt)
+
+@dp.message(Command("gc"))
+async def cmd_gc(msg: types.Message):
+    if msg.from_user.id not in ADMIN_IDS:
+        await msg.reply("⛔ Доступ запрещён")
         return
-    
-    if mode == "edit_price":
-        pid = state.get("pid")
-        try:
-            price = int(msg.text)
-            update_product_field(pid, "price", price)
-            refresh_web_data()
-            clear_admin(uid)
-            await msg.reply(f"✅ Цена товара #{pid} обновлена!")
-        except ValueError:
-            await msg.reply("❌ Цена должна быть числом!")
+    removed, reclaimed = await run_media_gc()
+    await msg.answer(f"🧹 Удалено файлов: {removed}\n💾 Освобождено: {reclaimed / 1024 / 1024:.1f} МБ")
+
+def format_sales_line(totals):
+    return f"{totals['orders']} зак. · {totals['revenue']} ₽ · {totals['weight']:g} кг"
+
+def format_sales_report(report):
+    totals = report["totals"]
+    lines = [
+        "📊 Продажи",
+        "",
+        f"Сегодня: {format_sales_line(totals['today'])}",
+        f"7 дней: {format_sales_line(totals['week'])}",
+        f"30 дней: {format_sales_line(totals['month'])}",
+        "",
+        "📅 По неделям:" if report["period"] == "week" else "📅 По дням:",
+    ]
+    for row in reversed(report["periods"]):
+        start = datetime.strptime(row["start"], "%Y-%m-%d").strftime("%d.%m")
+        lines.append(f"{start} — {format_sales_line(row)}")
+    if report["products"]:
+        lines += ["", "🏆 Товары:"]
+        for index, row in enumerate(report["products"], start=1):
+            lines.append(f"{index}. {row['name'] or 'Без названия'} — {format_sales_line(row)}")
+    if report["categories"]:
+        lines += ["", "📂 Категории:"]
+        for row in report["categories"]:
+            lines.append(f"• {row['category'] or 'Без категории'} — {format_sales_line(row)}")
+    return "\n".join(lines)
+
+@dp.message(Command("stats"))
+async def cmd_stats(msg: types.Message):
+    if msg.from_user.id not in ADMIN_IDS:
+        await msg.reply("⛔ Доступ запрещён")
         return
-    
-    if mode == "edit_desc":
-        pid = state.get("pid")
-        update_product_field(pid, "description", msg.text)
-        refresh_web_data()
-        clear_admin(uid)
-        await msg.reply(f"✅ Описание товара #{pid} обновлено!")
+    args = (msg.text or "").lower().split()[1:]
+    if "rebuild" in args:
+        count = await rebuild_sales_stats()
+        await msg.answer(f"♻️ Статистика пересчитана: выполненных заказов {count}")
         return
+    report = await get_sales_report("week", 8) if "week" in args else await get_sales_report("day", 7)
+    await msg.answer(format_sales_report(report))
 
-# --------------------------------
-# Обработчик фото
-# --------------------------------
-@dp.message(F.photo)
-async def handle_photo(msg: types.Message):
-    uid = msg.from_user.id
-    state = get_admin(uid)
-    mode = state.get("mode")
-    
-    if mode == "add_photo":
-        photo = msg.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        filename = f"{photo.file_id}.jpg"
-        dest = os.path.join(IMAGES_DIR, filename)
-        await bot.download_file(file.file_path, dest)
-        
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO products (name, category, price, description, image) VALUES (?,?,?,?,?)",
-            (state["new_name"], state["new_cat"], state["new_price"], state["new_desc"], filename)
-        )
-        conn.commit()
-        conn.close()
-        
-        refresh_web_data()
-        clear_admin(uid)
-        await msg.reply("✅ Товар добавлен!")
-        return
-    
-    if mode == "edit_photo":
-        pid = state.get("pid")
-        photo = msg.photo[-1]
-        file = await bot.get_file(photo.file_id)
-        filename = f"{photo.file_id}.jpg"
-        dest = os.path.join(IMAGES_DIR, filename)
-        await bot.download_file(file.file_path, dest)
-        
-        update_product_field(pid, "image", filename)
-        refresh_web_data()
-        clear_admin(uid)
-        await msg.reply(f"✅ Фото товара #{pid} обновлено!")
+@callback_route("catalog_export", str)
+async def catalog_export(call: types.CallbackQuery, fmt):
+    if call.from_user.id not in ADMIN_IDS:
+        await call.answer("⛔ Доступ запрещён", show_alert=True)
         return
+    await call.answer()
+    if fmt in ("csv", "json"):
+        await send_catalog_export(call.message.chat.id, fmt)
+
+async def send_catalog_export(chat_id, fmt):
+    path = await run_db(export_catalog, fmt)
+    try:
+        filename = f"catalog_{datetime.now().strftime('%Y%m%d_%H%M')}.{fmt}"
+        await bot.send_document(chat_id, types.FSInputFile(path, filename=filename))
+    finally:
+        os.remove(path)
 
-@dp.callback_query(F.data == "support_from_notification")
+@callback_route("support_from_notification")
 async def support_from_notification(call: types.CallbackQuery):
     await call.answer()
-    set_admin_state(call.from_user.id, "mode", "support_message")
+    await set_admin_state(call.from_user.id, "mode", "support_message")
     await call.message.answer("✍️ Напишите ваш ответ:")
 # --------------------------------
 # AIOHTTP web - API endpoints
 # --------------------------------
+# --------------------------------
+# Статика WebApp
+# --------------------------------
+# Файлы web/ (кроме images/) загружаются в память целиком вместе с
+# заранее сжатыми gzip/brotli версиями и ETag. В HTML ссылки вида
+# "/web/app.js?v=..." переписываются на хэш содержимого: такие запросы
+# кэшируются навсегда, а сам HTML — с обязательной ревалидацией.
+# Фоновая задача раз в STATIC_WATCH_INTERVAL секунд перечитывает
+# изменившиеся файлы.
+STATIC_WATCH_INTERVAL = float(os.getenv("STATIC_WATCH_INTERVAL", 5))
+STATIC_SKIP_DIRS = {"images"}
+CACHE_IMMUTABLE = "public, max-age=31536000, immutable"
+CACHE_REVALIDATE = "no-cache"
+WEB_DIR_REAL = os.path.realpath(WEB_DIR)
+ASSET_VERSION_RE = re.compile(r"""(["'])/(?:web|shop)/([^"'?#]+)\?v=[^"'#]*\1""")
+
+static_assets = {}
+static_state = {"signature": None}
+
+def resolve_web_path(base, path):
+    """Абсолютный путь внутри base или None, если путь выходит за его пределы"""
+    full = os.path.realpath(os.path.join(base, path))
+    if full != base and not full.startswith(base + os.sep):
+        return None
+    return full
+
+def scan_web_dir():
+    """{относительный путь: (полный путь, mtime, размер)} для кэшируемых файлов"""
+    files = {}
+    for root, dirs, names in os.walk(WEB_DIR_REAL):
+        if root == WEB_DIR_REAL:
+            dirs[:] = [d for d in dirs if d not in STATIC_SKIP_DIRS]
+        for name in names:
+            if name.endswith(".tmp"):
+                continue
+            full = os.path.join(root, name)
+            st = os.stat(full)
+            rel = os.path.relpath(full, WEB_DIR_REAL).replace(os.sep, "/")
+            files[rel] = (full, st.st_mtime_ns, st.st_size)
+    return files
+
+def compress_asset(body):
+    gz = gzip.compress(body, compresslevel=9)
+    br = brotli.compress(body, quality=11) if brotli else None
+    # Сжатие без заметного выигрыша (картинки и т.п.) не храним
+    return (gz if len(gz) < len(body) * 0.9 else None,
+            br if br and len(br) < len(body) * 0.9 else None)
+
+def make_asset(rel, body):
+    content_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+    gz, br = compress_asset(body)
+    return {
+        "body": body,
+        "gzip": gz,
+        "br": br,
+        "etag": f'"{hashlib.sha1(body).hexdigest()[:20]}"',
+        "content_type": content_type,
+        "charset": "utf-8" if content_type.startswith("text/") or content_type.endswith(("javascript", "json")) else None,
+    }
+
+def load_static_assets(files):
+    assets = {}
+    for rel, (full, _, _) in files.items():
+        with open(full, "rb") as f:
+            assets[rel] = make_asset(rel, f.read())
+
+    def versioned(match):
+        quote, rel = match.group(1), match.group(2)
+        asset = assets.get(rel)
+        if not asset:
+            return match.group(0)
+        return f"{quote}/web/{rel}?v={asset['etag'].strip(chr(34))[:12]}{quote}"
+
+    for rel in [r for r, a in assets.items() if a["content_type"] == "text/html"]:
+        html = assets[rel]["body"].decode("utf-8")
+        assets[rel] = make_asset(rel, ASSET_VERSION_RE.sub(versioned, html).encode("utf-8"))
+    return assets
+
+def reload_static_assets():
+    files = scan_web_dir()
+    signature = tuple(sorted((rel, mtime, size) for rel, (_, mtime, size) in files.items()))
+    if signature == static_state["signature"]:
+        return False
+    static_assets.clear()
+    static_assets.update(load_static_assets(files))
+    static_state["signature"] = signature
+    return True
+
+async def watch_static_assets():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(STATIC_WATCH_INTERVAL)
+        try:
+            if await loop.run_in_executor(media_executor, reload_static_assets):
+                print("🔄 Статика WebApp перезагружена")
+        except Exception as e:
+            print(f"⚠️ Ошибка перезагрузки статики: {e}")
+
+def asset_response(request, asset, cache_control):
+    headers = {"ETag": asset["etag"], "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if etag_matches(request, asset["etag"]):
+        return web.Response(status=304, headers=headers)
+    body = asset["body"]
+    accept = request.headers.get("Accept-Encoding", "")
+    if asset["br"] and "br" in accept:
+        body = asset["br"]
+        headers["Content-Encoding"] = "br"
+    elif asset["gzip"] and "gzip" in accept:
+        body = asset["gzip"]
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(body=body, content_type=asset["content_type"], charset=asset["charset"], headers=headers)
+
 async def index(request):
-    return web.FileResponse(os.path.join(WEB_DIR, 'index.html'))
+    return asset_response(request, static_assets["index.html"], CACHE_REVALIDATE)
 
 async def static_handler(request):
-    path = request.match_info.get("path")
-    full = os.path.join(WEB_DIR, path)
+    path = request.match_info.get("path", "")
+    full = resolve_web_path(WEB_DIR_REAL, path)
+    if full is None:
+        return web.Response(status=404, text="Not found")
+    rel = os.path.relpath(full, WEB_DIR_REAL).replace(os.sep, "/")
+    asset = static_assets.get(rel)
+    if asset:
+        versioned = request.query.get("v") == asset["etag"].strip('"')[:12]
+        return asset_response(request, asset, CACHE_IMMUTABLE if versioned else CACHE_REVALIDATE)
     if os.path.isfile(full):
-        return web.FileResponse(full)
+        return web.FileResponse(full, headers={"Cache-Control": "public, max-age=86400"})
     return web.Response(status=404, text="Not found")
 
+async def derived_image_handler(request):
+    # Имена копий содержат хэш содержимого — файл по имени никогда не меняется
+    full = resolve_web_path(os.path.realpath(DERIVED_DIR), request.match_info.get("name", ""))
+    if full is None or not os.path.isfile(full):
+        return web.Response(status=404, text="Not found")
+    return web.FileResponse(full, headers={"Cache-Control": CACHE_IMMUTABLE})
+
+def etag_matches(request, etag):
+    """Проверка If-None-Match (поддерживает список и слабые ETag)"""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+CATALOG_QUERY_PARAMS = ("category", "q", "sort", "limit", "cursor")
+
+async def select_catalog_page(snapshot, query):
+    """Страница каталога по параметрам запроса; ValueError — неверный параметр"""
+    text = query.get("q", "").strip()
+    sort = query.get("sort") or ("relevance" if text else "default")
+    if sort not in CATALOG_SORTS and not (sort == "relevance" and text):
+        raise ValueError(f"unknown sort: {sort}")
+    category = query.get("category", "")
+    limit = min(max(int(query.get("limit", CATALOG_PAGE_SIZE)), 1), CATALOG_PAGE_MAX)
+    cursor = query.get("cursor")
+
+    if text:
+        by_id = snapshot["prices"]
+        ids = [pid for pid in await search_product_ids(text) if pid in by_id]
+        found = set(ids)
+        if sort == "relevance":
+            order = {pid: i for i, pid in enumerate(ids)}
+            items = sorted((p for p in snapshot["items"] if p["id"] in found), key=lambda p: order[p["id"]])
+        else:
+            items = [p for p in snapshot["views"][(sort, "")]["items"] if p["id"] in found]
+        if category:
+            items = [p for p in items if p["category"] == category]
+        view = catalog_view(items)
+    else:
+        view = snapshot["views"].get((sort, category)) or catalog_view([])
+
+    start = 0
+    if cursor:
+        position = view["positions"].get(int(cursor))
+        if position is None:
+            raise ValueError("stale cursor")
+        start = position + 1
+    page = view["items"][start:start + limit]
+    has_more = start + limit < len(view["items"])
+    return {
+        "items": page,
+        "total": len(view["items"]),
+        "next_cursor": page[-1]["id"] if has_more else None,
+        "categories": snapshot["categories"],
+    }
+
 async def api_products(request):
-    refresh_web_data()
-    with open(DATA_JSON, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    print(f"📡 API /api/products вернул {len(data)} товаров")
-    return web.json_response(data)
+    snapshot = await get_catalog_snapshot()
+    if any(name in request.query for name in CATALOG_QUERY_PARAMS):
+        return await api_products_page(request, snapshot)
+    headers = {
+        "ETag": snapshot["etag"],
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding",
+    }
+    if etag_matches(request, snapshot["etag"]):
+        return web.Response(status=304, headers=headers)
+
+    body = snapshot["body"]
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        body = snapshot["gzip_body"]
+        headers["Content-Encoding"] = "gzip"
+    return web.Response(body=body, content_type="application/json", charset="utf-8", headers=headers)
+
+async def api_products_page(request, snapshot):
+    """Постраничная выдача: фильтр по категории, поиск, сортировка.
+    ETag — от версии снимка и параметров, поэтому повторный запрос той же
+    страницы без изменений каталога отвечает 304"""
+    query_hash = hashlib.sha1(request.query_string.encode("utf-8")).hexdigest()[:8]
+    etag = f'"{snapshot["etag"][1:-1]}-{query_hash}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return web.Response(status=304, headers=headers)
+    try:
+        result = await select_catalog_page(snapshot, request.query)
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    return web.json_response(result, headers=headers, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
 
 async def api_support_send(request):
     """Отправка сообщения в поддержку из WebApp"""
@@ -898,23 +3892,18 @@ async def api_support_send(request):
             return web.json_response({"error": "Missing data"}, status=400)
         
         # Сохраняем в БД
-        save_support_message(user_id, username, message, from_admin=0)
+        await save_support_message(user_id, username, message, from_admin=0)
         
         # Уведомляем админов
-        for admin_id in ADMIN_IDS:
-            try:
-                kb = InlineKeyboardBuilder()
-                kb.button(text="✍️ Ответить", callback_data=f"support_reply_{user_id}")
-                
-                await bot.send_message(
-                    admin_id,
-                    f"💬 Новое сообщение в поддержку (из WebApp)!\n\n"
-                    f"От: @{username}\n"
-                    f"Сообщение: {message}",
-                    reply_markup=kb.as_markup()
-                )
-            except:
-                pass
+        kb = InlineKeyboardBuilder()
+        kb.button(text="✍️ Ответить", callback_data=f"support_reply_{user_id}")
+        await notify_admins(
+            f"💬 Новое сообщение в поддержку (из WebApp)!\n\n"
+            f"От: @{username}\n"
+            f"Сообщение: {message}",
+            reply_markup=kb.as_markup(),
+            coalesce_key=f"support_{user_id}"
+        )
         
         return web.json_response({"success": True})
     
@@ -926,22 +3915,74 @@ async def api_support_history(request):
     """Получить историю сообщений пользователя"""
     try:
         user_id = int(request.query.get("user_id"))
-        messages = get_user_support_messages(user_id)
+        before_id = request.query.get("before_id")
+        since_id = request.query.get("since_id")
+        limit = min(max(int(request.query.get("limit", 50)), 1), 100)
+        messages, has_more = await get_support_messages_window(
+            user_id,
+            before_id=int(before_id) if before_id else None,
+            since_id=int(since_id) if since_id else None,
+            limit=limit
+        )
         
         result = []
-        for message, timestamp, from_admin in messages:
+        for message_id, message, timestamp, from_admin in messages:
             result.append({
+                "id": message_id,
                 "message": message,
                 "timestamp": timestamp,
                 "from_admin": bool(from_admin)
             })
         
-        return web.json_response({"messages": result})
+        return web.json_response({"messages": result, "has_more": has_more})
     
     except Exception as e:
         print(f"❌ Ошибка API support/history: {e}")
         return web.json_response({"error": str(e)}, status=500)
 
+async def api_events(request):
+    """Поток push-событий (Server-Sent Events)"""
+    topics = {"catalog"}
+    init_data = request.query.get("init_data")
+    if init_data:
+        user_id = verify_init_data(init_data)
+        if user_id is None:
+            return web.json_response({"error": "bad init_data"}, status=403)
+        topics.add(f"user:{user_id}")
+    if push_hub.clients >= PUSH_MAX_CLIENTS:
+        return web.Response(status=503, headers={"Retry-After": "30"})
+    last_event_id = request.headers.get("Last-Event-ID") or request.query.get("last_event_id")
+    
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    await response.prepare(request)
+    sub, missed = push_hub.subscribe(topics, last_event_id)
+    try:
+        await response.write(b"retry: 3000\n\n")
+        if missed is None:
+            await response.write(format_sse(push_hub.event_id(push_hub.seq), "reset", {}))
+        else:
+            for seq, _, event, data in missed:
+                await response.write(format_sse(push_hub.event_id(seq), event, data))
+        while True:
+            try:
+                message = await asyncio.wait_for(sub.queue.get(), PUSH_HEARTBEAT)
+            except asyncio.TimeoutError:
+                await response.write(b": ping\n\n")
+                continue
+            if message is None:
+                break
+            seq, _, event, data = message
+            await response.write(format_sse(push_hub.event_id(seq), event, data))
+    except ConnectionResetError:
+        pass
+    finally:
+        push_hub.unsubscribe(sub)
+    return response
+
 async def api_order_create(request):
     """Создание заказа из WebApp"""
     try:
@@ -949,13 +3990,17 @@ async def api_order_create(request):
         user_id = data.get("user_id")
         username = data.get("username", "неизвестен")
         cart = data.get("cart", [])
-        total_price = data.get("total_price", 0)
         
         if not user_id or not cart:
             return web.json_response({"error": "Missing data"}, status=400)
         
+        # Цены и итог считаются на сервере, присланные клиентом не используются
+        cart, total_price, errors = quote_cart(cart, await get_catalog_snapshot())
+        if errors:
+            return web.json_response({"error": "Invalid cart", "errors": errors}, status=400)
+        
         # Создаём заказ
-        order_id = create_order(user_id, username, cart, total_price)
+        order_id = await create_order(user_id, username, cart, total_price)
         
         # Уведомляем админов
         order_text = f"📦 Новый заказ #{order_id}!\n\n"
@@ -967,64 +4012,576 @@ async def api_order_create(request):
         
         order_text += f"\n💰 Итого: {total_price} ₽"
         
-        for admin_id in ADMIN_IDS:
-            try:
-                kb = InlineKeyboardBuilder()
-                kb.button(text="📋 Посмотреть заказ", callback_data=f"order_view_{order_id}")
-                
-                await bot.send_message(admin_id, order_text, reply_markup=kb.as_markup())
-            except:
-                pass
+        kb = InlineKeyboardBuilder()
+        kb.button(text="📋 Посмотреть заказ", callback_data=f"order_view_{order_id}")
+        await notify_admins(order_text, reply_markup=kb.as_markup())
         
-        return web.json_response({"success": True, "order_id": order_id})
+        return web.json_response({"success": True, "order_id": order_id, "total_price": total_price})
     
     except Exception as e:
         print(f"❌ Ошибка API order/create: {e}")
         return web.json_response({"error": str(e)}, status=500)
 
+async def api_cart_quote(request):
+    """Расчёт корзины по серверным ценам"""
+    try:
+        data = await request.json()
+        snapshot = await get_catalog_snapshot()
+        lines, total_price, errors = quote_cart(data.get("cart", []), snapshot)
+        return web.json_response({
+            "items": lines,
+            "total_price": total_price,
+            "errors": errors,
+            "catalog_version": snapshot["built_version"]
+        })
+    
+    except Exception as e:
+        print(f"❌ Ошибка API cart/quote: {e}")
+        return web.json_response({"error": str(e)}, status=500)
+
 async def api_profile(request):
     """Получить данные профиля пользователя"""
     try:
         user_id = int(request.query.get("user_id"))
         username = request.query.get("username", "неизвестен")
         
-        # Получаем историю покупок
-        purchases = get_user_purchases(user_id)
+        before = request.query.get("before")
+        limit = min(max(int(request.query.get("limit", 20)), 1), 50)
+        
+        # Получаем историю покупок (страница)
+        purchases, has_more = await get_profile_page(user_id, int(before) if before else None, limit)
         
         result = {
             "username": username,
-            "purchases": []
+            "purchases": purchases,
+            "has_more": has_more,
+            "next_before": purchases[-1]["id"] if has_more else None
         }
         
-        for products_json, total_price, timestamp in purchases:
-            products = json.loads(products_json)
-            result["purchases"].append({
-                "products": products,
-                "total_price": total_price,
-                "timestamp": timestamp
-            })
-        
         return web.json_response(result)
     
     except Exception as e:
         print(f"❌ Ошибка API profile: {e}")
         return web.json_response({"error": str(e)}, status=500)
 
+# --------------------------------
+# Приём webhook
+# --------------------------------
+# Telegram получает 200 сразу после постановки апдейта в очередь, сама
+# обработка идёт в пуле воркеров. Апдейты одного чата всегда попадают в
+# одну очередь, поэтому обрабатываются строго по порядку. Повторные
+# доставки отсекаются по окну последних update_id. Лимит WEBHOOK_QUEUE_SIZE
+# общий на все очереди (один активный чат может занять его целиком, а не
+# 1/WEBHOOK_WORKERS); при переполнении отвечаем 503 — Telegram повторит
+# доставку позже.
+WEBHOOK_DEDUP_WINDOW = 10000
+
+webhook_queues = []
+webhook_tasks = []
+webhook_load = {"pending": 0}  # принято и ещё не обработано, по всем очередям
+webhook_capacity = asyncio.Event()
+webhook_seen_ids = set()
+webhook_seen_order = deque()
+webhook_stats = {"received": 0, "duplicates": 0, "rejected": 0, "processed": 0, "failed": 0}
+
+def try_enqueue_update(update):
+    if webhook_load["pending"] >= WEBHOOK_QUEUE_SIZE:
+        return False
+    webhook_load["pending"] += 1
+    webhook_queues[update_chat_key(update) % len(webhook_queues)].put_nowait(update)
+    return True
+
+def remember_update_id(update_id):
+    webhook_seen_ids.add(update_id)
+    webhook_seen_order.append(update_id)
+    if len(webhook_seen_order) > WEBHOOK_DEDUP_WINDOW:
+        webhook_seen_ids.discard(webhook_seen_order.popleft())
+
+def update_chat_key(update):
+    """Ключ упорядочивания: чат (или пользователь), иначе сам update_id"""
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    event = update.event
+    user = getattr(event, "from_user", None)
+    return user.id if user else update.update_id
+
+async def webhook_worker(queue):
+    while True:
+        update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+            webhook_stats["processed"] += 1
+        except Exception as e:
+            webhook_stats["failed"] += 1
+            print(f"❌ Ошибка обработки апдейта {update.update_id}: {e}")
+        finally:
+            webhook_load["pending"] -= 1
+            webhook_capacity.set()
+            queue.task_done()
+
+def get_webhook_queue_stats():
+    depths = [q.qsize() for q in webhook_queues]
+    return {
+        **webhook_stats,
+        "workers": len(webhook_queues),
+        "queue_depth": sum(depths),
+        "queue_max_depth": max(depths, default=0),
+        "queue_capacity": WEBHOOK_QUEUE_SIZE if webhook_queues else 0,
+    }
+
+# В многопроцессном режиме апдейт может прийти в любой воркер. Чтобы
+# порядок по чату, защита от повторов и состояние диалогов оставались в
+# одном месте, воркер только складывает апдейт в webhook_inbox, а
+# обрабатывает его воркер 0 через те же очереди.
+WEBHOOK_INBOX_BATCH = 200
+# Пустой inbox проверяется обычным чтением, блокировка записи берётся
+# только под непустую пачку. Пока апдейтов нет, интервал опроса растёт
+# от WEBHOOK_INBOX_POLL до WEBHOOK_INBOX_POLL_MAX; апдейт, принятый
+# самим воркером 0, будит читателя сразу
+WEBHOOK_INBOX_POLL = 0.02
+WEBHOOK_INBOX_POLL_MAX = float(os.getenv("WEBHOOK_INBOX_POLL_MAX", 0.25))
+webhook_inbox_wakeup = asyncio.Event()
+
+@db_task
+def put_webhook_inbox(update_id, body):
+    conn = get_conn()
+    cur = conn.execute(
+        "INSERT OR IGNORE INTO webhook_inbox (update_id, body, received_at) VALUES (?,?,?)",
+        (update_id, body, time.time())
+    )
+    conn.commit()
+    return cur.rowcount > 0
+
+@db_task
+def take_webhook_inbox(limit):
+    conn = get_conn()
+    if conn.execute("SELECT 1 FROM webhook_inbox LIMIT 1").fetchone() is None:
+        return []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT update_id, body FROM webhook_inbox ORDER BY update_id LIMIT ?", (limit,)
+        ).fetchall()
+        if rows:
+            conn.execute("DELETE FROM webhook_inbox WHERE update_id <= ?", (rows[-1][0],))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return rows
+
+async def webhook_inbox_reader():
+    delay = WEBHOOK_INBOX_POLL
+    while True:
+        try:
+            rows = await take_webhook_inbox(WEBHOOK_INBOX_BATCH)
+        except Exception as e:
+            print(f"❌ Ошибка чтения webhook_inbox: {e}")
+            rows = []
+        if not rows:
+            try:
+                await asyncio.wait_for(webhook_inbox_wakeup.wait(), delay)
+                delay = WEBHOOK_INBOX_POLL
+            except asyncio.TimeoutError:
+                delay = min(delay * 2, WEBHOOK_INBOX_POLL_MAX)
+            webhook_inbox_wakeup.clear()
+            continue
+        delay = WEBHOOK_INBOX_POLL
+        for update_id, body in rows:
+            if update_id in webhook_seen_ids:
+                webhook_stats["duplicates"] += 1
+                continue
+            try:
+                update = types.Update.model_validate_json(body, context={"bot": bot})
+            except Exception as e:
+                print(f"❌ Некорректный апдейт {update_id} в webhook_inbox: {e}")
+                continue
+            remember_update_id(update_id)
+            # Ждём место в очереди: апдейты подождут в БД
+            while not try_enqueue_update(update):
+                webhook_capacity.clear()
+                await webhook_capacity.wait()
+
 async def webhook_handler(request):
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=401)
     try:
-        update_dict = await request.json()
-        update = types.Update(**update_dict)
+        body = await request.text()
+        update = types.Update.model_validate_json(body, context={"bot": bot})
+    except Exception as e:
+        print(f"❌ Некорректный webhook: {e}")
+        return web.Response(status=400)
+
+    webhook_stats["received"] += 1
+    if MULTI_PROCESS:
+        if not await put_webhook_inbox(update.update_id, body):
+            webhook_stats["duplicates"] += 1
+        elif IS_UPDATE_OWNER:
+            webhook_inbox_wakeup.set()
+        return web.Response(status=200)
+
+    if update.update_id in webhook_seen_ids:
+        webhook_stats["duplicates"] += 1
+        return web.Response(status=200)
+
+    if not webhook_queues:
+        # Пул не запущен (например, приложение поднято без on_startup)
         await dp.feed_update(bot, update)
+        remember_update_id(update.update_id)
         return web.Response(status=200)
+
+    if not try_enqueue_update(update):
+        webhook_stats["rejected"] += 1
+        return web.Response(status=503, headers={"Retry-After": "1"})
+    remember_update_id(update.update_id)
+    return web.Response(status=200)
+
+async def api_sales_stats(request):
+    """Отчёт о продажах (как /stats). Доступ по STATS_TOKEN"""
+    if not STATS_TOKEN or not hmac.compare_digest(request.query.get("token", ""), STATS_TOKEN):
+        return web.json_response({"error": "forbidden"}, status=403)
+    try:
+        report = await get_sales_report(request.query.get("period", "day"), request.query.get("count", 7))
+    except ValueError as e:
+        return web.json_response({"error": str(e)}, status=400)
+    return web.json_response(report)
+
+async def api_webhook_stats(request):
+    return web.json_response(get_webhook_queue_stats())
+
+def render_metrics():
+    lines = []
+    name = "shop_http_request_duration_seconds"
+    metric_header(lines, name, "histogram", "Время обработки HTTP-запросов по маршрутам")
+    for route, stats in list(http_metrics.items()):
+        render_histogram(lines, name, stats, route=route)
+    name = "shop_http_responses_total"
+    metric_header(lines, name, "counter", "Ответы HTTP по маршрутам и классам статуса")
+    for route, stats in list(http_metrics.items()):
+        for index, count in enumerate(stats.statuses):
+            if count:
+                lines.append(f"{name}{metric_labels(route=route, status=f'{index}xx')} {count}")
+    name = "shop_rate_limited_total"
+    metric_header(lines, name, "counter", "Отказы ограничителя частоты по маршруту и причине (ip, user, busy)")
+    for (route, reason), count in list(rate_limit_stats.items()):
+        lines.append(f"{name}{metric_labels(route=route, reason=reason)} {count}")
+    metric_header(lines, "shop_rate_limit_buckets", "gauge", "Корзин токенов ограничителя в памяти")
+    lines.append(f"shop_rate_limit_buckets {len(rate_buckets)}")
+
+    name = "shop_handler_duration_seconds"
+    metric_header(lines, name, "histogram", "Время обработчиков aiogram по обработчику и режиму диалога")
+    for handler, by_mode in list(handler_metrics.items()):
+        for mode, hist in list(by_mode.items()):
+            render_histogram(lines, name, hist, handler=handler, mode=mode)
+    name = "shop_handler_errors_total"
+    metric_header(lines, name, "counter", "Исключения в обработчиках aiogram")
+    for handler, by_mode in list(handler_metrics.items()):
+        for mode, hist in list(by_mode.items()):
+            lines.append(f"{name}{metric_labels(handler=handler, mode=mode)} {hist.errors}")
+
+    # Гистограммы БД обновляются из потоков пула — читаем под той же блокировкой
+    with metrics_lock:
+        name = "shop_db_query_duration_seconds"
+        metric_header(lines, name, "histogram", "Время функций БД в пуле потоков")
+        for func, hist in db_metrics.items():
+            render_histogram(lines, name, hist, func=func)
+        name = "shop_db_query_errors_total"
+        metric_header(lines, name, "counter", "Исключения в функциях БД")
+        for func, hist in db_metrics.items():
+            lines.append(f"{name}{metric_labels(func=func)} {hist.errors}")
+
+    name = "shop_bot_api_duration_seconds"
+    metric_header(lines, name, "histogram", "Время исходящих вызовов Bot API")
+    for method, hist in list(bot_api_metrics.items()):
+        render_histogram(lines, name, hist, method=method)
+    name = "shop_bot_api_errors_total"
+    metric_header(lines, name, "counter", "Ошибки вызовов Bot API по методам")
+    for method, hist in list(bot_api_metrics.items()):
+        lines.append(f"{name}{metric_labels(method=method)} {hist.errors}")
+    name = "shop_bot_api_error_kinds_total"
+    metric_header(lines, name, "counter", "Ошибки вызовов Bot API по типу исключения")
+    for kind, count in list(bot_api_errors.items()):
+        lines.append(f"{name}{metric_labels(error=kind)} {count}")
+
+    queue_stats = get_webhook_queue_stats()
+    name = "shop_webhook_updates_total"
+    metric_header(lines, name, "counter", "Апдейты webhook по результату")
+    for result in ("received", "duplicates", "rejected", "processed", "failed"):
+        lines.append(f"{name}{metric_labels(result=result)} {queue_stats[result]}")
+    for key, help_text in (("queue_depth", "Апдейтов в очередях webhook"),
+                           ("queue_max_depth", "Длина самой загруженной очереди webhook"),
+                           ("queue_capacity", "Суммарная ёмкость очередей webhook")):
+        metric_header(lines, f"shop_webhook_{key}", "gauge", help_text)
+        lines.append(f"shop_webhook_{key} {queue_stats[key]}")
+
+    name = "shop_outbox_messages_total"
+    metric_header(lines, name, "counter", "Уведомления админам по результату доставки")
+    for result in ("sent", "failed"):
+        lines.append(f"{name}{metric_labels(result=result)} {outbox_state[result]}")
+
+    name = "shop_push_events_total"
+    metric_header(lines, name, "counter", "Push-события: опубликовано, доставлено, отключено по переполнению")
+    for result in ("published", "delivered", "overflows"):
+        lines.append(f"{name}{metric_labels(result=result)} {push_hub.stats[result]}")
+    metric_header(lines, "shop_push_clients", "gauge", "Подключённых клиентов push-событий")
+    lines.append(f"shop_push_clients {push_hub.clients}")
+
+    name = "shop_media_files_total"
+    metric_header(lines, name, "counter", "Фото из Telegram: скачано, взято из хранилища, совпало по хэшу, ошибки")
+    for result in ("downloaded", "reused", "deduplicated", "failed"):
+        lines.append(f"{name}{metric_labels(result=result)} {media_stats[result]}")
+    metric_header(lines, "shop_media_gc_files_total", "counter", "Файлов удалено сборщиком фото")
+    lines.append(f"shop_media_gc_files_total {media_stats['gc_files']}")
+    metric_header(lines, "shop_media_gc_bytes_total", "counter", "Байт освобождено сборщиком фото")
+    lines.append(f"shop_media_gc_bytes_total {media_stats['gc_bytes']}")
+
+    name = "shop_archived_total"
+    metric_header(lines, name, "counter", "Перенесено в архивную БД")
+    for kind in ("orders", "support_threads"):
+        lines.append(f"{name}{metric_labels(kind=kind)} {retention_stats[kind]}")
+    metric_header(lines, "shop_vacuum_pages_total", "counter", "Страниц БД возвращено incremental_vacuum")
+    lines.append(f"shop_vacuum_pages_total {retention_stats['vacuum_pages']}")
+
+    name = "shop_event_loop_lag_seconds"
+    metric_header(lines, name, "histogram", "Опоздание event loop относительно таймера")
+    render_histogram(lines, name, loop_lag)
+    metric_header(lines, "shop_event_loop_lag_last_seconds", "gauge", "Последнее измеренное опоздание event loop")
+    lines.append(f"shop_event_loop_lag_last_seconds {loop_lag_state['last']}")
+    return "\n".join(lines) + "\n"
+
+async def metrics_handler(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-store"})
+
+# --------------------------------
+# Ограничение частоты запросов WebApp
+# --------------------------------
+# Публичные POST-маршруты пишут в БД и будят админов, поэтому у каждого
+# свои корзины токенов: по user_id (из тела или query) и по IP клиента.
+# Лимит (запросов в секунду, запас) задаётся на маршрут, RATE_LIMITS в
+# окружении (JSON) дополняет или меняет значения по умолчанию. Кроме
+# частоты ограничено число одновременных запросов маршрута: при
+# переполнении — 503, чтобы очередь к пулу БД не росла без конца.
+# Отказы — 429/503 с Retry-After. Корзины хранятся в LRU; при
+# переполнении сначала удаляются полные (неотличимые от новых), затем
+# самые старые. Счётчики у каждого процесса свои: при WORKER_PROCESSES > 1
+# клиент, попадающий в разные процессы, получает лимит на каждый.
+RATE_LIMITS = {
+    "/api/support/send": {"user": (1 / 3, 5), "ip": (1, 20), "concurrency": 32},
+    "/api/order/create": {"user": (0.1, 3), "ip": (0.5, 10), "concurrency": 32},
+    "/api/cart/quote": {"ip": (10, 40)},
+}
+for route, limits in json.loads(os.getenv("RATE_LIMITS", "{}")).items():
+    RATE_LIMITS.setdefault(route, {}).update({
+        kind: tuple(value) if isinstance(value, list) else value for kind, value in limits.items()
+    })
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", 20000))
+# За сколькими прокси стоит сервер: адрес клиента — N-й справа в
+# X-Forwarded-For (левые значения подделываются клиентом). На Render — 1
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 1 if os.getenv("RENDER") else 0))
+
+rate_buckets = OrderedDict()  # (route, kind, key) -> TokenBucket
+rate_inflight = {}
+rate_limit_stats = {}  # (route, reason) -> отказов
+
+def client_ip(request):
+    if TRUSTED_PROXY_HOPS:
+        hops = [h.strip() for h in request.headers.get("X-Forwarded-For", "").split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.remote or ""
+
+async def request_user_id(request):
+    """user_id из query или JSON-тела (тело aiohttp кэширует, обработчик прочитает его снова)"""
+    value = request.query.get("user_id")
+    if value is None and request.can_read_body:
+        try:
+            data = await request.json()
+        except ValueError:
+            return None
+        value = data.get("user_id") if isinstance(data, dict) else None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def evict_rate_buckets(now):
+    for key in [k for k, b in rate_buckets.items() if b.is_idle(now)]:
+        del rate_buckets[key]
+    # С запасом, чтобы полный проход не повторялся на каждом новом ключе
+    while len(rate_buckets) > RATE_LIMIT_MAX_BUCKETS * 0.9:
+        rate_buckets.popitem(last=False)
+
+def take_rate_token(route, kind, key, now):
+    rate, capacity = RATE_LIMITS[route][kind]
+    bucket = rate_buckets.get((route, kind, key))
+    if bucket is None:
+        if len(rate_buckets) >= RATE_LIMIT_MAX_BUCKETS:
+            evict_rate_buckets(now)
+        bucket = rate_buckets[(route, kind, key)] = TokenBucket(rate, capacity)
+    else:
+        rate_buckets.move_to_end((route, kind, key))
+    return bucket.take(now)
+
+def rate_limited(route, reason, wait, status=429):
+    rate_limit_stats[(route, reason)] = rate_limit_stats.get((route, reason), 0) + 1
+    retry_after = max(1, math.ceil(wait))
+    return web.json_response(
+        {"error": "Too many requests", "retry_after": retry_after},
+        status=status, headers={"Retry-After": str(retry_after)}
+    )
+
+@web.middleware
+async def rate_limit_middleware(request, handler):
+    limits = RATE_LIMITS.get(request.path)
+    if limits is None:
+        return await handler(request)
+    route = request.path
+    now = time.monotonic()
+    if "ip" in limits:
+        wait = take_rate_token(route, "ip", client_ip(request), now)
+        if wait:
+            return rate_limited(route, "ip", wait)
+    if "user" in limits:
+        user_id = await request_user_id(request)
+        if user_id is not None:
+            wait = take_rate_token(route, "user", user_id, now)
+            if wait:
+                return rate_limited(route, "user", wait)
+    concurrency = limits.get("concurrency")
+    if concurrency and rate_inflight.get(route, 0) >= concurrency:
+        return rate_limited(route, "busy", 1, status=503)
+    rate_inflight[route] = rate_inflight.get(route, 0) + 1
+    try:
+        return await handler(request)
+    finally:
+        rate_inflight[route] -= 1
+
+# --------------------------------
+# Старт и готовность
+# --------------------------------
+# Порт занимается сразу, а миграции, прогрев каталога и статики и
+# проверка webhook идут в фоне. /healthz отвечает, пока процесс жив,
+# /readyz — только после прогрева; до этого остальные запросы получают
+# 503 с Retry-After (Telegram повторит доставку апдейтов сам).
+startup_state = {"ready": False, "stage": "import", "timings": {}, "error": None}
+HEALTH_ROUTES = ("/healthz", "/readyz")
+
+async def startup_stage(name, func, *args):
+    startup_state["stage"] = name
+    t0 = time.perf_counter()
+    try:
+        return await func(*args)
+    finally:
+        startup_state["timings"][name] = round(time.perf_counter() - t0, 3)
+
+async def ensure_webhook():
+    """Регистрирует webhook, если Telegram знает другой URL или сменился секрет.
+    getWebhookInfo секрет не возвращает, поэтому отпечаток (URL, секрет)
+    последней регистрации хранится в app_meta"""
+    webhook_url = f"{RENDER_EXTERNAL_URL}/webhook/{BOT_TOKEN}"
+    fingerprint = hashlib.sha256(f"{webhook_url}\n{WEBHOOK_SECRET}".encode("utf-8")).hexdigest()
+    info = await bot.get_webhook_info()
+    if (info.url == webhook_url and not WEBHOOK_FORCE_SET
+            and await get_app_meta("webhook_fingerprint") == fingerprint):
+        print(f"✅ Webhook уже установлен, ожидающих апдейтов: {info.pending_update_count}")
+        return
+    print(f"\n🔄 Установка webhook: {RENDER_EXTERNAL_URL}/webhook/…")
+    await bot.set_webhook(
+        webhook_url,
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=WEBHOOK_DROP_PENDING
+    )
+    await set_app_meta("webhook_fingerprint", fingerprint)
+    print("✅ Webhook установлен")
+
+async def warm_up(app):
+    loop = asyncio.get_running_loop()
+    try:
+        await startup_stage("migrations", run_db, init_db)
+        await startup_stage("seed", run_db, seed_database_from_json)
+        await startup_stage("static", loop.run_in_executor, media_executor, reload_static_assets)
+        await startup_stage("catalog", refresh_web_data)
+        # В многопроцессном режиме webhook проверяет супервизор
+        if not WORKER_INDEX:
+            try:
+                await startup_stage("webhook", ensure_webhook)
+            except Exception as e:
+                print(f"⚠️ Не удалось проверить webhook: {e}")
+        start_workers(app)
     except Exception as e:
-        print(f"❌ Ошибка обработки webhook: {e}")
-        return web.Response(status=500)
+        startup_state["error"] = str(e)
+        print(f"❌ Ошибка при старте ({startup_state['stage']}): {e}")
+        return
+    startup_state["timings"]["total"] = round(time.perf_counter() - BOOT_STARTED, 3)
+    startup_state["stage"] = "ready"
+    startup_state["ready"] = True
+    print("✅ Готов к работе, время старта (с): " + ", ".join(
+        f"{name} {seconds}" for name, seconds in startup_state["timings"].items()
+    ))
+
+@web.middleware
+async def readiness_middleware(request, handler):
+    if startup_state["ready"] or request.path in HEALTH_ROUTES:
+        return await handler(request)
+    return web.Response(status=503, headers={"Retry-After": "1"})
+
+async def healthz(request):
+    return web.Response(text="ok")
+
+async def readyz(request):
+    return web.json_response(
+        {key: startup_state[key] for key in ("ready", "stage", "timings", "error")},
+        status=200 if startup_state["ready"] else 503
+    )
+
+def start_workers(app):
+    tasks = app["background_tasks"]
+    push_hub.bind(asyncio.get_running_loop())
+    if IS_UPDATE_OWNER:
+        # Апдейты, уведомления и обработка фото — только в одном процессе
+        for _ in range(WEBHOOK_WORKERS):
+            queue = asyncio.Queue()
+            webhook_queues.append(queue)
+            webhook_tasks.append(asyncio.create_task(webhook_worker(queue)))
+        tasks.append(asyncio.create_task(notification_worker()))
+        tasks.append(asyncio.create_task(ingest_existing_images()))
+        tasks.append(asyncio.create_task(resume_media_downloads()))
+        tasks.append(asyncio.create_task(media_gc_loop()))
+        tasks.append(asyncio.create_task(retention_loop()))
+        if MULTI_PROCESS:
+            tasks.append(asyncio.create_task(webhook_inbox_reader()))
+    tasks.append(asyncio.create_task(watch_static_assets()))
+    tasks.append(asyncio.create_task(watch_cache_events()))
+
+async def start_background_tasks(app):
+    startup_state["timings"]["import"] = round(time.perf_counter() - BOOT_STARTED, 3)
+    app["background_tasks"] = [asyncio.create_task(monitor_loop_lag())]
+    app["warmup_task"] = asyncio.create_task(warm_up(app))
+
+async def stop_background_tasks(app):
+    # Даём воркерам доработать уже принятые апдейты
+    try:
+        await asyncio.wait_for(asyncio.gather(*(q.join() for q in webhook_queues)), timeout=10)
+    except asyncio.TimeoutError:
+        print("⚠️ Не все апдейты обработаны до остановки")
+    # Потоки SSE завершаются сами, иначе остановка ждала бы их до таймаута
+    push_hub.close_all()
+    for task in webhook_tasks + app["background_tasks"] + [app["warmup_task"]]:
+        task.cancel()
+    webhook_queues.clear()
+    webhook_tasks.clear()
+    webhook_load["pending"] = 0
 
 # --------------------------------
 # Настройка маршрутов
 # --------------------------------
-app = web.Application()
-app.router.add_post(f"/webhook/{BOT_TOKEN}", webhook_handler)
+app = web.Application(middlewares=[http_metrics_middleware, readiness_middleware, rate_limit_middleware])
+app.router.add_post(f"/webhook/{BOT_TOKEN}", webhook_handler, name="webhook")
 app.router.add_get("/", index)
 app.router.add_get("/web", index)
 app.router.add_get("/web/{path:.+}", static_handler)
@@ -1034,8 +4591,18 @@ app.router.add_get("/api/products", api_products)
 app.router.add_post("/api/support/send", api_support_send)
 app.router.add_get("/api/support/history", api_support_history)
 app.router.add_post("/api/order/create", api_order_create)
+app.router.add_post("/api/cart/quote", api_cart_quote)
 app.router.add_get("/api/profile", api_profile)
+app.router.add_get("/api/webhook/stats", api_webhook_stats)
+app.router.add_get("/api/stats", api_sales_stats)
+app.router.add_get("/api/events", api_events)
+app.router.add_get("/metrics", metrics_handler)
+app.router.add_get("/healthz", healthz)
+app.router.add_get("/readyz", readyz)
+app.router.add_get("/images/derived/{name}", derived_image_handler)
 app.router.add_static("/images/", IMAGES_DIR)
+app.on_startup.append(start_background_tasks)
+app.on_cleanup.append(stop_background_tasks)
 print("✅ Маршруты настроены")
 
 # --------------------------------
@@ -1043,28 +4610,17 @@ print("✅ Маршруты настроены")
 # --------------------------------
 async def main():
     print("\n" + "=" * 60)
-    print("ЗАПУСК СЕРВЕРА")
+    print("ЗАПУСК СЕРВЕРА" + (f" (воркер #{WORKER_INDEX})" if WORKER_INDEX else ""))
     print("=" * 60)
     
-    print("\n🔄 Обновление data.json...")
-    refresh_web_data()
-    print("✅ data.json обновлён")
-
-    print("\n🔄 Удаление старого webhook...")
-    await bot.delete_webhook(drop_pending_updates=True)
-    print("✅ Старый webhook удалён")
-    
-    webhook_url = f"{RENDER_EXTERNAL_URL}/webhook/{BOT_TOKEN}"
-    print(f"\n🔄 Установка нового webhook: {webhook_url}")
-    await bot.set_webhook(webhook_url)
-    print("✅ Webhook установлен")
-
+    # Порт занимаем первым: прогрев идёт в фоне (см. warm_up)
     print("\n🔄 Запуск AIOHTTP сервера...")
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", PORT)
+    site = web.TCPSite(runner, "0.0.0.0", PORT, reuse_port=MULTI_PROCESS)
     await site.start()
-    print(f"✅ Сервер запущен на порту {PORT}")
+    startup_state["timings"]["bind"] = round(time.perf_counter() - BOOT_STARTED, 3)
+    print(f"✅ Сервер запущен на порту {PORT}, готовность: /readyz")
 
     print("\n" + "=" * 60)
     print("🎉 ВСЁ ГОТОВО!")
@@ -1074,14 +4630,80 @@ async def main():
     print("🍓 Бот готов к работе!")
     print("=" * 60)
 
-    await asyncio.Event().wait()
+    # По SIGTERM (остановка хостингом или супервизором) закрываемся штатно:
+    # on_cleanup дорабатывает принятые апдейты
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    await stop_event.wait()
+    print("\n🛑 Остановка сервера...")
+    await runner.cleanup()
+
+# --------------------------------
+# Супервизор (WORKER_PROCESSES > 1)
+# --------------------------------
+# Миграции и проверка webhook выполняются один раз в супервизоре,
+# затем он запускает воркеры — отдельные процессы этого же файла с
+# WORKER_INDEX; все слушают PORT через SO_REUSEPORT, и ядро само
+# распределяет соединения. Упавший воркер перезапускается.
+WORKER_RESTART_DELAY = 1
+
+def spawn_worker(index):
+    env = dict(os.environ, WORKER_INDEX=str(index))
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+
+def run_supervisor():
+    asyncio.run(setup_supervisor())
+    workers = {i: spawn_worker(i) for i in range(WORKER_PROCESSES)}
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"✅ Запущено воркеров: {len(workers)}")
+
+    while not stopping:
+        for index, proc in list(workers.items()):
+            code = proc.poll()
+            if code is not None:
+                print(f"⚠️ Воркер #{index} завершился с кодом {code}, перезапуск")
+                time.sleep(WORKER_RESTART_DELAY)
+                workers[index] = spawn_worker(index)
+        time.sleep(0.5)
+
+    print("\n🛑 Остановка воркеров...")
+    for proc in workers.values():
+        proc.terminate()
+    for proc in workers.values():
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+async def setup_supervisor():
+    # Миграции — до запуска воркеров, чтобы они не выполняли их наперегонки
+    prepare_database()
+    try:
+        await refresh_web_data()
+        await ensure_webhook()
+    except Exception as e:
+        print(f"⚠️ Не удалось проверить webhook: {e}")
+    finally:
+        await bot.session.close()
 
 if __name__ == "__main__":
     try:
-        print("\n▶️  Запуск asyncio.run(main())...")
-        asyncio.run(main())
+        if MULTI_PROCESS and not WORKER_INDEX:
+            print("\n▶️  Запуск супервизора...")
+            run_supervisor()
+        else:
+            print("\n▶️  Запуск asyncio.run(main())...")
+            asyncio.run(main())
     except Exception as e:
         print(f"\n❌ КРИТИЧЕСКАЯ ОШИБКА: {e}")
         import traceback
         traceback.print_exc()
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -25,6 +25,58 @@ function showBigMessage(text, color = '#4CAF50') {
 
 let products = [];
 let cart = {};
+// Причина, по которой сервер не примет корзину (из последнего расчёта), или null
+let cartQuoteError = null;
+
+// Каталог грузится страницами: первая отрисовка — одна небольшая страница,
+// остальное по кнопке «Показать ещё». Фильтр, поиск и сортировка — на сервере
+const CATALOG_PAGE_SIZE = 20;
+let catalogQuery = { category: '', q: '', sort: '' };
+let catalogCursor = null;
+let catalogRequest = 0;
+
+async function fetchCatalogPage(cursor) {
+  const params = new URLSearchParams({ limit: CATALOG_PAGE_SIZE });
+  if (catalogQuery.category) params.set('category', catalogQuery.category);
+  if (catalogQuery.q) params.set('q', catalogQuery.q);
+  if (catalogQuery.sort) params.set('sort', catalogQuery.sort);
+  if (cursor) params.set('cursor', cursor);
+
+  const response = await fetch(`/api/products?${params}`);
+  if (!response.ok) {
+    throw new Error(`HTTP ${response.status}`);
+  }
+  return response.json();
+}
+
+// Загрузка первой страницы для текущего фильтра
+async function loadCatalog() {
+  const request = ++catalogRequest;
+  const data = await fetchCatalogPage(null);
+  // Пока шёл запрос, пользователь мог сменить фильтр — старый ответ не нужен
+  if (request !== catalogRequest) return data;
+
+  products = data.items;
+  catalogCursor = data.next_cursor;
+  updateCategoryCounts(data.categories);
+  displayProducts(products);
+  return data;
+}
+
+async function loadMoreProducts(button) {
+  button.disabled = true;
+  const request = catalogRequest;
+  try {
+    const data = await fetchCatalogPage(catalogCursor);
+    if (request !== catalogRequest) return;
+    products = products.concat(data.items);
+    catalogCursor = data.next_cursor;
+    displayProducts(data.items, true);
+  } catch (error) {
+    button.disabled = false;
+    showTelegramAlert('Не удалось загрузить товары');
+  }
+}
 
 // Загрузка товаров
 async function loadProducts() {
@@ -33,24 +85,17 @@ async function loadProducts() {
   try {
     showBigMessage('🔄 Загружаю товары...');
 
-    const response = await fetch('/api/products');
+    const data = await loadCatalog();
 
-    showBigMessage(`📡 Ответ сервера:<br>Статус ${response.status}`);
+    showBigMessage(`✅ Загружено<br>${data.total} товаров`, '#4CAF50');
 
-    if (!response.ok) {
-      throw new Error(`HTTP ${response.status}`);
-    }
-
-    products = await response.json();
-
-    showBigMessage(`✅ Загружено<br>${products.length} товаров`, '#4CAF50');
-
-    if (products.length === 0) {
+    if (data.total === 0) {
       productList.innerHTML = '<p style="color: red; text-align: center; padding: 20px; grid-column: 1/-1;">⚠️ Товары не найдены!</p>';
       return;
     }
 
-    showAll();
+    setActiveButton('all');
+    setActiveFooterButton(0);
 
   } catch (error) {
     showBigMessage(`❌ ОШИБКА<br>${error.message}`, '#ff5555');
@@ -73,7 +118,14 @@ let currentProduct = null;
 let selectedWeight = null;
 let selectedDiscount = 0;
 
-function getImagePath(p) {
+const supportsWebP = document.createElement('canvas').toDataURL('image/webp').startsWith('data:image/webp');
+
+// size: "thumb" (сетка) или "medium" (карточка); без копий — оригинал
+function getImagePath(p, size) {
+  const variant = size && p.images && p.images[size];
+  if (variant) {
+    return supportsWebP ? variant.webp : variant.jpeg;
+  }
   if (p.image) {
     const clean = p.image.replace('images/', '');
     return `/images/${clean}`;
@@ -81,6 +133,14 @@ function getImagePath(p) {
   return '/images/placeholder.jpg';
 }
 
+// srcset из всех размеров — браузер сам выберет наименьший подходящий
+function getImageSrcset(p) {
+  if (!p.images) return '';
+  return Object.values(p.images)
+    .map(v => `${supportsWebP ? v.webp : v.jpeg} ${v.width}w`)
+    .join(', ');
+}
+
 // Функция для умного определения веса
 function parseSmartWeight(inputValue) {
   const value = parseFloat(inputValue);
@@ -144,20 +204,28 @@ function getPriceLogic(category) {
   return logic[category] || logic["Варенье"];
 }
 
-function displayProducts(items) {
-  productList.innerHTML = "";
+// Категория последней выведенной карточки — при догрузке страницы
+// заголовок не повторяется, если категория продолжается
+let renderedCategory = "";
+
+function displayProducts(items, append = false) {
+  const moreBtn = productList.querySelector('.load-more-btn');
+  if (moreBtn) moreBtn.remove();
+
+  if (!append) {
+    productList.innerHTML = "";
+    renderedCategory = "";
+  }
   
-  if (items.length === 0) {
+  if (!append && items.length === 0) {
     productList.innerHTML = '<p style="color: #666; text-align: center; padding: 20px; grid-column: 1/-1;">Товары не найдены</p>';
     return;
   }
   
-  let currentCategory = "";
-  
   items.forEach(p => {
     // Если категория изменилась - добавляем заголовок категории
-    if (p.category !== currentCategory) {
-      currentCategory = p.category;
+    if (p.category !== renderedCategory) {
+      renderedCategory = p.category;
       
       const categoryHeader = document.createElement("div");
       categoryHeader.className = "category-header";
@@ -186,12 +254,13 @@ function displayProducts(items) {
     const card = document.createElement("div");
     card.className = "product";
 
-    const imgSrc = getImagePath(p);
+    const imgSrc = getImagePath(p, 'thumb');
     const priceLogic = getPriceLogic(p.category);
     
     card.innerHTML = `
-      <img src="${imgSrc}" alt="${p.name}"
-           onerror="this.src='/images/placeholder.jpg'">
+      <img src="${imgSrc}" srcset="${getImageSrcset(p)}" sizes="50vw" alt="${p.name}"
+           loading="lazy" decoding="async"
+           onerror="this.removeAttribute('srcset'); this.src='/images/placeholder.jpg'">
       <div class="product-info">
         <div class="product-rating">⭐ (0)</div>
         <h3>${p.name}</h3>
@@ -201,6 +270,14 @@ function displayProducts(items) {
     card.onclick = () => openProduct(p);
     productList.appendChild(card);
   });
+
+  if (catalogCursor) {
+    const more = document.createElement('button');
+    more.className = 'load-more-btn support-older-btn';
+    more.textContent = 'Показать ещё';
+    more.onclick = () => loadMoreProducts(more);
+    productList.appendChild(more);
+  }
 }
 
 // Функция для описания категорий
@@ -213,19 +290,57 @@ function getCategoryDescription(category) {
   return descriptions[category] || "Категория товаров";
 }
 
+function reloadCatalog() {
+  loadCatalog().catch(error => {
+    productList.innerHTML = `<p style="color: red; text-align: center; padding: 20px; grid-column: 1/-1;">❌ ${error.message}</p>`;
+  });
+}
+
 function showAll() {
-  categoryTitle.textContent = 'Все товары';
-  displayProducts(products);
+  categoryTitle.textContent = catalogQuery.q ? 'Поиск' : 'Все товары';
+  catalogQuery.category = '';
+  reloadCatalog();
   setActiveButton('all');
   setActiveFooterButton(0);
 }
 
 function filterCategory(cat) {
   categoryTitle.textContent = cat;
-  displayProducts(products.filter(p => p.category === cat));
+  catalogQuery.category = cat;
+  reloadCatalog();
   setActiveButton(cat);
 }
 
+// Поиск по названию и описанию; запрос уходит после паузы в наборе
+let searchTimer = null;
+
+function onSearchInput(value) {
+  clearTimeout(searchTimer);
+  searchTimer = setTimeout(() => {
+    catalogQuery.q = value.trim();
+    if (!catalogQuery.category) {
+      categoryTitle.textContent = catalogQuery.q ? 'Поиск' : 'Все товары';
+    }
+    reloadCatalog();
+  }, 300);
+}
+
+function onSortChange(value) {
+  catalogQuery.sort = value;
+  reloadCatalog();
+}
+
+// Количество товаров на кнопках категорий (приходит с каждой страницей)
+function updateCategoryCounts(categories) {
+  if (!categories) return;
+  let total = 0;
+  Object.values(categories).forEach(n => total += n);
+  document.querySelectorAll('.nav-btn .nav-count').forEach(el => {
+    const cat = el.dataset.category;
+    el.textContent = cat ? (categories[cat] || 0) : total;
+  });
+}
+
 function setActiveButton(category) {
   document.querySelectorAll('.nav-btn').forEach(btn => btn.classList.remove('active'));
   
@@ -254,7 +369,7 @@ function openProduct(p) {
   document.body.style.overflow = "hidden";
 
   document.getElementById("modal-title").textContent = p.name;
-  document.getElementById("modal-image").src = getImagePath(p);
+  document.getElementById("modal-image").src = getImagePath(p, 'medium');
   
   const priceLogic = getPriceLogic(p.category);
   document.getElementById("modal-price").textContent = priceLogic.modalDisplay(p.price);
@@ -467,15 +582,20 @@ function addToCart() {
   const discount = basePrice * (selectedDiscount / 100);
   const finalPrice = Math.round(basePrice - discount);
   
+  // Порции храним отдельно: сервер пересчитывает каждую со своей скидкой
+  const portion = { weight: selectedWeight, discount: selectedDiscount };
+  
   if (cart[currentProduct.id]) {
     cart[currentProduct.id].weight += selectedWeight;
     cart[currentProduct.id].totalPrice += finalPrice;
+    cart[currentProduct.id].portions.push(portion);
   } else {
     cart[currentProduct.id] = { 
       product: currentProduct, 
       weight: selectedWeight,
       totalPrice: finalPrice,
-      discount: selectedDiscount
+      discount: selectedDiscount,
+      portions: [portion]
     };
   }
   
@@ -561,6 +681,13 @@ function showTelegramAlert(text) {
   }
 }
 
+// Ответ ограничителя частоты (429/503 с Retry-After) — текст для пользователя
+function rateLimitMessage(response) {
+  if (response.status !== 429 && response.status !== 503) return null;
+  const seconds = parseInt(response.headers.get("Retry-After"), 10) || 1;
+  return `⏳ Слишком много запросов. Попробуйте через ${seconds} с.`;
+}
+
 window.onclick = (e) => {
   if (e.target == modal) closeModal();
 }
@@ -610,34 +737,112 @@ function closeSupportModal() {
   document.body.style.overflow = "auto";
 }
 
+// Состояние окна истории: при повторном открытии догружаем только новое
+let supportUserId = null;
+let supportFirstId = null;
+let supportLastId = null;
+let supportHasOlder = false;
+
+function renderSupportMessage(msg) {
+  const msgDiv = document.createElement("div");
+  msgDiv.className = msg.from_admin ? "support-msg admin" : "support-msg user";
+  msgDiv.innerHTML = `
+    <div class="support-msg-text"></div>
+    <div class="support-msg-time"></div>
+  `;
+  msgDiv.querySelector(".support-msg-text").textContent = msg.message;
+  msgDiv.querySelector(".support-msg-time").textContent = msg.timestamp;
+  return msgDiv;
+}
+
+function updateOlderButton() {
+  const historyDiv = document.getElementById("support-history");
+  let btn = document.getElementById("support-older-btn");
+  if (!supportHasOlder) {
+    if (btn) btn.remove();
+    return;
+  }
+  if (!btn) {
+    btn = document.createElement("button");
+    btn.id = "support-older-btn";
+    btn.className = "support-older-btn";
+    btn.textContent = "⬆️ Показать ранние";
+    btn.onclick = loadOlderSupportMessages;
+    historyDiv.prepend(btn);
+  }
+}
+
 async function loadSupportHistory() {
   const user = getTelegramUser();
   const historyDiv = document.getElementById("support-history");
+  const incremental = supportUserId === user.id && supportLastId !== null;
+  
+  let url = `/api/support/history?user_id=${user.id}`;
+  if (incremental) {
+    url += `&since_id=${supportLastId}`;
+  }
   
   try {
-    const response = await fetch(`/api/support/history?user_id=${user.id}`);
+    const response = await fetch(url);
     const data = await response.json();
+    const messages = data.messages || [];
     
-    if (data.messages && data.messages.length > 0) {
-      historyDiv.innerHTML = "";
-      data.messages.forEach(msg => {
-        const msgDiv = document.createElement("div");
-        msgDiv.className = msg.from_admin ? "support-msg admin" : "support-msg user";
-        msgDiv.innerHTML = `
-          <div class="support-msg-text">${msg.message}</div>
-          <div class="support-msg-time">${msg.timestamp}</div>
-        `;
-        historyDiv.appendChild(msgDiv);
-      });
+    // Пропущено слишком много — проще перезагрузить окно целиком
+    if (incremental && data.has_more) {
+      supportLastId = null;
+      return loadSupportHistory();
+    }
+    
+    if (!incremental) {
+      supportUserId = user.id;
+      supportFirstId = messages.length > 0 ? messages[0].id : null;
+      supportHasOlder = Boolean(data.has_more);
       
+      if (messages.length === 0) {
+        historyDiv.innerHTML = '<p style="color: #666; text-align: center;">История сообщений пуста</p>';
+        return;
+      }
+      historyDiv.innerHTML = "";
+      updateOlderButton();
+    }
+    
+    messages.forEach(msg => historyDiv.appendChild(renderSupportMessage(msg)));
+    if (messages.length > 0) {
+      supportLastId = messages[messages.length - 1].id;
       // Скроллим вниз
       historyDiv.scrollTop = historyDiv.scrollHeight;
-    } else {
-      historyDiv.innerHTML = '<p style="color: #666; text-align: center;">История сообщений пуста</p>';
     }
   } catch (error) {
     console.error("Ошибка загрузки истории:", error);
-    historyDiv.innerHTML = '<p style="color: #ff5555; text-align: center;">Ошибка загрузки</p>';
+    if (!incremental) {
+      historyDiv.innerHTML = '<p style="color: #ff5555; text-align: center;">Ошибка загрузки</p>';
+    }
+  }
+}
+
+async function loadOlderSupportMessages() {
+  const user = getTelegramUser();
+  const historyDiv = document.getElementById("support-history");
+  if (supportFirstId === null) return;
+  
+  try {
+    const response = await fetch(`/api/support/history?user_id=${user.id}&before_id=${supportFirstId}`);
+    const data = await response.json();
+    const messages = data.messages || [];
+    
+    // Сохраняем позицию прокрутки, чтобы текущие сообщения не «прыгали»
+    const prevHeight = historyDiv.scrollHeight;
+    const anchor = document.getElementById("support-older-btn").nextSibling;
+    messages.forEach(msg => historyDiv.insertBefore(renderSupportMessage(msg), anchor));
+    
+    if (messages.length > 0) {
+      supportFirstId = messages[0].id;
+    }
+    supportHasOlder = Boolean(data.has_more);
+    updateOlderButton();
+    historyDiv.scrollTop += historyDiv.scrollHeight - prevHeight;
+  } catch (error) {
+    console.error("Ошибка загрузки истории:", error);
   }
 }
 
@@ -667,7 +872,7 @@ async function sendSupportMessage() {
       showTelegramAlert("✅ Сообщение отправлено!");
       loadSupportHistory();
     } else {
-      showTelegramAlert("❌ Ошибка отправки");
+      showTelegramAlert(rateLimitMessage(response) || "❌ Ошибка отправки");
     }
   } catch (error) {
     console.error("Ошибка отправки:", error);
@@ -692,35 +897,98 @@ async function openCart() {
   const cartItems = document.getElementById("cart-items");
   const cartTotal = document.getElementById("cart-total");
   
+  // Цены пересчитывает сервер; при ошибке сети показываем локальный расчёт
+  const quote = await quoteCart(items);
+  const quoted = {};
+  const lineErrors = {};
+  cartQuoteError = null;
+  if (quote && quote.items) {
+    quote.items.forEach(line => { quoted[line.product_id] = line.price; });
+    // Строки с ошибкой сервер не считает: не включаем их в итог и не даём
+    // оформить заказ, пока они в корзине
+    (quote.errors || []).forEach(e => {
+      if (e.line !== null && items[e.line]) {
+        lineErrors[items[e.line].product.id] = e.error;
+      } else {
+        cartQuoteError = `❌ ${e.error}`;
+      }
+    });
+    if (!cartQuoteError && Object.keys(lineErrors).length > 0) {
+      cartQuoteError = "❌ Уберите из корзины недоступные позиции";
+    }
+  }
+  
   let totalSum = 0;
   cartItems.innerHTML = "";
   
   items.forEach(item => {
     const p = item.product;
     const w = item.weight;
-    const price = item.totalPrice;
-    totalSum += price;
+    const error = lineErrors[p.id];
+    const price = quoted[p.id] !== undefined ? quoted[p.id] : item.totalPrice;
+    if (!error) {
+      item.totalPrice = price;
+      totalSum += price;
+    }
     
     const displayWeight = w >= 1 ? `${w} кг` : `${Math.round(w * 1000)} г`;
     
     const itemDiv = document.createElement("div");
-    itemDiv.className = "cart-item";
+    itemDiv.className = error ? "cart-item cart-item-error" : "cart-item";
     itemDiv.innerHTML = `
       <div>
         <strong>${p.name}</strong><br>
         <span style="color: #999;">${displayWeight}</span>
         ${item.discount > 0 ? `<span style="color: #FF5722;"> (-${item.discount}%)</span>` : ''}
+        ${error ? `<div class="cart-item-error-text">${error}</div>` : ''}
       </div>
-      <div style="font-weight: bold; color: #4CAF50;">${price} ₽</div>
+      ${error
+        ? `<button class="cart-item-remove" onclick="removeCartItem(${p.id})">✕</button>`
+        : `<div style="font-weight: bold; color: #4CAF50;">${price} ₽</div>`}
     `;
     cartItems.appendChild(itemDiv);
   });
   
-  cartTotal.textContent = `${totalSum} ₽`;
+  // Итог сервера равен сумме показанных строк без ошибок
+  cartTotal.textContent = `${quote && quote.items ? quote.total_price : totalSum} ₽`;
   cartModal.style.display = "block";
   document.body.style.overflow = "hidden";
 }
 
+function removeCartItem(productId) {
+  delete cart[productId];
+  updateCartBadge();
+  if (Object.keys(cart).length === 0) {
+    closeCartModal();
+  } else {
+    openCart();
+  }
+}
+
+function cartPayload(items) {
+  return items.map(item => ({
+    product_id: item.product.id,
+    name: item.product.name,
+    weight: item.weight,
+    portions: item.portions || [{ weight: item.weight, discount: 0 }]
+  }));
+}
+
+async function quoteCart(items) {
+  try {
+    const response = await fetch("/api/cart/quote", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ cart: cartPayload(items) })
+    });
+    if (rateLimitMessage(response)) return null;
+    return await response.json();
+  } catch (error) {
+    console.error("Ошибка расчёта корзины:", error);
+    return null;
+  }
+}
+
 function closeCartModal() {
   const cartModal = document.getElementById("cart-modal");
   cartModal.style.display = "none";
@@ -736,14 +1004,13 @@ async function checkoutOrder() {
     return;
   }
   
-  // Формируем данные заказа
-  const cartData = items.map(item => ({
-    name: item.product.name,
-    weight: item.weight,
-    price: item.totalPrice
-  }));
+  if (cartQuoteError) {
+    showTelegramAlert(cartQuoteError);
+    return;
+  }
   
-  const totalPrice = items.reduce((sum, item) => sum + item.totalPrice, 0);
+  // Формируем данные заказа (цены и итог считает сервер)
+  const cartData = cartPayload(items);
   
   try {
     const response = await fetch("/api/order/create", {
@@ -752,21 +1019,20 @@ async function checkoutOrder() {
       body: JSON.stringify({
         user_id: user.id,
         username: user.username || "неизвестен",
-        cart: cartData,
-        total_price: totalPrice
+        cart: cartData
       })
     });
     
     if (response.ok) {
       const data = await response.json();
-      showTelegramAlert(`✅ Заказ #${data.order_id} оформлен!\nС вами свяжутся в ближайшее время.`);
+      showTelegramAlert(`✅ Заказ #${data.order_id} оформлен!\nСумма: ${data.total_price} ₽\nС вами свяжутся в ближайшее время.`);
       
       // Очищаем корзину
       cart = {};
       updateCartBadge();
       closeCartModal();
     } else {
-      showTelegramAlert("❌ Ошибка оформления заказа");
+      showTelegramAlert(rateLimitMessage(response) || "❌ Ошибка оформления заказа");
     }
   } catch (error) {
     console.error("Ошибка оформления:", error);
@@ -777,6 +1043,58 @@ async function checkoutOrder() {
 // ========================================
 // ПРОФИЛЬ
 // ========================================
+function renderPurchase(purchase) {
+  const purchaseDiv = document.createElement("div");
+  purchaseDiv.className = "purchase-item";
+  
+  let productsHtml = "";
+  purchase.products.forEach(p => {
+    productsHtml += `<div>• ${p.name} (${p.weight} кг)</div>`;
+  });
+  
+  purchaseDiv.innerHTML = `
+    <div class="purchase-date">${purchase.timestamp}</div>
+    <div class="purchase-products">${productsHtml}</div>
+    <div class="purchase-total">Сумма: ${purchase.total_price} ₽</div>
+  `;
+  return purchaseDiv;
+}
+
+// История покупок грузится страницами, следующая — по кнопке
+async function loadPurchasesPage(before) {
+  const user = getTelegramUser();
+  const purchasesList = document.getElementById("purchases-list");
+  let url = `/api/profile?user_id=${user.id}&username=${user.username || "неизвестен"}`;
+  if (before) url += `&before=${before}`;
+  
+  const response = await fetch(url);
+  const data = await response.json();
+  
+  const oldButton = purchasesList.querySelector(".purchases-more-btn");
+  if (oldButton) oldButton.remove();
+  
+  (data.purchases || []).forEach(purchase => {
+    purchasesList.appendChild(renderPurchase(purchase));
+  });
+  
+  if (data.has_more) {
+    const moreButton = document.createElement("button");
+    moreButton.className = "purchases-more-btn support-older-btn";
+    moreButton.textContent = "Показать ещё";
+    moreButton.onclick = async () => {
+      moreButton.disabled = true;
+      try {
+        await loadPurchasesPage(data.next_before);
+      } catch (error) {
+        console.error("Ошибка загрузки покупок:", error);
+        moreButton.disabled = false;
+      }
+    };
+    purchasesList.appendChild(moreButton);
+  }
+  return data;
+}
+
 async function openProfile() {
   const user = getTelegramUser();
   const profileModal = document.getElementById("profile-modal");
@@ -790,30 +1108,10 @@ async function openProfile() {
   purchasesList.innerHTML = '<p style="color: #666; text-align: center;">⏳ Загрузка...</p>';
   
   try {
-    const response = await fetch(`/api/profile?user_id=${user.id}&username=${user.username || "неизвестен"}`);
-    const data = await response.json();
+    purchasesList.innerHTML = "";
+    const data = await loadPurchasesPage(null);
     
-    if (data.purchases && data.purchases.length > 0) {
-      purchasesList.innerHTML = "";
-      
-      data.purchases.forEach(purchase => {
-        const purchaseDiv = document.createElement("div");
-        purchaseDiv.className = "purchase-item";
-        
-        let productsHtml = "";
-        purchase.products.forEach(p => {
-          productsHtml += `<div>• ${p.name} (${p.weight} кг)</div>`;
-        });
-        
-        purchaseDiv.innerHTML = `
-          <div class="purchase-date">${purchase.timestamp}</div>
-          <div class="purchase-products">${productsHtml}</div>
-          <div class="purchase-total">Сумма: ${purchase.total_price} ₽</div>
-        `;
-        
-        purchasesList.appendChild(purchaseDiv);
-      });
-    } else {
+    if (!data.purchases || data.purchases.length === 0) {
       purchasesList.innerHTML = '<p style="color: #666; text-align: center;">У вас ещё нету покупок 📦</p>';
     }
   } catch (error) {
@@ -834,4 +1132,67 @@ function closeProfileModal() {
 function openOrders() {
   setActiveFooterButton(2);
   openProfile(); // Теперь кнопка "Заказы" открывает профиль с историей
-}
\ No newline at end of file
+}
+// ========================================
+// PUSH-СОБЫТИЯ
+// ========================================
+// Сервер сам сообщает об ответах поддержки, статусах заказов и изменениях
+// каталога (Server-Sent Events). EventSource переподключается сам и
+// передаёт Last-Event-ID — пропущенные события сервер досылает, а reset
+// означает, что досылать нечего и данные нужно перечитать.
+const ORDER_STATUS_TEXT = {
+  pending: "принят",
+  in_progress: "в работе",
+  completed: "выполнен"
+};
+
+let catalogRefreshTimer = null;
+
+function isModalOpen(id) {
+  return document.getElementById(id).style.display === "block";
+}
+
+// Правки каталога приходят пачками (импорт) — перечитываем один раз
+function scheduleCatalogRefresh() {
+  clearTimeout(catalogRefreshTimer);
+  catalogRefreshTimer = setTimeout(async () => {
+    try {
+      // Догруженные страницы не сбрасываем — обновляем только счётчики
+      if (products.length <= CATALOG_PAGE_SIZE) {
+        await loadCatalog();
+      } else {
+        updateCategoryCounts((await fetchCatalogPage(null)).categories);
+      }
+    } catch (error) {
+      console.error("Ошибка обновления каталога:", error);
+    }
+  }, 1000);
+}
+
+function connectEvents() {
+  if (!window.EventSource) return;
+  // EventSource не умеет заголовки, поэтому подписанные initData идут в query
+  const initData = window.Telegram?.WebApp?.initData;
+  const url = initData ? `/api/events?init_data=${encodeURIComponent(initData)}` : "/api/events";
+  const source = new EventSource(url);
+  
+  source.addEventListener("support", () => {
+    if (isModalOpen("support-modal")) loadSupportHistory();
+  });
+  
+  source.addEventListener("order", (event) => {
+    const data = JSON.parse(event.data);
+    showBigMessage(`📦 Заказ #${data.order_id}<br>${ORDER_STATUS_TEXT[data.status] || data.status}`);
+    if (isModalOpen("profile-modal")) openProfile();
+  });
+  
+  source.addEventListener("catalog", scheduleCatalogRefresh);
+  
+  source.addEventListener("reset", () => {
+    scheduleCatalogRefresh();
+    if (isModalOpen("support-modal")) loadSupportHistory();
+    if (isModalOpen("profile-modal")) openProfile();
+  });
+}
+
+connectEvents();